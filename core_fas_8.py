@@ -1,12 +1,46 @@
+import argparse
+import ast
+import base64
+import contextlib
+import hashlib
+import io
+import itertools
+import json
 import math
 import csv
+import multiprocessing
+import operator
 import os
+import queue
+import re
+import shutil
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import time
+import warnings
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlsplit
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox, simpledialog, colorchooser
 import tkinter.font as tkFont
 import xml.sax.saxutils as saxutils
 
-from PIL import Image  # pip install pillow
+# Обязательные сторонние библиотеки: Pillow (pip install pillow) и NumPy
+# (pip install numpy). Они импортируются лениво — в местах использования,
+# чтобы не замедлять запуск окна.
+
+# Отсчёт времени запуска (--startup-timing): от импорта модуля
+_PROCESS_T0 = time.perf_counter()
+
+# Задержка перед построением решётки/загрузкой CSV: окно успевает отрисоваться
+STARTUP_DEFER_MS = 30
 
 
 DEFAULT_FUEL_TYPES = [
@@ -23,9 +57,4168 @@ DEFAULT_FUEL_TYPES = [
     {"name": "Тип 10", "color": "#FFCCFF"},
 ]
 
+CSV_REQUIRED_COLUMNS = {"index", "q", "r", "shape", "fuel_type"}
+CSV_COLUMNS = [
+    "index", "q", "r", "shape", "fuel_type",
+    "pos_label", "factory_id",
+    "mass_fuel", "mass_boron", "mass_gd"
+]
+
+
+def read_cartogram_csv(filename):
+    """
+    Прочитать CSV картограммы (разделитель ';') и вернуть список строк-словарей
+    без преобразования значений. При отсутствии обязательных столбцов — ValueError.
+    """
+    with open(filename, "r", encoding="utf-8") as f:
+        return parse_cartogram_csv(f)
+
+
+def parse_cartogram_csv(lines):
+    """Строки-словари CSV картограммы из итерируемого по строкам текста (файл, splitlines)."""
+    reader = csv.DictReader(lines, delimiter=";")
+    rows = list(reader)
+
+    missing = CSV_REQUIRED_COLUMNS - set(reader.fieldnames or [])
+    if missing:
+        raise ValueError("В CSV отсутствуют столбцы: " + ", ".join(sorted(missing)))
+    return rows
+
+
+# Цвета автоматически создаваемых типов ТВС (по кругу, начиная с индекса 1)
+FUEL_TYPE_PALETTE = [
+    "#FFCC00", "#66CCFF", "#FF6666", "#99CC00",
+    "#CC99FF", "#FF9966", "#00CC99", "#9999FF",
+    "#CCCCCC", "#FFCCFF",
+]
+
+
+def auto_type_color(idx: int) -> str:
+    if idx == 0:
+        return "#FFFFFF"
+    return FUEL_TYPE_PALETTE[(idx - 1) % len(FUEL_TYPE_PALETTE)]
+
+
+def fuel_type_index(fuel_types, type_label) -> int:
+    """
+    Преобразует текстовый ярлык типа ТВС (например, 'ОМ-1' или 'ПЗ-2')
+    во внутренний индекс fuel_type. Если такого типа ещё нет в fuel_types,
+    он добавляется в список с автоматически подобранным цветом.
+
+    Поддерживает старый формат, когда в CSV в fuel_type записывался просто индекс.
+    """
+    if type_label is None:
+        type_label = ""
+    name = str(type_label).strip()
+
+    # Пустое поле считаем "Пусто"
+    if not name:
+        name = "Пусто"
+
+    # СТАРЫЙ ФОРМАТ: если поле целочисленное — трактуем его как индекс
+    if name.isdigit():
+        idx = int(name)
+        # расширяем список типов до нужного индекса
+        while len(fuel_types) <= idx:
+            j = len(fuel_types)
+            fuel_types.append({
+                "name": f"Тип {j}",
+                "color": auto_type_color(j),
+            })
+        return idx
+
+    # НОВЫЙ ФОРМАТ: строковое имя типа ('ОМ-1', 'ПЗ-2', ...)
+    # ищем существующий тип с таким именем
+    for idx, ft in enumerate(fuel_types):
+        if ft["name"] == name:
+            return idx
+
+    # если не нашли — создаём новый тип
+    new_idx = len(fuel_types)
+    fuel_types.append({
+        "name": name,
+        "color": auto_type_color(new_idx),
+    })
+    return new_idx
+
+
+def cells_data_from_rows(rows, fuel_types):
+    """
+    Преобразовать строки CSV в список ячеек: типы ТВС — во внутренние индексы
+    списка fuel_types (новые типы дописываются в него). Неизвестная форма
+    заменяется на hex, исходное значение остаётся в "shape_source" для проверки.
+    """
+    cells_data = []
+    for row in rows:
+        idx = int(row["index"])
+        q = int(row["q"])
+        r = int(row["r"])
+
+        shape = row["shape"].strip().lower()
+        shape_source = None
+        if shape not in ("hex", "circle"):
+            shape_source = row["shape"]
+            shape = "hex"
+
+        # читаем тип ТВС как текст и получаем для него внутренний индекс
+        fuel_type_label = row.get("fuel_type", "")
+        fuel_type = fuel_type_index(fuel_types, fuel_type_label)
+
+        pos_label = row.get("pos_label") if "pos_label" in row else ""
+        if not pos_label:
+            pos_label = str(idx)
+
+        factory_id = row.get("factory_id") if "factory_id" in row else ""
+        if factory_id is None:
+            factory_id = ""
+
+        mass_fuel = row.get("mass_fuel") if "mass_fuel" in row else ""
+        mass_boron = row.get("mass_boron") if "mass_boron" in row else ""
+        mass_gd = row.get("mass_gd") if "mass_gd" in row else ""
+
+        # прочие столбцы (например, из паспортов ТВС) — в "extra"
+        extra = {
+            k: v for k, v in row.items()
+            if k and k not in CSV_COLUMNS and isinstance(v, str) and v
+        }
+
+        cells_data.append({
+            "index": idx,
+            "q": q,
+            "r": r,
+            "shape": shape,
+            "fuel_type": fuel_type,
+            "pos_label": pos_label,
+            "factory_id": factory_id,
+            "mass_fuel": mass_fuel or "",
+            "mass_boron": mass_boron or "",
+            "mass_gd": mass_gd or "",
+            "extra": extra,
+        })
+        if shape_source is not None:
+            cells_data[-1]["shape_source"] = shape_source
+    return cells_data
+
+
+# ---------- Столбцовое представление ячеек и агрегаты ----------
+
+MASS_FIELDS = ("mass_fuel", "mass_boron", "mass_gd")
+
+# Величины для статистики: имя -> функция от CellColumns
+STAT_METRICS = {
+    "m_топл": lambda cols: cols.mass["mass_fuel"],
+    "m_B": lambda cols: cols.mass["mass_boron"],
+    "m_Gd": lambda cols: cols.mass["mass_gd"],
+    # m_погл = m_B + m_Gd; отсутствующая масса считается нулевой
+    "m_погл": lambda cols: cols.nan_to_zero("mass_boron") + cols.nan_to_zero("mass_gd"),
+}
+
+AGGREGATE_PERCENTILES = (5, 50, 95)
+
+
+def mass_or_nan(val) -> float:
+    """Масса из строки ('3053,9' / '3053.9'); пустое или нечисловое значение -> NaN."""
+    if val is None:
+        return math.nan
+    s = str(val).replace(",", ".").strip()
+    if not s:
+        return math.nan
+    try:
+        return float(s)
+    except ValueError:
+        return math.nan
+
+
+# Шесть соседей гекса в осевых координатах (q, r)
+HEX_DIRECTIONS = ((1, 0), (1, -1), (0, -1), (-1, 0), (-1, 1), (0, 1))
+
+
+class NeighbourTable:
+    """
+    Таблица соседей в формате CSR: соседи строки i — indices[indptr[i]:indptr[i + 1]].
+    Строится за линейное время через плотную сетку (q, r) -> номер строки;
+    owner[k] — строка, которой принадлежит k-я запись (для bincount / reduceat).
+    """
+
+    def __init__(self, q, r):
+        import numpy as np
+
+        n = q.size
+        self.n = n
+        if not n:
+            self.indptr = np.zeros(1, dtype=np.int64)
+            self.indices = np.zeros(0, dtype=np.int64)
+            self.owner = np.zeros(0, dtype=np.int64)
+            return
+
+        # сетка с полями в одну ячейку — соседи крайних ячеек не выходят за границы
+        q0 = q - int(q.min()) + 1
+        r0 = r - int(r.min()) + 1
+        grid = np.full((int(q0.max()) + 2, int(r0.max()) + 2), -1, dtype=np.int64)
+        grid[q0, r0] = np.arange(n)
+
+        nb = np.stack([grid[q0 + dq, r0 + dr] for dq, dr in HEX_DIRECTIONS], axis=1)  # (n, 6)
+        valid = nb >= 0
+        counts = valid.sum(axis=1)
+        self.indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.indptr[1:])
+        self.indices = nb[valid]  # построчно, в порядке строк
+        self.owner = np.repeat(np.arange(n), counts)
+
+    def counts(self):
+        import numpy as np
+        return np.diff(self.indptr)
+
+    def local_sum(self, values):
+        """Сумма значений соседей (отсутствующие — NaN — не учитываются)."""
+        import numpy as np
+        nv = values[self.indices]
+        return np.bincount(self.owner, weights=np.nan_to_num(nv, nan=0.0), minlength=self.n)
+
+    def local_mean(self, values):
+        """Среднее по соседям с известными значениями; NaN, если таких нет."""
+        import numpy as np
+        nv = values[self.indices]
+        count = np.bincount(self.owner, weights=~np.isnan(nv), minlength=self.n)
+        total = np.bincount(self.owner, weights=np.nan_to_num(nv, nan=0.0), minlength=self.n)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(count > 0, total / np.maximum(count, 1), np.nan)
+
+    def local_max_diff(self, values):
+        """Наибольшая |v_i − v_j| по соседям j; NaN, если сравнивать не с чем."""
+        import numpy as np
+        out = np.full(self.n, np.nan)
+        if not self.indices.size:
+            return out
+        diffs = np.abs(values[self.owner] - values[self.indices])
+        diffs = np.where(np.isnan(diffs), -np.inf, diffs)
+        nonempty = np.flatnonzero(np.diff(self.indptr) > 0)
+        out[nonempty] = np.maximum.reduceat(diffs, self.indptr[nonempty])
+        out[np.isinf(out)] = np.nan
+        return out
+
+
+class CellColumns:
+    """
+    Столбцовое представление ячеек (массивы NumPy).
+    Строка i соответствует i-й ячейке в порядке обхода self.cells;
+    отсутствующие массы хранятся как NaN.
+    """
+
+    def __init__(self, cells):
+        import numpy as np
+
+        cells = list(cells)
+        n = len(cells)
+        self.n = n
+        self.index = np.fromiter((c["index"] for c in cells), dtype=np.int64, count=n)
+        self.q = np.fromiter((c["q"] for c in cells), dtype=np.int64, count=n)
+        self.r = np.fromiter((c["r"] for c in cells), dtype=np.int64, count=n)
+        self.fuel_type = np.fromiter(
+            (c.get("fuel_type", 0) for c in cells), dtype=np.int64, count=n
+        )
+        self.mass = {
+            field: np.fromiter(
+                (mass_or_nan(c.get(field, "")) for c in cells), dtype=np.float64, count=n
+            )
+            for field in MASS_FIELDS
+        }
+        self.factory_id = [str(c.get("factory_id", "") or "") for c in cells]
+        self.pos_label = [str(c.get("pos_label", "") or "") for c in cells]
+
+        # производные массивы (сортированные индексы, ...) — лениво
+        self._derived = {}
+        # то, что зависит только от (q, r): кольца, секторы, соседи, образы симметрии
+        self._geometry = {}
+
+    # ---------- Геометрия решётки ----------
+
+    def adopt_geometry(self, other):
+        """
+        Взять готовую геометрию у столбцов прежней версии данных, если решётка
+        (q, r по строкам) не изменилась. Возвращает True при успехе.
+        """
+        import numpy as np
+        if other is None or other.n != self.n:
+            return False
+        if not (np.array_equal(other.q, self.q) and np.array_equal(other.r, self.r)):
+            return False
+        self._geometry = other._geometry
+        return True
+
+    def hex_center(self):
+        """Центральная ячейка (q, r): центр масс координат, округлённый до гекса."""
+        center = self._geometry.get("center")
+        if center is None:
+            center = self._geometry["center"] = self._hex_center()
+        return center
+
+    def _hex_center(self):
+        if not self.n:
+            return 0, 0
+        fq = float(self.q.mean())
+        fr = float(self.r.mean())
+        fs = -fq - fr
+        rq, rr, rs = round(fq), round(fr), round(fs)
+        dq, dr, ds = abs(rq - fq), abs(rr - fr), abs(rs - fs)
+        if dq > dr and dq > ds:
+            rq = -rr - rs
+        elif dr > ds:
+            rr = -rq - rs
+        return int(rq), int(rr)
+
+    @property
+    def ring(self):
+        """Номер кольца (1 — центральная ячейка) по гексагональному расстоянию от центра."""
+        ring = self._geometry.get("ring")
+        if ring is None:
+            import numpy as np
+            cq, cr = self.hex_center()
+            dq = self.q - cq
+            dr = self.r - cr
+            ring = (np.abs(dq) + np.abs(dr) + np.abs(dq + dr)) // 2 + 1
+            self._geometry["ring"] = ring
+        return ring
+
+    @property
+    def sector(self):
+        """
+        Номер 60°-сектора (0..5) относительно центральной ячейки; у центра -1.
+        Сектор k — углы [60k°, 60(k+1)°) в пиксельных координатах; поворот
+        решётки на 60° переводит сектор k в k+1.
+        """
+        sector = self._geometry.get("sector")
+        if sector is None:
+            import numpy as np
+            cq, cr = self.hex_center()
+            dq = (self.q - cq).astype(np.float64)
+            dr = (self.r - cr).astype(np.float64)
+            x = math.sqrt(3) * dq + math.sqrt(3) / 2 * dr
+            y = 1.5 * dr
+            angle = np.degrees(np.arctan2(y, x)) % 360.0
+            sector = (np.floor((angle + 1e-6) / 60.0).astype(np.int64)) % 6
+            sector[(dq == 0) & (dr == 0)] = -1
+            self._geometry["sector"] = sector
+        return sector
+
+    def symmetry_partners(self, element):
+        """
+        Для элемента симметрии (k, mirror) — номер строки образа каждой ячейки
+        (поворот на 60°·k вокруг центра, предварительно отражение q ↔ r) или -1.
+        """
+        key = ("partners", element)
+        partners = self._geometry.get(key)
+        if partners is None:
+            k, mirror = element
+            cq, cr = self.hex_center()
+            dq = self.q - cq
+            dr = self.r - cr
+            if mirror:
+                dq, dr = dr, dq
+            for _ in range(k % 6):
+                # поворот на 60° в кубических координатах: (q, r) -> (-r, q + r)
+                dq, dr = -dr, dq + dr
+            partners = axial_join(self.q, self.r, dq + cq, dr + cr)
+            self._geometry[key] = partners
+        return partners
+
+    @property
+    def neighbours(self):
+        """Таблица соседей (NeighbourTable), одна на решётку."""
+        table = self._geometry.get("neighbours")
+        if table is None:
+            table = self._geometry["neighbours"] = NeighbourTable(self.q, self.r)
+        return table
+
+    # ---------- Сортированные индексы ----------
+
+    def numeric_column(self, name):
+        """Числовой столбец по имени (index, q, r, fuel_type, ring, mass_*)."""
+        if name in self.mass:
+            return self.mass[name]
+        if name == "ring":
+            return self.ring
+        return getattr(self, name)
+
+    def sorted_index(self, name):
+        """
+        (порядок строк, отсортированные значения, число не-NaN) для столбца.
+        NaN (отсутствующие массы) после сортировки стоят в конце.
+        """
+        key = ("sorted", name)
+        entry = self._derived.get(key)
+        if entry is None:
+            import numpy as np
+            values = self.numeric_column(name)
+            order = np.argsort(values, kind="stable")
+            sorted_values = values[order]
+            valid = int(np.count_nonzero(~np.isnan(sorted_values))) if sorted_values.dtype.kind == "f" else values.size
+            entry = (order, sorted_values, valid)
+            self._derived[key] = entry
+        return entry
+
+    def range_mask(self, name, op, value):
+        """Маска строк, где столбец <op> value, через бинарный поиск по сортированному индексу."""
+        import numpy as np
+        order, sorted_values, valid = self.sorted_index(name)
+        head = sorted_values[:valid]
+        if op == "<":
+            rows = order[:np.searchsorted(head, value, side="left")]
+        elif op == "<=":
+            rows = order[:np.searchsorted(head, value, side="right")]
+        elif op == ">":
+            rows = order[np.searchsorted(head, value, side="right"):valid]
+        elif op == ">=":
+            rows = order[np.searchsorted(head, value, side="left"):valid]
+        else:  # "=" / "!="
+            lo = np.searchsorted(head, value, side="left")
+            hi = np.searchsorted(head, value, side="right")
+            if op == "=":
+                rows = order[lo:hi]
+            else:
+                rows = np.concatenate([order[:lo], order[hi:valid]])
+        mask = np.zeros(self.n, dtype=bool)
+        mask[rows] = True
+        return mask
+
+    def text_index(self, name):
+        """Хеш-индекс строкового столбца (factory_id, pos_label): значение -> номера строк."""
+        key = ("text", name)
+        index = self._derived.get(key)
+        if index is None:
+            index = {}
+            for i, v in enumerate(getattr(self, name)):
+                index.setdefault(v.strip(), []).append(i)
+            self._derived[key] = index
+        return index
+
+    def nan_to_zero(self, field):
+        import numpy as np
+        return np.nan_to_num(self.mass[field], nan=0.0)
+
+    def metric(self, name):
+        return STAT_METRICS[name](self)
+
+    def computed(self, column):
+        """Значения вычисляемого столбца (ComputedColumn); кэш живёт с этой версией данных."""
+        key = ("computed", column.text)
+        values = self._derived.get(key)
+        if values is None:
+            values = self._derived[key] = column.evaluate(self)
+        return values
+
+    def with_rows_updated(self, rows, cells):
+        """
+        Новые столбцы, где строки rows взяты из словарей cells (та же решётка).
+        Массивы копируются целиком, но без прохода Python по всем ячейкам;
+        геометрия общая, ленивые индексы строятся заново.
+        """
+        new = CellColumns.__new__(CellColumns)
+        new.n = self.n
+        new.index = self.index
+        new.q = self.q
+        new.r = self.r
+        new.fuel_type = self.fuel_type.copy()
+        new.mass = {field: values.copy() for field, values in self.mass.items()}
+        new.factory_id = list(self.factory_id)
+        new.pos_label = list(self.pos_label)
+        for row, cell in zip(rows, cells):
+            new.fuel_type[row] = cell.get("fuel_type", 0)
+            for field in MASS_FIELDS:
+                new.mass[field][row] = mass_or_nan(cell.get(field, ""))
+            new.factory_id[row] = str(cell.get("factory_id", "") or "")
+            new.pos_label[row] = str(cell.get("pos_label", "") or "")
+        new._derived = {}
+        new._geometry = self._geometry
+        return new
+
+
+class TypeAggregates:
+    """
+    Статистика по всем типам ТВС и всем величинам STAT_METRICS за один проход.
+
+    stats[metric][stat] — массив длины n_types; stat ∈ count, mean, std, min, max,
+    p5, p50, p95. Учитываются только положительные значения (как и в градиенте).
+    extra_metrics — дополнительные величины {имя: функция от CellColumns}
+    (вычисляемые столбцы); у них учитываются все значения, кроме NaN.
+    """
+
+    STAT_NAMES = ("count", "mean", "std", "min", "max") + tuple(
+        f"p{p}" for p in AGGREGATE_PERCENTILES
+    )
+
+    def __init__(self, columns, n_types, extra_metrics=None):
+        import numpy as np
+
+        self.n_types = n_types
+        self.stats = {}
+        types = columns.fuel_type
+
+        metrics = dict(STAT_METRICS)
+        metrics.update(extra_metrics or {})
+        for metric, fn in metrics.items():
+            values = fn(columns)
+            present = (values > 0.0) if metric in STAT_METRICS else ~np.isnan(values)
+            ok = present & (types >= 0) & (types < n_types)
+            vt = types[ok]
+            vv = values[ok]
+
+            count = np.bincount(vt, minlength=n_types)
+            sums = np.bincount(vt, weights=vv, minlength=n_types)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                mean = sums / count
+                dev = vv - mean[vt]
+                std = np.sqrt(np.bincount(vt, weights=dev * dev, minlength=n_types) / count)
+
+            # сортировка по (тип, значение): min/max/перцентили — индексы в группах
+            sv = vv[np.lexsort((vv, vt))]
+            starts = np.cumsum(count) - count
+            has = count > 0
+            last = np.where(has, starts + count - 1, 0)
+            first = np.where(has, starts, 0)
+
+            def pick(pos):
+                out = np.full(n_types, np.nan)
+                if sv.size:
+                    out[has] = sv[pos[has]]
+                return out
+
+            entry = {
+                "count": count,
+                "mean": np.where(has, mean, np.nan),
+                "std": np.where(has, std, np.nan),
+                "min": pick(first),
+                "max": pick(last),
+            }
+            for p in AGGREGATE_PERCENTILES:
+                # линейная интерполяция, как np.percentile по умолчанию
+                pos = first + (count - 1).clip(min=0) * (p / 100.0)
+                lo = np.floor(pos).astype(np.int64)
+                hi = np.minimum(lo + 1, last)
+                lo_v = pick(lo)
+                hi_v = pick(hi)
+                entry[f"p{p}"] = lo_v + (hi_v - lo_v) * (pos - lo)
+            self.stats[metric] = entry
+
+    def row(self, metric, type_id):
+        """Статистика одной величины для одного типа: dict stat -> число."""
+        entry = self.stats[metric]
+        if not (0 <= type_id < self.n_types):
+            return {"count": 0}
+        return {name: entry[name][type_id].item() for name in self.STAT_NAMES}
+
+    def table_rows(self):
+        """Строки сводной таблицы: (type_id, metric, stats dict) для непустых групп."""
+        rows = []
+        for type_id in range(self.n_types):
+            for metric in self.stats:
+                row = self.row(metric, type_id)
+                if row["count"]:
+                    rows.append((type_id, metric, row))
+        return rows
+
+
+# Деление зоны на кольца / 60°-секторы: название -> (номер зоны по строкам, число зон)
+ZONE_KINDS = {
+    "Кольца": lambda cols: (cols.ring - 1, int(cols.ring.max()) if cols.n else 0),
+    "Секторы": lambda cols: (cols.sector, 6),
+}
+
+
+class ZoneAggregates:
+    """
+    Агрегаты по зонам (кольцам или секторам): число ТВС каждого типа, сумма
+    и среднее масс. Хранятся только счётчики и суммы, поэтому правка ячеек
+    учитывается вычитанием старого вклада строк и добавлением нового.
+    Строки с номером зоны -1 (центр для секторов) не учитываются.
+    """
+
+    def __init__(self, columns, kind, n_types):
+        import numpy as np
+
+        self.kind = kind
+        self.zone, self.n_zones = ZONE_KINDS[kind](columns)
+        self.n_types = n_types
+        self.type_counts = np.zeros((self.n_zones, n_types), dtype=np.int64)
+        self.sums = {f: np.zeros(self.n_zones) for f in MASS_FIELDS}
+        self.counts = {f: np.zeros(self.n_zones, dtype=np.int64) for f in MASS_FIELDS}
+        self._add(columns, np.arange(columns.n), 1)
+
+    def _add(self, columns, rows, sign):
+        import numpy as np
+
+        zone = self.zone[rows]
+        ok = zone >= 0
+        rows = rows[ok]
+        zone = zone[ok]
+        types = columns.fuel_type[rows]
+        typed = (types >= 0) & (types < self.n_types)
+        np.add.at(self.type_counts, (zone[typed], types[typed]), sign)
+        for field in MASS_FIELDS:
+            values = columns.mass[field][rows]
+            known = ~np.isnan(values)
+            np.add.at(self.sums[field], zone[known], sign * values[known])
+            np.add.at(self.counts[field], zone[known], sign)
+
+    def update_rows(self, rows, old_columns, new_columns):
+        """Учесть правку строк rows: old_columns — до правки, new_columns — после."""
+        import numpy as np
+        rows = np.asarray(rows, dtype=np.int64)
+        self._add(old_columns, rows, -1)
+        self._add(new_columns, rows, 1)
+
+    def cell_counts(self):
+        return self.type_counts.sum(axis=1)
+
+    def mean(self, field):
+        import numpy as np
+        counts = self.counts[field]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(counts > 0, self.sums[field] / np.maximum(counts, 1), np.nan)
+
+    def table_rows(self):
+        """Строки таблицы: номер зоны (с 1), число ТВС, по типам, суммы и средние масс."""
+        means = {f: self.mean(f) for f in MASS_FIELDS}
+        total = self.cell_counts()
+        rows = []
+        for z in range(self.n_zones):
+            row = {"zone": z + 1, "count": int(total[z])}
+            for t in range(self.n_types):
+                row[f"type_{t}"] = int(self.type_counts[z, t])
+            for f in MASS_FIELDS:
+                row[f"sum_{f}"] = float(self.sums[f][z])
+                row[f"mean_{f}"] = float(means[f][z])
+            rows.append(row)
+        return rows
+
+
+# ---------- Масштабирование градиента ----------
+
+SCALING_MEAN_MAX = "Среднее, макс. откл."
+SCALING_MEAN_SIGMA = "Среднее ± kσ"
+SCALING_MEDIAN_MAD = "Медиана ± k·MAD"
+SCALING_FIXED = "Фиксированный диапазон"
+SCALING_QUANTILE = "Квантили"
+
+SCALING_MODES = [
+    SCALING_MEAN_MAX,
+    SCALING_MEAN_SIGMA,
+    SCALING_MEDIAN_MAD,
+    SCALING_FIXED,
+    SCALING_QUANTILE,
+]
+
+# MAD -> σ для нормального распределения
+MAD_TO_SIGMA = 1.4826
+
+
+class ValueDistribution:
+    """
+    Отсортированная выборка значений и её гистограмма.
+    Считается один раз на версию данных; все способы масштабирования
+    градиента берут центр и размах отсюда без повторного прохода по ячейкам.
+    """
+
+    HIST_BINS = 40
+
+    def __init__(self, values):
+        import numpy as np
+
+        v = np.sort(np.asarray(values, dtype=np.float64))
+        self.sorted = v
+        self.n = int(v.size)
+        if not self.n:
+            self.mean = self.std = self.median = self.mad = math.nan
+            self.min = self.max = math.nan
+            self.hist_counts = np.zeros(self.HIST_BINS, dtype=np.int64)
+            self.hist_edges = np.linspace(0.0, 1.0, self.HIST_BINS + 1)
+            return
+
+        self.min = float(v[0])
+        self.max = float(v[-1])
+        self.mean = float(v.mean())
+        self.std = float(v.std())
+        self.median = self.quantile(0.5)
+        self.mad = float(np.median(np.abs(v - self.median)))
+        self.hist_counts, self.hist_edges = np.histogram(v, bins=self.HIST_BINS)
+
+    def quantile(self, p: float) -> float:
+        """Квантиль p ∈ [0,1] по отсортированному массиву (линейная интерполяция)."""
+        if not self.n:
+            return math.nan
+        p = max(0.0, min(1.0, p))
+        pos = (self.n - 1) * p
+        lo = int(math.floor(pos))
+        hi = min(lo + 1, self.n - 1)
+        return float(self.sorted[lo] + (self.sorted[hi] - self.sorted[lo]) * (pos - lo))
+
+    def center_swing(self, scaling, k=2.0, fixed_range=None, quantiles=(0.05, 0.95)):
+        """
+        Центр и размах градиента для выбранного способа масштабирования.
+        Значения за пределами центр ± размах окрашиваются предельным цветом.
+        """
+        if scaling == SCALING_MEAN_SIGMA:
+            return self.mean, k * self.std
+        if scaling == SCALING_MEDIAN_MAD:
+            return self.median, k * MAD_TO_SIGMA * self.mad
+        if scaling == SCALING_FIXED:
+            lo, hi = fixed_range
+            return (lo + hi) / 2.0, abs(hi - lo) / 2.0
+        if scaling == SCALING_QUANTILE:
+            q_lo = self.quantile(min(quantiles))
+            q_hi = self.quantile(max(quantiles))
+            return self.median, max(self.median - q_lo, q_hi - self.median)
+        # SCALING_MEAN_MAX — исходный вариант: среднее и максимальное отклонение
+        return self.mean, max(abs(self.min - self.mean), abs(self.max - self.mean))
+
+
+def gradient_color(v, center, swing):
+    """
+    Цвет градиента по принципу VBA: ниже центра — холодные тона, выше — тёплые,
+    в центре — белый. Компоненты ограничены диапазоном [100..255].
+    """
+    intColorMax = 255
+    intColorMin = 100
+    color_range = intColorMax - intColorMin
+
+    dev = abs(v - center) / swing if swing > 0 else 0.0
+    if dev > 1.0:
+        dev = 1.0
+    intDeltaColor = int(dev * color_range)
+
+    if v < center:
+        intR = intColorMax - intDeltaColor
+        intG = intColorMax - intDeltaColor
+        intB = intColorMax
+    elif v > center:
+        intR = intColorMax
+        intG = intColorMax - intDeltaColor
+        intB = intColorMax - intDeltaColor
+    else:
+        intR = intG = intB = intColorMax
+    return f"#{intR:02X}{intG:02X}{intB:02X}"
+
+
+# ---------- Режимы окраски и стили ячеек ----------
+
+COLOR_MODE_TYPES = "По типам ТВС"
+
+# Градиентные режимы: название -> (поле массы, только выбранный тип)
+GRADIENT_MODES = {
+    "Градиент m_топл (все)": ("mass_fuel", False),
+    "Градиент m_бор (все)": ("mass_boron", False),
+    "Градиент m_гадолиний (все)": ("mass_gd", False),
+    "Градиент m_топл (выбранный тип)": ("mass_fuel", True),
+    "Градиент m_бор (выбранный тип)": ("mass_boron", True),
+    "Градиент m_гадолиний (выбранный тип)": ("mass_gd", True),
+}
+
+# Режимы сравнения с другой картограммой: название -> поле массы (None — классы)
+DIFF_MODES = {
+    "Сравнение: классы ячеек": None,
+    "Сравнение: Δ m_топл": "mass_fuel",
+    "Сравнение: Δ m_бор": "mass_boron",
+    "Сравнение: Δ m_гадолиний": "mass_gd",
+}
+
+# Режимы сравнения с соседями: название -> (поле массы, величина)
+#   "deviation" — относительное отклонение от среднего по соседям,
+#   "max_diff" — наибольшая разность с соседом, "sum" — сумма по соседям
+LOCAL_MODES = {
+    "Соседи: отклонение m_топл": ("mass_fuel", "deviation"),
+    "Соседи: отклонение m_бор": ("mass_boron", "deviation"),
+    "Соседи: отклонение m_гадолиний": ("mass_gd", "deviation"),
+    "Соседи: макс. разность m_топл": ("mass_fuel", "max_diff"),
+    "Соседи: макс. разность m_бор": ("mass_boron", "max_diff"),
+    "Соседи: макс. разность m_гадолиний": ("mass_gd", "max_diff"),
+    "Соседи: сумма m_топл": ("mass_fuel", "sum"),
+    "Соседи: сумма m_бор": ("mass_boron", "sum"),
+    "Соседи: сумма m_гадолиний": ("mass_gd", "sum"),
+}
+
+# Режимы по кольцам: ячейка красится средним своего кольца
+ZONE_MODES = {
+    "Кольца: среднее m_топл": ("Кольца", "mass_fuel"),
+    "Кольца: среднее m_бор": ("Кольца", "mass_boron"),
+    "Кольца: среднее m_гадолиний": ("Кольца", "mass_gd"),
+}
+
+# Градиент по результату последнего запроса к архиву циклов
+FLEET_MODE = "Архив: результат запроса"
+
+COLOR_MODES = (
+    [COLOR_MODE_TYPES] + list(GRADIENT_MODES) + list(LOCAL_MODES)
+    + list(ZONE_MODES) + list(DIFF_MODES) + [FLEET_MODE]
+)
+
+# Число запомненных раскрасок (режим, тип, масштаб, версия данных)
+COLORING_CACHE_SIZE = 12
+
+INACTIVE_FILL = "#F0F0F0"
+INACTIVE_OUTLINE = "#CCCCCC"
+
+# Стиль ячейки: (заливка, контур, толщина контура, текст нижней метки, цвет текста)
+BLANK_STYLE = ("#FFFFFF", "black", 1, "", "black")
+INACTIVE_STYLE = (INACTIVE_FILL, INACTIVE_OUTLINE, 1, "", INACTIVE_OUTLINE)
+
+
+def type_cell_styles(columns, fuel_colors):
+    """Стили ячеек для окраски по типам ТВС: цвет типа и заводской номер."""
+    n_types = len(fuel_colors)
+    styles = []
+    for t, factory_id in zip(columns.fuel_type.tolist(), columns.factory_id):
+        color = fuel_colors[t] if 0 <= t < n_types else "#FFFFFF"
+        styles.append((color, "black", 1, factory_id, "black"))
+    return styles
+
+
+def _gradient_palettes():
+    """Таблицы цветов градиента по целому сдвигу компонент 0..155 (как в gradient_color)."""
+    cold = [f"#{255 - d:02X}{255 - d:02X}FF" for d in range(156)]
+    warm = [f"#FF{255 - d:02X}{255 - d:02X}" for d in range(156)]
+    return cold, warm
+
+
+_GRADIENT_COLD, _GRADIENT_WARM = _gradient_palettes()
+
+
+def gradient_cell_styles(values, active, center, swing, blank=None, absolute_labels=False):
+    """
+    Стили ячеек для градиента (векторно, те же цвета, что gradient_color).
+    active — ячейки, участвующие в выборке; blank — ячейки, которые красятся
+    белым без подписи (другие типы при нулевом размахе); остальные неактивны.
+    Подпись — относительное отклонение от центра или, при absolute_labels,
+    само значение со знаком (для разностей).
+    """
+    import numpy as np
+
+    n = values.size
+    styles = [INACTIVE_STYLE] * n
+    rows = np.flatnonzero(active)
+    if blank is not None:
+        for i in np.flatnonzero(blank & ~active).tolist():
+            styles[i] = BLANK_STYLE
+
+    v = values[rows]
+    if swing <= 0.0:
+        for i, vi in zip(rows.tolist(), v.tolist()):
+            label = f"{vi:+.3f}" if absolute_labels else "+0.000"
+            styles[i] = ("#FFFFFF", "black", 1, label, "black")
+        return styles
+
+    dev = np.minimum(np.abs(v - center) / swing, 1.0)
+    delta = (dev * 155).astype(np.int64)
+    if absolute_labels:
+        rel = v
+    else:
+        rel = (v - center) / center if center != 0 else np.zeros_like(v)
+    for i, vi, di, ri in zip(rows.tolist(), v.tolist(), delta.tolist(), rel.tolist()):
+        if vi < center:
+            color = _GRADIENT_COLD[di]
+        elif vi > center:
+            color = _GRADIENT_WARM[di]
+        else:
+            color = "#FFFFFF"
+        styles[i] = (color, "black", 1, f"{ri:+.3f}", "black")
+    return styles
+
+
+def mass_gradient_styles(columns, field, type_id, dist, center_swing):
+    """
+    Градиент по полю массы: все ячейки (type_id=None) или только тип type_id.
+    dist — распределение ненулевых значений той же выборки, center_swing(dist) —
+    центр и размах выбранного масштабирования. Возвращает (стили, dist, центр,
+    размах) или None, если значений нет.
+    """
+    # выборка: только ненулевые значения (и только выбранный тип)
+    values = columns.mass[field]
+    active = values > 0.0
+    blank = None
+    if type_id is not None:
+        same_type = columns.fuel_type == type_id
+        active &= same_type
+        blank = ~same_type
+    if not dist.n:
+        return None
+
+    # центр и "амплитуда" отклонений (аналог dblValueCenter / dblSwing)
+    center, swing = center_swing(dist)
+    if swing > 0.0:
+        # при ненулевом размахе другие типы выглядят как неактивные ячейки
+        blank = None
+    styles = gradient_cell_styles(values, active, center, swing, blank=blank)
+    return styles, dist, center, swing
+
+
+def local_cell_styles(columns, field, kind, center_swing):
+    """
+    Раскраска по соседям: относительное отклонение от среднего по соседям
+    (центр 0, симметричный размах) или градиент наибольшей разности / суммы
+    по соседям с выбранным масштабированием.
+    """
+    import numpy as np
+
+    table = columns.neighbours
+    values = columns.mass[field]
+    if kind == "deviation":
+        mean = table.local_mean(values)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            rel = np.where(mean != 0, values / mean - 1.0, np.nan)
+        active = ~np.isnan(rel)
+        if not active.any():
+            return None
+        dist = ValueDistribution(rel[active])
+        swing = max(abs(dist.min), abs(dist.max))
+        styles = gradient_cell_styles(rel, active, 0.0, swing, absolute_labels=True)
+        return styles, dist, 0.0, swing
+
+    if kind == "max_diff":
+        local = table.local_max_diff(values)
+    else:
+        local = table.local_sum(values)
+        local[table.counts() == 0] = np.nan
+    active = ~np.isnan(local) & (local > 0.0)
+    if not active.any():
+        return None
+    dist = ValueDistribution(local[active])
+    center, swing = center_swing(dist)
+    styles = gradient_cell_styles(local, active, center, swing)
+    return styles, dist, center, swing
+
+
+def zone_cell_styles(aggregates, field, center_swing):
+    """Каждая ячейка красится средним значением своей зоны (кольца)."""
+    import numpy as np
+
+    zone = aggregates.zone
+    mean = aggregates.mean(field)
+    values = np.full(zone.size, np.nan)
+    in_zone = zone >= 0
+    values[in_zone] = mean[zone[in_zone]]
+    active = ~np.isnan(values) & (values > 0.0)
+    if not active.any():
+        return None
+    dist = ValueDistribution(values[active])
+    center, swing = center_swing(dist)
+    styles = gradient_cell_styles(values, active, center, swing)
+    return styles, dist, center, swing
+
+
+def computed_cell_styles(values, center_swing):
+    """Градиент по вычисляемому столбцу: все ячейки со значением, подпись — само значение."""
+    import numpy as np
+
+    active = ~np.isnan(values)
+    if not active.any():
+        return None
+    dist = ValueDistribution(values[active])
+    center, swing = center_swing(dist)
+    styles = gradient_cell_styles(values, active, center, swing, absolute_labels=True)
+    return styles, dist, center, swing
+
+
+# Режимы окраски, доступные без окна программы (сравнение и архив требуют её состояния)
+HEADLESS_MODES = [COLOR_MODE_TYPES] + list(GRADIENT_MODES) + list(LOCAL_MODES) + list(ZONE_MODES)
+
+
+def mode_cell_styles(columns, mode, fuel_colors, selected_type=0, center_swing=None):
+    """
+    Стили ячеек для режима окраски из HEADLESS_MODES без Tk (рендер-сервис,
+    пакетный экспорт). center_swing по умолчанию — среднее и макс. отклонение.
+    Возвращает (стили, распределение, центр, размах) или None — нет значений.
+    """
+    if center_swing is None:
+        def center_swing(dist):
+            return dist.center_swing(SCALING_MEAN_MAX)
+    if mode == COLOR_MODE_TYPES:
+        return type_cell_styles(columns, fuel_colors), None, None, None
+    if mode in GRADIENT_MODES:
+        field, per_type = GRADIENT_MODES[mode]
+        type_id = selected_type if per_type else None
+        values = columns.mass[field]
+        mask = values > 0.0
+        if type_id is not None:
+            mask &= columns.fuel_type == type_id
+        return mass_gradient_styles(columns, field, type_id, ValueDistribution(values[mask]), center_swing)
+    if mode in LOCAL_MODES:
+        return local_cell_styles(columns, *LOCAL_MODES[mode], center_swing)
+    if mode in ZONE_MODES:
+        kind, field = ZONE_MODES[mode]
+        return zone_cell_styles(ZoneAggregates(columns, kind, len(fuel_colors)), field, center_swing)
+    raise ValueError(f"Режим окраски недоступен без окна программы: {mode}")
+
+
+# ---------- Анализ симметрии ----------
+
+# Группа симметрии: название -> (элементы (поворот k·60°, отражение), способ деления на секторы)
+SYMMETRY_GROUPS = {
+    "Поворот 60° (C6)": ([(k, False) for k in range(6)], "sector6"),
+    "Поворот 120° (C3)": ([(0, False), (2, False), (4, False)], "sector3"),
+    "Поворот 180° (C2)": ([(0, False), (3, False)], "sector2"),
+    "Зеркальная (ось q = r)": ([(0, False), (0, True)], "mirror"),
+    "Повороты и зеркала (D6)": ([(k, m) for m in (False, True) for k in range(6)], "sector6"),
+}
+
+
+class SymmetryAnalysis:
+    """
+    Проверка симметрии распределения масс для гексагональной зоны.
+
+    Для каждой ячейки заранее вычисляются целочисленные массивы образов при всех
+    элементах группы (CellColumns.symmetry_partners). Орбита ячейки — множество её
+    образов; отклонение ячейки — разность значения и среднего по орбите.
+    Суммы по секторам считаются через np.bincount.
+    """
+
+    def __init__(self, columns, group_name, worst_count=20):
+        import numpy as np
+
+        elements, sector_kind = SYMMETRY_GROUPS[group_name]
+        self.columns = columns
+        self.group_name = group_name
+
+        partners = np.stack([columns.symmetry_partners(e) for e in elements])  # (G, n)
+        self.complete = (partners >= 0).all(axis=0)
+        self.incomplete_count = int(np.count_nonzero(~self.complete))
+        safe = np.where(partners >= 0, partners, np.arange(columns.n)[None, :])
+        # номер орбиты — наименьший номер строки среди образов
+        self.orbit = safe.min(axis=0) if columns.n else np.zeros(0, dtype=np.int64)
+
+        if sector_kind == "mirror":
+            cq, cr = columns.hex_center()
+            side = (columns.q - cq) - (columns.r - cr)
+            self.sector = np.where(side > 0, 0, np.where(side < 0, 1, -1))
+            self.sector_count = 2
+        else:
+            sector = columns.sector
+            div = {"sector6": 1, "sector3": 2, "sector2": 3}[sector_kind]
+            self.sector = np.where(sector >= 0, sector // div, -1)
+            self.sector_count = 6 // div
+
+        in_sector = self.sector >= 0
+        self.sector_sums = {}
+        self.deviation = {}
+        self.rel_deviation = {}
+        self.orbit_mean = {}
+        for field in MASS_FIELDS:
+            values = columns.mass[field]
+            self.sector_sums[field] = np.bincount(
+                self.sector[in_sector],
+                weights=np.nan_to_num(values[in_sector], nan=0.0),
+                minlength=self.sector_count,
+            )
+            # среднее по орбите без отсутствующих значений
+            image_values = np.where(partners >= 0, values[safe], np.nan)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                valid = ~np.isnan(image_values)
+                count = valid.sum(axis=0)
+                mean = np.where(count > 0, np.nansum(image_values, axis=0) / np.maximum(count, 1), np.nan)
+                dev = values - mean
+                rel = np.where(mean != 0, dev / mean, np.nan)
+            self.orbit_mean[field] = mean
+            self.deviation[field] = dev
+            self.rel_deviation[field] = rel
+
+        self.worst_count = worst_count
+
+    def max_rel_deviation(self, field):
+        import numpy as np
+        rel = np.abs(self.rel_deviation[field])
+        return float(np.nanmax(rel)) if np.any(~np.isnan(rel)) else math.nan
+
+    def worst_rows(self, field, count=None):
+        """Строки с наибольшим |относительным отклонением| от среднего по орбите."""
+        import numpy as np
+        count = self.worst_count if count is None else count
+        rel = np.abs(self.rel_deviation[field])
+        rel = np.where(np.isnan(rel), -1.0, rel)
+        if not rel.size:
+            return np.zeros(0, dtype=np.int64)
+        count = min(count, rel.size)
+        top = np.argpartition(-rel, count - 1)[:count]
+        top = top[np.argsort(-rel[top], kind="stable")]
+        return top[rel[top] > 0]
+
+
+# ---------- Запросы по атрибутам ячеек ----------
+
+# Имена полей в запросах (регистр не важен) -> столбец CellColumns
+QUERY_FIELDS = {
+    "mass_fuel": "mass_fuel", "m_fuel": "mass_fuel", "m_топл": "mass_fuel",
+    "mass_boron": "mass_boron", "m_b": "mass_boron", "m_бор": "mass_boron",
+    "mass_gd": "mass_gd", "m_gd": "mass_gd", "m_гадолиний": "mass_gd",
+    "type": "fuel_type", "fuel_type": "fuel_type", "тип": "fuel_type",
+    "ring": "ring", "кольцо": "ring",
+    "index": "index", "индекс": "index",
+    "q": "q", "r": "r",
+    "factory_id": "factory_id", "зав": "factory_id",
+    "pos": "pos_label", "pos_label": "pos_label", "позиция": "pos_label",
+}
+QUERY_TEXT_FIELDS = {"factory_id", "pos_label"}
+
+QUERY_KEYWORDS = {
+    "and": "AND", "и": "AND",
+    "or": "OR", "или": "OR",
+    "not": "NOT", "не": "NOT",
+    "is": "IS",
+    "missing": "MISSING", "пусто": "MISSING",
+}
+
+_QUERY_TOKEN_RE = None
+
+
+def _query_tokens(text):
+    global _QUERY_TOKEN_RE
+    if _QUERY_TOKEN_RE is None:
+        _QUERY_TOKEN_RE = re.compile(
+            r"\s*(?:(?P<num>[-+]?\d+(?:[.,]\d+)?(?:[eE][-+]?\d+)?(?![\w\-]))"
+            r"|(?P<str>\"[^\"]*\"|'[^']*')"
+            r"|(?P<op><=|>=|!=|==|<>|=|<|>)"
+            r"|(?P<paren>[()])"
+            r"|(?P<word>[\w\-]+))"
+        )
+    pos = 0
+    tokens = []
+    text = text.strip()
+    while pos < len(text):
+        m = _QUERY_TOKEN_RE.match(text, pos)
+        if not m or m.end() == pos:
+            raise ValueError(f"Непонятный символ в запросе: {text[pos:pos + 10]!r}")
+        pos = m.end()
+        kind = m.lastgroup
+        value = m.group(kind)
+        if kind == "word" and value.lower() in QUERY_KEYWORDS:
+            tokens.append(("kw", QUERY_KEYWORDS[value.lower()]))
+        elif kind == "str":
+            tokens.append(("str", value[1:-1]))
+        elif kind == "op":
+            tokens.append(("op", {"==": "=", "<>": "!="}.get(value, value)))
+        else:
+            tokens.append((kind, value))
+    return tokens
+
+
+class CellQuery:
+    """
+    Небольшой язык запросов по атрибутам ячеек:
+
+        mass_fuel < 3050
+        type = 7 AND m_gd > 0
+        ring = 5 AND mass_boron IS MISSING
+        (type = 1 OR type = 2) AND NOT factory_id = 347
+
+    Сравнения: < <= > >= = !=; логика: AND/OR/NOT (И/ИЛИ/НЕ), скобки.
+    Числовые сравнения вычисляются бинарным поиском по сортированным индексам
+    столбцов, строковые (factory_id, pos) — по хеш-индексу; результат — маска NumPy.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self._tokens = _query_tokens(text)
+        self._pos = 0
+        if not self._tokens:
+            raise ValueError("Пустой запрос.")
+        self.tree = self._parse_or()
+        if self._pos != len(self._tokens):
+            raise ValueError(f"Лишний фрагмент запроса: {self._tokens[self._pos][1]!r}")
+
+    # --- разбор (рекурсивный спуск) ---
+
+    def _peek(self):
+        return self._tokens[self._pos] if self._pos < len(self._tokens) else (None, None)
+
+    def _take(self):
+        tok = self._peek()
+        self._pos += 1
+        return tok
+
+    def _parse_or(self):
+        node = self._parse_and()
+        while self._peek() == ("kw", "OR"):
+            self._take()
+            node = ("or", node, self._parse_and())
+        return node
+
+    def _parse_and(self):
+        node = self._parse_not()
+        while self._peek() == ("kw", "AND"):
+            self._take()
+            node = ("and", node, self._parse_not())
+        return node
+
+    def _parse_not(self):
+        if self._peek() == ("kw", "NOT"):
+            self._take()
+            return ("not", self._parse_not())
+        if self._peek() == ("paren", "("):
+            self._take()
+            node = self._parse_or()
+            if self._take() != ("paren", ")"):
+                raise ValueError("Не закрыта скобка в запросе.")
+            return node
+        return self._parse_comparison()
+
+    def _parse_comparison(self):
+        kind, word = self._take()
+        if kind != "word" or word.lower() not in QUERY_FIELDS:
+            raise ValueError(
+                f"Неизвестное поле {word!r}. Доступны: "
+                + ", ".join(sorted(set(QUERY_FIELDS)))
+            )
+        field = QUERY_FIELDS[word.lower()]
+
+        if self._peek() == ("kw", "IS"):
+            self._take()
+            negate = False
+            if self._peek() == ("kw", "NOT"):
+                self._take()
+                negate = True
+            if self._take() != ("kw", "MISSING"):
+                raise ValueError("Ожидалось IS [NOT] MISSING.")
+            node = ("missing", field)
+            return ("not", node) if negate else node
+
+        kind, op = self._take()
+        if kind != "op":
+            raise ValueError(f"Ожидался оператор сравнения после {word!r}.")
+        kind, value = self._take()
+        if kind not in ("num", "str", "word"):
+            raise ValueError(f"Ожидалось значение после {word} {op}.")
+
+        if field in QUERY_TEXT_FIELDS:
+            if op not in ("=", "!="):
+                raise ValueError(f"Для поля {word!r} допустимы только = и !=.")
+            return ("text", field, op, str(value).strip())
+        if kind == "str" or kind == "word":
+            raise ValueError(f"Для поля {word!r} нужно числовое значение.")
+        return ("cmp", field, op, float(value.replace(",", ".")))
+
+    # --- вычисление ---
+
+    def evaluate(self, columns):
+        """Маска строк CellColumns, удовлетворяющих запросу."""
+        return self._eval(self.tree, columns)
+
+    def _eval(self, node, columns):
+        import numpy as np
+
+        kind = node[0]
+        if kind == "or":
+            return self._eval(node[1], columns) | self._eval(node[2], columns)
+        if kind == "and":
+            return self._eval(node[1], columns) & self._eval(node[2], columns)
+        if kind == "not":
+            return ~self._eval(node[1], columns)
+        if kind == "missing":
+            field = node[1]
+            if field in QUERY_TEXT_FIELDS:
+                return np.array([not v.strip() for v in getattr(columns, field)], dtype=bool)
+            values = columns.numeric_column(field)
+            if values.dtype.kind != "f":
+                return np.zeros(columns.n, dtype=bool)
+            return np.isnan(values)
+        if kind == "text":
+            _, field, op, value = node
+            mask = np.zeros(columns.n, dtype=bool)
+            mask[columns.text_index(field).get(value, [])] = True
+            return mask if op == "=" else ~mask
+        _, field, op, value = node
+        return columns.range_mask(field, op, value)
+
+
+# ---------- Вычисляемые столбцы ----------
+
+# Функции выражений: имя -> (функция NumPy, число аргументов); mean / median — по всей зоне
+COMPUTED_FUNCTIONS = {
+    "abs": ("abs", 1),
+    "sqrt": ("sqrt", 1),
+    "log": ("log", 1),
+    "exp": ("exp", 1),
+    "min": ("fmin", 2),
+    "max": ("fmax", 2),
+    "nz": ("nan_to_num", 1),        # отсутствующее значение -> 0
+    "mean": ("nanmean", 1),
+    "median": ("nanmedian", 1),
+}
+
+# Наибольшая вложенность выражения: вычисление — цепочка вложенных вызовов
+COMPUTED_MAX_DEPTH = 100
+
+# Режим окраски вычисляемого столбца: префикс + имя столбца
+COMPUTED_MODE_PREFIX = "Вычисл.: "
+
+
+class ComputedColumn:
+    """
+    Вычисляемый столбец: арифметическое выражение над числовыми полями
+    запросов (QUERY_FIELDS: массы, тип, кольцо, q, r, index), например
+
+        nz(m_b) + nz(m_gd)
+        m_топл / (nz(m_b) + nz(m_gd))
+        mass_fuel - 3050
+        mass_fuel - mean(mass_fuel)
+
+    Выражение разбирается ast один раз и допускает только числа, поля,
+    + - * / ** и функции COMPUTED_FUNCTIONS; дерево превращается в цепочку
+    функций над массивами NumPy. Результат — float64 по всем строкам,
+    NaN там, где значение не определено (нет массы, деление на 0).
+    """
+
+    def __init__(self, name, text):
+        self.name = name
+        self.text = text
+        self.fields = set()
+        try:
+            tree = ast.parse(text.strip(), mode="eval")
+            self._fn = self._compile(tree.body)
+        except SyntaxError as e:
+            raise ValueError(f"Синтаксическая ошибка: {e.msg}") from None
+        except (RecursionError, MemoryError):
+            # ast.parse и рекурсивный _compile не справляются с глубокой вложенностью
+            raise ValueError("Выражение слишком длинное или слишком глубоко вложенное") from None
+
+    def _compile(self, node, depth=0):
+        import numpy as np
+
+        if depth > COMPUTED_MAX_DEPTH:
+            raise ValueError(f"Выражение вложено глубже {COMPUTED_MAX_DEPTH} уровней")
+
+        if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+            try:
+                value = np.float64(node.value)     # переполнение в ** даёт inf, а не исключение
+            except OverflowError:
+                raise ValueError(f"Слишком большое число: {node.value}") from None
+            return lambda cols: value
+        if isinstance(node, ast.Name):
+            field = QUERY_FIELDS.get(node.id.lower())
+            if field is None or field in QUERY_TEXT_FIELDS:
+                names = sorted(k for k, v in QUERY_FIELDS.items() if v not in QUERY_TEXT_FIELDS)
+                raise ValueError(f"Неизвестное числовое поле {node.id!r}. Доступны: " + ", ".join(names))
+            self.fields.add(field)
+            return lambda cols: cols.numeric_column(field).astype(np.float64, copy=False)
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+            operand = self._compile(node.operand, depth + 1)
+            if isinstance(node.op, ast.UAdd):
+                return operand
+            return lambda cols: -operand(cols)
+        binary = {
+            ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul,
+            ast.Div: operator.truediv, ast.Pow: operator.pow,
+        }
+        if isinstance(node, ast.BinOp) and type(node.op) in binary:
+            op = binary[type(node.op)]
+            left = self._compile(node.left, depth + 1)
+            right = self._compile(node.right, depth + 1)
+            return lambda cols: op(left(cols), right(cols))
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and not node.keywords:
+            spec = COMPUTED_FUNCTIONS.get(node.func.id.lower())
+            if spec is not None:
+                fn = getattr(np, spec[0])
+                if len(node.args) != spec[1]:
+                    raise ValueError(f"{node.func.id}(): нужно аргументов — {spec[1]}.")
+                args = [self._compile(arg, depth + 1) for arg in node.args]
+                return lambda cols: fn(*[arg(cols) for arg in args])
+            raise ValueError(
+                f"Неизвестная функция {node.func.id!r}. Доступны: " + ", ".join(COMPUTED_FUNCTIONS)
+            )
+        raise ValueError(f"Недопустимый элемент выражения: {ast.unparse(node)!r}")
+
+    def evaluate(self, columns):
+        """Значения по всем строкам CellColumns (без кэша, см. CellColumns.computed)."""
+        import numpy as np
+
+        with np.errstate(all="ignore"), warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)    # mean / median без значений
+            values = self._fn(columns)
+        values = np.array(np.broadcast_to(values, (columns.n,)), dtype=np.float64)
+        values[~np.isfinite(values)] = np.nan
+        return values
+
+
+# ---------- Сравнение двух картограмм ----------
+
+DIFF_UNCHANGED = 0
+DIFF_MOVED = 1
+DIFF_FRESH = 2
+DIFF_TYPE_CHANGED = 3
+DIFF_VACATED = 4
+DIFF_NEW_POSITION = 5
+
+DIFF_CATEGORY_NAMES = [
+    "без изменений",
+    "перемещена",
+    "свежая",
+    "тип изменён",
+    "освобождена",
+    "новая позиция",
+]
+DIFF_CATEGORY_COLORS = [
+    "#FFFFFF",
+    "#66CCFF",
+    "#99CC00",
+    "#FF9966",
+    "#CCCCCC",
+    "#FFCCFF",
+]
+DIFF_DISCHARGED_NAME = "выгружена"
+
+
+def axial_join(q_from, r_from, q_to, r_to):
+    """
+    Для каждой позиции (q_to, r_to) — номер строки с теми же (q, r) в (q_from, r_from)
+    или -1. Не хэш-соединение: ключ q*span + r, argsort и searchsorted по
+    отсортированным ключам — O(n log n), зато целиком в NumPy без цикла по ячейкам.
+    """
+    import numpy as np
+
+    if not q_from.size or not q_to.size:
+        return np.full(q_to.size, -1, dtype=np.int64)
+    q_min = min(int(q_from.min()), int(q_to.min()))
+    r_min = min(int(r_from.min()), int(r_to.min()))
+    span = max(int(r_from.max()), int(r_to.max())) - r_min + 1
+    keys_from = (q_from - q_min) * span + (r_from - r_min)
+    keys_to = (q_to - q_min) * span + (r_to - r_min)
+
+    order = np.argsort(keys_from, kind="stable")
+    sorted_keys = keys_from[order]
+    pos = np.searchsorted(sorted_keys, keys_to)
+    pos_c = np.minimum(pos, sorted_keys.size - 1)
+    found = sorted_keys[pos_c] == keys_to
+    return np.where(found, order[pos_c], -1)
+
+
+class CartogramDiff:
+    """
+    Сравнение текущей картограммы (new) с предыдущей (old).
+
+    Соединение двух картограмм хеш-таблицами: по позиции (q, r) и по заводскому
+    номеру. Для каждой ячейки текущей картограммы определяется класс
+    (DIFF_*), позиция, откуда перемещена ТВС, и разности масс на позиции
+    (new − old). ТВС старой картограммы, отсутствующие в новой, — выгруженные.
+    """
+
+    def __init__(self, old_cols, new_cols):
+        import numpy as np
+
+        self.old = old_cols
+        self.new = new_cols
+        n = new_cols.n
+
+        # соединение по позиции: (q, r) упаковываются в одно целое, строки старой
+        # картограммы ищутся бинарным поиском по отсортированным ключам
+        self.old_row_at_pos = axial_join(old_cols.q, old_cols.r, new_cols.q, new_cols.r)
+
+        # соединение по заводскому номеру: хеш номер -> строка старой картограммы
+        # (при повторах номера берётся первая строка)
+        old_fids = [fid.strip() for fid in old_cols.factory_id]
+        new_fids = [fid.strip() for fid in new_cols.factory_id]
+        old_fid = dict(zip(reversed(old_fids), range(len(old_fids) - 1, -1, -1)))
+        old_fid.pop("", None)
+        fid_row = np.array([old_fid.get(fid, -1) for fid in new_fids], dtype=np.int64)
+        has_fid = np.array([bool(fid) for fid in new_fids], dtype=bool)
+        old_has_fid = np.array([bool(fid) for fid in old_fids], dtype=bool)
+
+        j = self.old_row_at_pos
+        has_pos = j >= 0
+        safe_j = np.where(has_pos, j, 0)
+        if old_cols.n:
+            type_changed = has_pos & (old_cols.fuel_type[safe_j] != new_cols.fuel_type)
+            old_occupied = has_pos & old_has_fid[safe_j]
+        else:
+            type_changed = old_occupied = np.zeros(n, dtype=bool)
+
+        category = np.full(n, DIFF_UNCHANGED, dtype=np.int8)
+        empty = ~has_fid
+        category[empty & type_changed] = DIFF_TYPE_CHANGED
+        category[empty & old_occupied] = DIFF_VACATED
+        category[empty & ~has_pos] = DIFF_NEW_POSITION
+        category[has_fid & (fid_row == j) & type_changed] = DIFF_TYPE_CHANGED
+        moved = has_fid & (fid_row >= 0) & (fid_row != j)
+        category[moved] = DIFF_MOVED
+        category[has_fid & (fid_row < 0)] = DIFF_FRESH
+        self.category = category
+        self.moved_from_row = np.where(moved, fid_row, -1)
+
+        new_fid_set = set(new_fids)
+        self.discharged_rows = [
+            i for i, fid in enumerate(old_fids) if fid and fid not in new_fid_set
+        ]
+
+        # разности масс на позиции (NaN, если позиции нет или масса не задана)
+        self.delta = {}
+        for field in MASS_FIELDS:
+            old_v = old_cols.mass[field][safe_j] if old_cols.n else np.full(n, np.nan)
+            self.delta[field] = np.where(has_pos, new_cols.mass[field] - old_v, np.nan)
+
+    def counts(self):
+        """Число ячеек по классам (и число выгруженных ТВС)."""
+        import numpy as np
+        bins = np.bincount(self.category, minlength=len(DIFF_CATEGORY_NAMES))
+        result = {name: int(c) for name, c in zip(DIFF_CATEGORY_NAMES, bins.tolist())}
+        result[DIFF_DISCHARGED_NAME] = len(self.discharged_rows)
+        return result
+
+    def table_rows(self, type_name):
+        """Строки таблицы различий (словари); type_name(idx) -> название типа."""
+        new = self.new
+        old = self.old
+        rows = []
+        for i in range(new.n):
+            j = int(self.old_row_at_pos[i])
+            k = int(self.moved_from_row[i])
+            rows.append({
+                "pos_label": new.pos_label[i],
+                "q": int(new.q[i]),
+                "r": int(new.r[i]),
+                "category": DIFF_CATEGORY_NAMES[self.category[i]],
+                "moved_from": old.pos_label[k] if k >= 0 else "",
+                "factory_id_old": old.factory_id[j] if j >= 0 else "",
+                "factory_id_new": new.factory_id[i],
+                "fuel_type_old": type_name(int(old.fuel_type[j])) if j >= 0 else "",
+                "fuel_type_new": type_name(int(new.fuel_type[i])),
+                **{f"d_{field}": self.delta[field][i].item() for field in MASS_FIELDS},
+            })
+        for j in self.discharged_rows:
+            rows.append({
+                "pos_label": old.pos_label[j],
+                "q": int(old.q[j]),
+                "r": int(old.r[j]),
+                "category": DIFF_DISCHARGED_NAME,
+                "moved_from": "",
+                "factory_id_old": old.factory_id[j],
+                "factory_id_new": "",
+                "fuel_type_old": type_name(int(old.fuel_type[j])),
+                "fuel_type_new": "",
+                **{f"d_{field}": math.nan for field in MASS_FIELDS},
+            })
+        return rows
+
+
+DIFF_TABLE_COLUMNS = [
+    "pos_label", "q", "r", "category", "moved_from",
+    "factory_id_old", "factory_id_new", "fuel_type_old", "fuel_type_new",
+    "d_mass_fuel", "d_mass_boron", "d_mass_gd",
+]
+
+
+# ---------- Импорт паспортов ТВС ----------
+
+# Сколько номеров перечислять в отчёте об импорте
+PASSPORT_REPORT_SAMPLE = 10
+
+
+def iter_passport_csv(filename):
+    """
+    Потоковое чтение реестра паспортов: (заголовок, итератор строк-списков).
+    Разделитель ';' или ',' определяется по заголовку; файл закрывается,
+    когда итератор исчерпан.
+    """
+    f = open(filename, "r", encoding="utf-8-sig", newline="")
+    header_line = f.readline()
+    delimiter = ";" if header_line.count(";") >= header_line.count(",") else ","
+    header = [h.strip() for h in next(csv.reader([header_line], delimiter=delimiter), [])]
+    if "factory_id" not in header:
+        f.close()
+        raise ValueError("В реестре паспортов нет столбца factory_id")
+
+    def rows():
+        with f:
+            yield from csv.reader(f, delimiter=delimiter)
+
+    return header, rows()
+
+
+class PassportJoin:
+    """
+    Соединение реестра паспортов с картограммой по заводскому номеру.
+
+    Картограмма индексируется хешем factory_id -> строки (CellColumns.text_index),
+    реестр читается потоком: в памяти остаются множество встреченных номеров
+    и паспорта, нашедшие позицию. Для повторяющегося номера берётся первая
+    запись реестра. Пустые значения паспорта не затирают данные картограммы.
+    Остальные столбцы картограммы (тип, позиция, координаты, ...) из реестра
+    не берутся и перечисляются в отчёте как пропущенные.
+    """
+
+    def __init__(self, columns, header, rows):
+        index = columns.text_index("factory_id")
+        key_col = header.index("factory_id")
+        self.mass_columns = [(f, header.index(f)) for f in MASS_FIELDS if f in header]
+        self.extra_columns = [
+            (name, i) for i, name in enumerate(header)
+            if name and name not in CSV_COLUMNS
+        ]
+        self.ignored_columns = [
+            name for name in header
+            if name in CSV_COLUMNS and name != "factory_id" and name not in MASS_FIELDS
+        ]
+
+        self.updates = {}           # строка картограммы -> строка реестра
+        self.registry_rows = 0
+        self.blank_rows = 0
+        self.unmatched_count = 0
+        self.unmatched_sample = []
+        self.duplicates = {}        # номер -> сколько раз встретился в реестре
+        seen = set()
+        width = len(header)
+        for rec in rows:
+            self.registry_rows += 1
+            if len(rec) < width:
+                rec = rec + [""] * (width - len(rec))
+            fid = rec[key_col].strip()
+            if not fid:
+                self.blank_rows += 1
+                continue
+            if fid in seen:
+                self.duplicates[fid] = self.duplicates.get(fid, 1) + 1
+                continue
+            seen.add(fid)
+            map_rows = index.get(fid)
+            if map_rows is None:
+                self.unmatched_count += 1
+                if len(self.unmatched_sample) < PASSPORT_REPORT_SAMPLE:
+                    self.unmatched_sample.append(fid)
+                continue
+            for row in map_rows:
+                self.updates[row] = rec
+
+        # номера картограммы без паспорта и номера, стоящие на нескольких позициях
+        self.missing_on_map = sorted(fid for fid in index if fid and fid not in seen)
+        self.map_duplicates = sorted(fid for fid, r in index.items() if fid and len(r) > 1)
+
+    def changes(self, cell_of_row):
+        """
+        Изменения для apply_cell_changes: [(строка, поле, значение)].
+        cell_of_row(row) — словарь ячейки (для слияния дополнительных полей).
+        """
+        out = []
+        for row, rec in self.updates.items():
+            for field, i in self.mass_columns:
+                value = rec[i].strip()
+                if value:
+                    out.append((row, field, value))
+            extra = {name: rec[i].strip() for name, i in self.extra_columns if rec[i].strip()}
+            if extra:
+                merged = dict(cell_of_row(row).get("extra") or {})
+                merged.update(extra)
+                out.append((row, "extra", merged))
+        return out
+
+    def report_lines(self):
+        def sample(values):
+            values = list(values)
+            text = ", ".join(values[:PASSPORT_REPORT_SAMPLE])
+            if len(values) > PASSPORT_REPORT_SAMPLE:
+                text += ", …"
+            return text
+
+        lines = [
+            f"Записей в реестре: {self.registry_rows}",
+            f"Найдено позиций на картограмме: {len(self.updates)}",
+        ]
+        if self.blank_rows:
+            lines.append(f"Записей без заводского номера: {self.blank_rows}")
+        if self.unmatched_count:
+            lines.append(
+                f"Номеров реестра нет на картограмме: {self.unmatched_count} "
+                f"({sample(self.unmatched_sample)})"
+            )
+        if self.duplicates:
+            lines.append(
+                f"Повторяющихся номеров в реестре: {len(self.duplicates)} "
+                f"({sample(self.duplicates)}) — взята первая запись"
+            )
+        if self.missing_on_map:
+            lines.append(
+                f"Позиций без паспорта: {len(self.missing_on_map)} ({sample(self.missing_on_map)})"
+            )
+        if self.map_duplicates:
+            lines.append(
+                f"Номеров на нескольких позициях картограммы: {len(self.map_duplicates)} "
+                f"({sample(self.map_duplicates)})"
+            )
+        if self.extra_columns:
+            lines.append("Дополнительные столбцы: " + ", ".join(n for n, _ in self.extra_columns))
+        if self.ignored_columns:
+            lines.append(
+                "Пропущены столбцы картограммы (из реестра не берутся): "
+                + ", ".join(self.ignored_columns)
+            )
+        return lines
+
+
+# ---------- Проверка данных картограммы ----------
+
+VALIDATION_ERROR = "ошибка"
+VALIDATION_WARNING = "предупреждение"
+VALIDATION_SAMPLE = 10      # сколько позиций перечислять в описании нарушения
+VALIDATION_MARK_COLOR = "#FF8C00"   # кольца ячеек с замечаниями (отдельно от подсветки выделения)
+VALIDATION_MARKS_MAX = 5000         # больше колец не рисуется
+
+CELL_SHAPES = frozenset(("hex", "circle"))
+
+
+class ValidationFinding:
+    """Нарушение правила проверки: строгость, правило, описание и строки ячеек."""
+
+    __slots__ = ("severity", "rule", "message", "rows")
+
+    def __init__(self, severity, rule, message, rows):
+        self.severity = severity
+        self.rule = rule
+        self.message = message
+        self.rows = rows
+
+
+def _duplicate_rows(keys, skip=None):
+    """
+    Строки, ключ которых встречается больше одного раза (хеш-таблица, один
+    проход), и число таких ключей. Ключ skip (например, пустой) не проверяется.
+    """
+    keys = list(keys)
+    distinct = set(keys)
+    distinct.discard(skip)
+    if len(distinct) == len(keys) - keys.count(skip):
+        return [], 0        # повторов нет — обычный случай, без прохода по строкам
+    first = {}
+    repeated = set()
+    rows = []
+    for i, key in enumerate(keys):
+        if key == skip:
+            continue
+        j = first.setdefault(key, i)
+        if j != i:
+            if key not in repeated:
+                repeated.add(key)
+                rows.append(j)
+            rows.append(i)
+    rows.sort()
+    return rows, len(repeated)
+
+
+def validate_cartogram(columns, cells_data, raw_rows=None):
+    """
+    Проверка картограммы за линейное время: повторы координат, индексов и
+    заводских номеров, нечисловые и отрицательные массы, неизвестные формы.
+    cells_data — ячейки в порядке строк columns (форма приведена к hex / circle,
+    исходная неизвестная — в "shape_source"); raw_rows — строки CSV до
+    преобразования, если ячейки собраны не cells_data_from_rows.
+    Возвращает список ValidationFinding: сначала ошибки, затем предупреждения.
+    """
+    import numpy as np
+
+    labels = columns.pos_label
+    findings = []
+
+    def add(severity, rule, text, rows):
+        if not rows:
+            return
+        sample = ", ".join(labels[i] for i in rows[:VALIDATION_SAMPLE])
+        if len(rows) > VALIDATION_SAMPLE:
+            sample += ", …"
+        findings.append(ValidationFinding(severity, rule, f"{text} ({sample})", rows))
+
+    rows, k = _duplicate_rows(zip(columns.q.tolist(), columns.r.tolist()))
+    add(VALIDATION_ERROR, "coords", f"Повтор координат (q, r): значений {k}, ячеек {len(rows)}", rows)
+    rows, k = _duplicate_rows(columns.index.tolist())
+    add(VALIDATION_ERROR, "index", f"Повтор index: значений {k}, ячеек {len(rows)}", rows)
+    rows, k = _duplicate_rows(columns.factory_id, skip="")
+    add(VALIDATION_ERROR, "factory_id", f"Заводской номер на нескольких позициях: номеров {k}, ячеек {len(rows)}", rows)
+
+    for field in MASS_FIELDS:
+        mass = columns.mass[field]
+        # NaN — пустое поле или нечисловой текст: строки смотрим только у них
+        rows = [
+            i for i in np.flatnonzero(~np.isfinite(mass)).tolist()
+            if str(cells_data[i].get(field, "") or "").strip()
+        ]
+        add(VALIDATION_ERROR, field, f"{field}: нечисловое значение (читается как 0), ячеек {len(rows)}", rows)
+        with np.errstate(invalid="ignore"):
+            rows = np.flatnonzero(mass < 0).tolist()
+        add(VALIDATION_ERROR, field, f"{field}: отрицательная масса, ячеек {len(rows)}", rows)
+
+    if raw_rows is not None:
+        shapes = (row.get("shape") for row in raw_rows)
+    else:
+        shapes = (cell.get("shape_source", cell.get("shape")) for cell in cells_data)
+    rows = [
+        i for i, shape in enumerate(shapes)
+        if shape not in CELL_SHAPES and str(shape or "").strip().lower() not in CELL_SHAPES
+    ]
+    add(VALIDATION_WARNING, "shape", f"Неизвестная форма (показана шестиугольником), ячеек {len(rows)}", rows)
+
+    findings.sort(key=lambda f: f.severity != VALIDATION_ERROR)
+    return findings
+
+
+def validation_summary(findings):
+    """Одна строка итога проверки для строки состояния."""
+    if not findings:
+        return "Проверка данных: замечаний нет"
+    errors = sum(1 for f in findings if f.severity == VALIDATION_ERROR)
+    return f"Проверка данных: ошибок {errors}, предупреждений {len(findings) - errors}"
+
+
+# ---------- Набор картограмм (циклы) ----------
+
+# Сколько ячеек (суммарно по всем картограммам) держать разобранными в памяти
+WORKSPACE_CACHE_CELLS = 500_000
+
+
+class WorkspaceEntry:
+    """Картограмма набора: строки CSV, ячейки с индексами типов, версия данных."""
+
+    def __init__(self, path, rows=None, mtime=None):
+        self.path = path
+        self.rows = rows            # строки CSV (как из read_cartogram_csv)
+        self.mtime = mtime
+        self.cells_data = None      # ячейки с внутренними индексами типов
+        self.type_names = None      # названия типов на момент сопоставления индексов
+        self.version = None         # версия данных, под которой картограмма показывалась
+        self.columns = None         # CellColumns этой версии
+        self.dirty = False          # есть несохранённые правки
+
+    @property
+    def n_cells(self):
+        if self.cells_data is not None:
+            return len(self.cells_data)
+        return len(self.rows) if self.rows is not None else 0
+
+
+def read_workspace_entry(path):
+    """Прочитать картограмму для набора (можно вызывать из фонового потока)."""
+    mtime = os.path.getmtime(path)
+    return WorkspaceEntry(path, rows=read_cartogram_csv(path), mtime=mtime)
+
+
+class WorkspaceCache:
+    """
+    LRU разобранных картограмм набора, ограниченный суммарным числом ячеек.
+    Картограммы с несохранёнными правками не вытесняются. Потокобезопасен:
+    фоновая предзагрузка кладёт сюда записи из другого потока.
+    """
+
+    def __init__(self, max_cells=WORKSPACE_CACHE_CELLS):
+        self.max_cells = max_cells
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None:
+                self._entries.move_to_end(path)
+            return entry
+
+    def put(self, entry):
+        with self._lock:
+            self._entries[entry.path] = entry
+            self._entries.move_to_end(entry.path)
+            self._evict(keep=entry.path)
+
+    def discard(self, path):
+        with self._lock:
+            self._entries.pop(path, None)
+
+    def _evict(self, keep):
+        total = sum(e.n_cells for e in self._entries.values())
+        for path in list(self._entries):
+            if total <= self.max_cells:
+                break
+            entry = self._entries[path]
+            if path == keep or entry.dirty:
+                continue
+            total -= entry.n_cells
+            del self._entries[path]
+
+
+# ---------- Архив картограмм по циклам (SQLite) ----------
+
+FLEET_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cycles (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    path TEXT NOT NULL UNIQUE,
+    seq INTEGER NOT NULL,
+    mtime REAL
+);
+CREATE TABLE IF NOT EXISTS cells (
+    cycle_id INTEGER NOT NULL REFERENCES cycles(id),
+    q INTEGER NOT NULL,
+    r INTEGER NOT NULL,
+    pos_label TEXT NOT NULL,
+    factory_id TEXT NOT NULL,
+    fuel_type TEXT NOT NULL,
+    mass_fuel REAL,
+    mass_boron REAL,
+    mass_gd REAL
+);
+CREATE INDEX IF NOT EXISTS cells_factory_id ON cells(factory_id);
+CREATE INDEX IF NOT EXISTS cells_position ON cells(q, r);
+CREATE INDEX IF NOT EXISTS cells_pos_label ON cells(pos_label);
+CREATE INDEX IF NOT EXISTS cells_cycle ON cells(cycle_id);
+CREATE INDEX IF NOT EXISTS cells_fuel_type ON cells(fuel_type);
+CREATE INDEX IF NOT EXISTS cycles_seq ON cycles(seq);
+"""
+
+# Тип массива NumPy для столбцов результатов запросов (прочие — object)
+FLEET_INT_FIELDS = {"seq", "q", "r", "count"}
+FLEET_HISTORY_FIELDS = (
+    "cycle", "seq", "q", "r", "pos_label", "factory_id", "fuel_type",
+    "mass_fuel", "mass_boron", "mass_gd",
+)
+FLEET_INGEST_BATCH = 5000   # строк на один executemany
+
+
+class FleetStore:
+    """
+    Архив картограмм по циклам в файле SQLite: строка cells — ячейка одного
+    цикла, порядок циклов — cycles.seq. Индексы по заводскому номеру, позиции,
+    циклу и типу ТВС; запросы возвращают столбцы массивами NumPy (dict поле -> массив).
+
+    У каждого потока своё соединение: загрузка CSV идёт в фоне, запросы — в потоке Tk.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        con = self._connection()
+        with con:
+            con.executescript(FLEET_SCHEMA)
+
+    def _connection(self):
+        con = getattr(self._local, "con", None)
+        if con is None:
+            con = sqlite3.connect(self.path)
+            con.execute("PRAGMA journal_mode=WAL")   # запросы не ждут загрузки
+            self._local.con = con
+        return con
+
+    def close(self):
+        """Закрыть соединение текущего потока."""
+        con = getattr(self._local, "con", None)
+        if con is not None:
+            con.close()
+            self._local.con = None
+
+    # ---------- Загрузка ----------
+
+    def ingest(self, paths, job=None, fuel_types=None):
+        """
+        Загрузить картограммы CSV (по циклу на файл, в порядке paths) одной
+        транзакцией; повторно загруженный файл заменяет свой цикл, сохраняя место
+        в порядке. При ошибке или отмене архив не меняется. Возвращает число ячеек.
+
+        Тип ТВС хранится именем из fuel_types (по умолчанию DEFAULT_FUEL_TYPES),
+        как в fuel_type_index: старый числовой '9' -> 'Тип 9'. Список не меняется.
+        """
+        fuel_types = [dict(ft) for ft in (fuel_types or DEFAULT_FUEL_TYPES)]
+        type_names = {}
+
+        def type_name(label):
+            label = (label or "").strip()
+            name = type_names.get(label)
+            if name is None:
+                name = type_names[label] = fuel_types[fuel_type_index(fuel_types, label)]["name"]
+            return name
+
+        con = self._connection()
+        total = max(len(paths), 1)
+        n_cells = 0
+        with con:
+            next_seq = con.execute("SELECT COALESCE(MAX(seq), -1) + 1 FROM cycles").fetchone()[0]
+            for i, path in enumerate(paths):
+                if job is not None:
+                    job.progress(i / total, os.path.basename(path))
+                rows = read_cartogram_csv(path)
+                path = os.path.abspath(path)
+                name = os.path.splitext(os.path.basename(path))[0]
+                mtime = os.path.getmtime(path)
+
+                found = con.execute("SELECT id FROM cycles WHERE path = ?", (path,)).fetchone()
+                if found:
+                    cycle_id = found[0]
+                    con.execute("DELETE FROM cells WHERE cycle_id = ?", (cycle_id,))
+                    con.execute(
+                        "UPDATE cycles SET name = ?, mtime = ? WHERE id = ?",
+                        (name, mtime, cycle_id)
+                    )
+                else:
+                    cycle_id = con.execute(
+                        "INSERT INTO cycles (name, path, seq, mtime) VALUES (?, ?, ?, ?)",
+                        (name, path, next_seq, mtime)
+                    ).lastrowid
+                    next_seq += 1
+
+                records = (
+                    (
+                        cycle_id,
+                        int(row["q"]),
+                        int(row["r"]),
+                        (row.get("pos_label") or row["index"]).strip(),
+                        (row.get("factory_id") or "").strip(),
+                        type_name(row.get("fuel_type")),
+                        mass_or_nan(row.get("mass_fuel", "")),     # NaN хранится как NULL
+                        mass_or_nan(row.get("mass_boron", "")),
+                        mass_or_nan(row.get("mass_gd", "")),
+                    )
+                    for row in rows
+                )
+                while True:
+                    batch = list(itertools.islice(records, FLEET_INGEST_BATCH))
+                    if not batch:
+                        break
+                    con.executemany(
+                        "INSERT INTO cells VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", batch
+                    )
+                    n_cells += len(batch)
+                    if job is not None:
+                        job.check()
+        return n_cells
+
+    # ---------- Запросы ----------
+
+    def _columns(self, sql, params, fields):
+        import numpy as np
+
+        rows = self._connection().execute(sql, params).fetchall()
+        columns = list(zip(*rows)) if rows else [()] * len(fields)
+        result = {}
+        for field, values in zip(fields, columns):
+            if field in FLEET_INT_FIELDS:
+                result[field] = np.array(values, dtype=np.int64)
+            elif field in MASS_FIELDS:
+                result[field] = np.array(values, dtype=np.float64)   # NULL -> NaN
+            else:
+                result[field] = np.array(values, dtype=object)
+        return result
+
+    @staticmethod
+    def _last_cycles(last):
+        """Условие «последние last циклов» (last=None или 0 — все циклы)."""
+        if not last:
+            return "", ()
+        return (
+            " AND c.cycle_id IN (SELECT id FROM cycles ORDER BY seq DESC LIMIT ?)",
+            (int(last),)
+        )
+
+    def cycles(self):
+        """Циклы архива по порядку: name, seq, count (ячеек)."""
+        return self._columns(
+            "SELECT y.name, y.seq, COUNT(c.cycle_id) FROM cycles y "
+            "LEFT JOIN cells c ON c.cycle_id = y.id GROUP BY y.id ORDER BY y.seq",
+            (), ("cycle", "seq", "count")
+        )
+
+    def _history(self, condition, params, last):
+        last_sql, last_params = self._last_cycles(last)
+        return self._columns(
+            "SELECT y.name, y.seq, c.q, c.r, c.pos_label, c.factory_id, c.fuel_type, "
+            "c.mass_fuel, c.mass_boron, c.mass_gd "
+            "FROM cells c JOIN cycles y ON y.id = c.cycle_id "
+            f"WHERE {condition}{last_sql} ORDER BY y.seq, c.q, c.r",
+            tuple(params) + last_params, FLEET_HISTORY_FIELDS
+        )
+
+    def assembly_history(self, factory_id, last=None):
+        """Где стояла ТВС factory_id: по строке на цикл (из последних last циклов)."""
+        return self._history("c.factory_id = ?", (factory_id.strip(),), last)
+
+    def position_history(self, pos_label, fuel_type=None, last=None):
+        """Что стояло на позиции pos_label по циклам (только тип fuel_type, если задан)."""
+        condition, params = "c.pos_label = ?", [pos_label.strip()]
+        if fuel_type:
+            condition += " AND c.fuel_type = ?"
+            params.append(fuel_type)
+        return self._history(condition, params, last)
+
+    def position_counts(self, fuel_type=None, last=None):
+        """
+        Для каждой позиции (q, r) — число циклов, в которых на ней стояла ТВС
+        (с заводским номером, или типа fuel_type, если задан).
+        """
+        condition, params = ("c.fuel_type = ?", [fuel_type]) if fuel_type else ("c.factory_id != ''", [])
+        last_sql, last_params = self._last_cycles(last)
+        return self._columns(
+            "SELECT c.q, c.r, COUNT(DISTINCT c.cycle_id) FROM cells c "
+            f"WHERE {condition}{last_sql} GROUP BY c.q, c.r",
+            tuple(params) + last_params, ("q", "r", "count")
+        )
+
+    def residence_counts(self, last=None):
+        """Число циклов в активной зоне для каждой ТВС архива: factory_id, count."""
+        last_sql, last_params = self._last_cycles(last)
+        return self._columns(
+            "SELECT c.factory_id, COUNT(DISTINCT c.cycle_id) FROM cells c "
+            f"WHERE c.factory_id != ''{last_sql} GROUP BY c.factory_id",
+            last_params, ("factory_id", "count")
+        )
+
+
+# Запросы панели архива: название -> вид запроса
+FLEET_QUERIES = {
+    "История ТВС (заводской №)": "assembly",
+    "История позиции": "position",
+    "Циклов на позиции": "position_counts",
+    "Циклов в зоне у ТВС картограммы": "residence",
+}
+FLEET_TABLE_LIMIT = 2000    # строк результата в таблице окна
+
+
+# ---------- Пространственный индекс центров ячеек ----------
+
+# Инструменты левой кнопки мыши на картограмме
+TOOL_EDIT = "edit"      # диалог редактирования ячейки
+TOOL_BRUSH = "brush"    # рисование текущим типом ТВС
+TOOL_RECT = "rect"      # выделение рамкой
+TOOL_LASSO = "lasso"    # выделение произвольным контуром
+
+
+class CellSpatialIndex:
+    """
+    Равномерная сетка по центрам ячеек на Canvas (без сдвига панорамирования).
+
+    Строки отсортированы по номеру корзины gx * ny + gy, поэтому корзины одного
+    столбца сетки лежат подряд и находятся двумя бинарными поисками; запрос
+    к области стоит O(число столбцов сетки + найденные строки).
+    """
+
+    def __init__(self, xs, ys, bucket):
+        import numpy as np
+
+        self.xs = np.asarray(xs, dtype=np.float64)
+        self.ys = np.asarray(ys, dtype=np.float64)
+        self.bucket = float(bucket) if bucket > 0 else 1.0
+        if not self.xs.size:
+            self.x0 = self.y0 = 0.0
+            self.nx = self.ny = 0
+            self.keys = np.zeros(0, dtype=np.int64)
+            self.rows = np.zeros(0, dtype=np.int64)
+            return
+        self.x0 = float(self.xs.min())
+        self.y0 = float(self.ys.min())
+        gx = ((self.xs - self.x0) // self.bucket).astype(np.int64)
+        gy = ((self.ys - self.y0) // self.bucket).astype(np.int64)
+        self.nx = int(gx.max()) + 1
+        self.ny = int(gy.max()) + 1
+        keys = gx * self.ny + gy
+        self.rows = np.argsort(keys, kind="stable")
+        self.keys = keys[self.rows]
+
+    def candidates(self, x0, y0, x1, y1):
+        """Строки из корзин, пересекающих прямоугольник (возможны лишние)."""
+        import numpy as np
+
+        if not self.nx:
+            return np.zeros(0, dtype=np.int64)
+        gx0 = max(int((min(x0, x1) - self.x0) // self.bucket), 0)
+        gx1 = min(int((max(x0, x1) - self.x0) // self.bucket), self.nx - 1)
+        gy0 = max(int((min(y0, y1) - self.y0) // self.bucket), 0)
+        gy1 = min(int((max(y0, y1) - self.y0) // self.bucket), self.ny - 1)
+        if gx0 > gx1 or gy0 > gy1:
+            return np.zeros(0, dtype=np.int64)
+        parts = []
+        for gx in range(gx0, gx1 + 1):
+            lo = np.searchsorted(self.keys, gx * self.ny + gy0, side="left")
+            hi = np.searchsorted(self.keys, gx * self.ny + gy1, side="right")
+            if hi > lo:
+                parts.append(self.rows[lo:hi])
+        return np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+
+    def in_rect(self, x0, y0, x1, y1):
+        """Строки, центры которых лежат в прямоугольнике."""
+        rows = self.candidates(x0, y0, x1, y1)
+        xs = self.xs[rows]
+        ys = self.ys[rows]
+        inside = (
+            (xs >= min(x0, x1)) & (xs <= max(x0, x1))
+            & (ys >= min(y0, y1)) & (ys <= max(y0, y1))
+        )
+        return rows[inside]
+
+    def in_polygon(self, points):
+        """Строки, центры которых внутри многоугольника [(x, y), ...] (чётность пересечений)."""
+        import numpy as np
+
+        if len(points) < 3:
+            return np.zeros(0, dtype=np.int64)
+        px = np.array([p[0] for p in points], dtype=np.float64)
+        py = np.array([p[1] for p in points], dtype=np.float64)
+        rows = self.candidates(px.min(), py.min(), px.max(), py.max())
+        xs = self.xs[rows]
+        ys = self.ys[rows]
+        inside = np.zeros(rows.size, dtype=bool)
+        for xa, ya, xb, yb in zip(px, py, np.roll(px, -1), np.roll(py, -1)):
+            if ya == yb:
+                continue
+            crosses = (ya > ys) != (yb > ys)
+            x_cross = xa + (ys - ya) * (xb - xa) / (yb - ya)
+            inside ^= crosses & (xs < x_cross)
+        return rows[inside]
+
+    def nearest(self, x, y, radius):
+        """Ближайшая строка с центром не дальше radius или -1."""
+        import numpy as np
+
+        rows = self.candidates(x - radius, y - radius, x + radius, y + radius)
+        if not rows.size:
+            return -1
+        d2 = (self.xs[rows] - x) ** 2 + (self.ys[rows] - y) ** 2
+        best = int(np.argmin(d2))
+        return int(rows[best]) if d2[best] <= radius * radius else -1
+
+
+# ---------- История правок (отмена / повтор) ----------
+
+# Предел истории: суммарное число изменённых полей во всех шагах отмены
+UNDO_MAX_DELTAS = 200_000
+
+
+class EditHistory:
+    """
+    Стек отмены/повтора из компактных изменений (строка, поле, было, стало).
+    Один шаг (транзакция) — все изменения одной операции; память ограничена
+    суммарным числом изменений: самые старые шаги отбрасываются.
+    """
+
+    def __init__(self, max_deltas=UNDO_MAX_DELTAS):
+        self.max_deltas = max_deltas
+        self._undo = deque()
+        self._redo = []
+        self._size = 0
+
+    def clear(self):
+        self._undo.clear()
+        self._redo.clear()
+        self._size = 0
+
+    def can_undo(self):
+        return bool(self._undo)
+
+    def can_redo(self):
+        return bool(self._redo)
+
+    def push(self, deltas):
+        """Записать новую транзакцию; ветка повтора при этом теряется."""
+        if not deltas:
+            return
+        self._undo.append(tuple(deltas))
+        self._size += len(deltas)
+        self._redo.clear()
+        while self._size > self.max_deltas and len(self._undo) > 1:
+            self._size -= len(self._undo.popleft())
+
+    def pop_undo(self):
+        """Транзакция для отмены (переходит в стек повтора) или None."""
+        if not self._undo:
+            return None
+        deltas = self._undo.pop()
+        self._size -= len(deltas)
+        self._redo.append(deltas)
+        return deltas
+
+    def pop_redo(self):
+        """Транзакция для повтора (возвращается в стек отмены) или None."""
+        if not self._redo:
+            return None
+        deltas = self._redo.pop()
+        self._undo.append(deltas)
+        self._size += len(deltas)
+        return deltas
+
+
+# ---------- Журнал правок и атомарная запись ----------
+
+JOURNAL_SUFFIX = ".journal"     # журнал правок рядом с CSV
+SNAPSHOT_SUFFIX = ".snapshot"   # полный снимок (CSV) после уплотнения журнала
+JOURNAL_FLUSH_SEC = 0.5         # окно накопления записей перед одним fsync
+JOURNAL_COMPACT_DELTAS = 2000   # изменений после снимка, после которых пишется новый снимок
+
+
+def _output_mode(path, default=0o666):
+    """
+    Права для результата на месте path: как у заменяемого, иначе default по
+    umask (mkstemp / mkdtemp создают 0600 / 0700).
+    """
+    try:
+        return os.stat(path).st_mode & 0o7777
+    except OSError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return default & ~umask
+
+
+@contextlib.contextmanager
+def atomic_output(filename):
+    """
+    Путь уникального временного файла рядом с filename (tempfile.mkstemp):
+    после записи без исключения он заменяет filename (os.replace), иначе
+    удаляется. Одновременные задачи с одной целью не пишут в общий файл.
+    """
+    directory, name = os.path.split(os.path.abspath(filename))
+    fd, tmp = tempfile.mkstemp(prefix=name + ".", suffix=".tmp", dir=directory)
+    os.close(fd)
+    try:
+        yield tmp
+        os.chmod(tmp, _output_mode(filename))
+        os.replace(tmp, filename)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def write_cells_csv(filename, entries, type_names, job=None):
+    """
+    Записать ячейки в CSV картограммы (тип ТВС — по названию) атомарно:
+    во временный файл рядом, fsync и os.replace. Дополнительные поля ячеек
+    ("extra") — отдельными столбцами после стандартных. job (BackgroundJob) —
+    прогресс и отмена; при отмене исходный файл не меняется.
+    """
+    entries = list(entries)
+    extra_columns = []
+    for cell in entries:
+        for key in cell.get("extra") or ():
+            if key not in extra_columns and key not in CSV_COLUMNS:
+                extra_columns.append(key)
+
+    total = max(len(entries), 1)
+    with atomic_output(filename) as tmp:
+        with open(tmp, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f, delimiter=";")
+            writer.writerow(CSV_COLUMNS + extra_columns)
+            for i, cell in enumerate(entries):
+                if job is not None and i % EXPORT_PROGRESS_STEP == 0:
+                    job.progress(i / total)
+                ft_idx = cell.get("fuel_type", 0)
+                ft_name = type_names[ft_idx] if 0 <= ft_idx < len(type_names) else ""
+                writer.writerow([
+                    cell["index"],
+                    cell["q"],
+                    cell["r"],
+                    cell["shape"],
+                    ft_name,                      # пишем НАЗВАНИЕ типа ТВС
+                    cell.get("pos_label", ""),
+                    cell.get("factory_id", ""),
+                    cell.get("mass_fuel", ""),
+                    cell.get("mass_boron", ""),
+                    cell.get("mass_gd", ""),
+                ] + [(cell.get("extra") or {}).get(key, "") for key in extra_columns])
+            f.flush()
+            os.fsync(f.fileno())
+        if job is not None:
+            job.check()
+
+
+def read_journal(source_path):
+    """
+    Прочитать журнал правок картограммы: (заголовок, [(index ячейки, поле, значение)])
+    или None, если журнала нет. Недописанная последняя запись (сбой во время
+    записи) отбрасывается.
+    """
+    path = source_path + JOURNAL_SUFFIX
+    try:
+        f = open(path, "r", encoding="utf-8")
+    except OSError:
+        return None
+    edits = []
+    with f:
+        try:
+            header = json.loads(f.readline())
+        except ValueError:
+            return None
+        for line in f:
+            try:
+                batch = json.loads(line)
+            except ValueError:
+                break
+            edits.extend(tuple(d) for d in batch)
+    return header, edits
+
+
+def discard_journal(source_path):
+    """Удалить журнал и снимок картограммы (правки сохранены или отвергнуты)."""
+    for suffix in (JOURNAL_SUFFIX, SNAPSHOT_SUFFIX):
+        try:
+            os.remove(source_path + suffix)
+        except OSError:
+            pass
+
+
+def replay_journal(source_path, header, edits, source_rows=None):
+    """
+    Восстановить строки CSV (словари со строковыми значениями, тип — по названию):
+    снимок или исходный файл плюс правки журнала. Правки адресованы по столбцу
+    index, поэтому порядок строк в базе не важен. ValueError, если база
+    не совпадает с журналом.
+    """
+    if header.get("base") == "snapshot":
+        rows = read_cartogram_csv(source_path + SNAPSHOT_SUFFIX)
+    else:
+        rows = source_rows if source_rows is not None else read_cartogram_csv(source_path)
+    if len(rows) != header.get("rows"):
+        raise ValueError("Число ячеек в журнале не совпадает с картограммой")
+    rows = [dict(row) for row in rows]
+    by_index = {int(row["index"]): row for row in rows}
+    if len(by_index) != len(rows):
+        raise ValueError("Номера ячеек (index) в картограмме повторяются")
+    for index, field, value in edits:
+        row = by_index.get(index)
+        if row is None:
+            raise ValueError(f"В картограмме нет ячейки с index = {index}")
+        if field == "extra":
+            # value — все дополнительные поля ячейки; стандартные столбцы не трогаются
+            extra = {k: v for k, v in (value or {}).items() if k not in CSV_COLUMNS}
+            for key in row:
+                if key not in CSV_COLUMNS and key not in extra:
+                    row[key] = ""
+            row.update(extra)
+        else:
+            row[field] = "" if value is None else str(value)
+    return rows
+
+
+class EditJournal:
+    """
+    Журнал правок одной картограммы: строки JSON дописываются фоновым потоком.
+
+    Поток собирает записи, пришедшие за JOURNAL_FLUSH_SEC, и делает один fsync
+    на пачку. Уплотнение: полный снимок пишется атомарно, затем журнал
+    заменяется новым с заголовком "base": "snapshot". Поток Tk только кладёт
+    задания в очередь и не ждёт записи, в том числе при закрытии.
+
+    Журналы одного файла пишутся по очереди: поток нового журнала начинает
+    работу, когда закроется прежний (_writers — последний журнал каждого файла).
+    """
+
+    _writers = {}
+    _writers_lock = threading.Lock()
+
+    def __init__(self, source_path):
+        self.source_path = source_path
+        self.path = source_path + JOURNAL_SUFFIX
+        self.deltas_since_snapshot = 0
+        self.error = None
+        self.closing = False
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="journal", daemon=True)
+        with EditJournal._writers_lock:
+            self._previous = EditJournal._writers.get(self.path)
+            EditJournal._writers[self.path] = self
+        self._thread.start()
+
+    @classmethod
+    def wait_closed(cls, source_path=None, timeout=None):
+        """
+        Дождаться записи закрытых журналов source_path (всех файлов, если None):
+        перед чтением журнала с диска и при выходе из программы.
+        """
+        with cls._writers_lock:
+            writers = [
+                w for path, w in cls._writers.items()
+                if w.closing and (source_path is None or path == source_path + JOURNAL_SUFFIX)
+            ]
+        for writer in writers:
+            writer._thread.join(timeout)
+
+    # --- вызовы из потока Tk ---
+
+    def start(self, n_rows):
+        """Начать журнал заново от исходного файла (он и есть база)."""
+        self.deltas_since_snapshot = 0
+        self._queue.put(("reset", {"base": "source", "rows": n_rows}, None))
+
+    def append(self, deltas):
+        """deltas: [(index ячейки, поле, значение)] — одна транзакция, одна строка журнала."""
+        self.deltas_since_snapshot += len(deltas)
+        self._queue.put(("edit", json.dumps(deltas, ensure_ascii=False) + "\n", None))
+
+    def snapshot(self, entries, type_names):
+        """Уплотнить: записать снимок (копию данных) и начать журнал от него."""
+        self.deltas_since_snapshot = 0
+        header = {"base": "snapshot", "rows": len(entries)}
+        self._queue.put(("reset", header, (entries, type_names)))
+
+    def close(self, discard=False):
+        """
+        Дописать очередь и закрыть (в фоне, без ожидания); discard — удалить
+        журнал и снимок. Дождаться записи — EditJournal.wait_closed.
+        """
+        self.closing = True
+        self._queue.put(("close", discard, None))
+
+    # --- фоновый поток ---
+
+    def _run(self):
+        try:
+            if self._previous is not None:
+                self._previous._thread.join()
+                self._previous = None
+            self._write_loop()
+        finally:
+            with EditJournal._writers_lock:
+                if EditJournal._writers.get(self.path) is self:
+                    del EditJournal._writers[self.path]
+
+    def _write_loop(self):
+        f = None
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + JOURNAL_FLUSH_SEC
+            while batch[-1][0] == "edit":
+                try:
+                    batch.append(self._queue.get(timeout=max(deadline - time.monotonic(), 0.0)))
+                except queue.Empty:
+                    break
+            dirty = False
+            try:
+                for kind, payload, data in batch:
+                    if kind == "edit":
+                        if f is not None:
+                            f.write(payload)
+                            dirty = True
+                        continue
+                    if f is not None:
+                        if dirty:
+                            f.flush()
+                            os.fsync(f.fileno())
+                            dirty = False
+                        f.close()
+                        f = None
+                    if kind == "close":
+                        if payload:
+                            discard_journal(self.source_path)
+                        return
+                    # "reset": новый снимок (если есть) и новый журнал — атомарно
+                    if data is not None:
+                        write_cells_csv(self.source_path + SNAPSHOT_SUFFIX, *data)
+                    with atomic_output(self.path) as tmp:
+                        with open(tmp, "w", encoding="utf-8") as jf:
+                            jf.write(json.dumps(payload) + "\n")
+                            jf.flush()
+                            os.fsync(jf.fileno())
+                    if data is None and os.path.exists(self.source_path + SNAPSHOT_SUFFIX):
+                        # снимок удаляется только после замены журнала, который на него ссылался
+                        os.remove(self.source_path + SNAPSHOT_SUFFIX)
+                    f = open(self.path, "a", encoding="utf-8")
+                if dirty:
+                    f.flush()
+                    os.fsync(f.fileno())
+            except OSError as e:
+                self.error = e
+                if f is not None:
+                    f.close()
+                    f = None
+                if any(kind == "close" for kind, _, _ in batch):
+                    return
+
+
+# ---------- Слежение за файлом картограммы ----------
+
+WATCH_POLL_MS = 700     # период опроса файла; перечитывание — когда он не меняется между опросами
+
+# Поля ячейки, которые перечитывание файла обновляет на месте
+RELOAD_FIELDS = ("fuel_type", "pos_label", "factory_id") + MASS_FIELDS + ("extra",)
+
+
+def file_signature(path):
+    """(mtime в нс, размер) файла или None, если файл недоступен."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def cell_changes_by_index(cells, cells_data):
+    """
+    Сопоставить новые данные ячеек с текущими (в порядке строк) по столбцу index:
+    [(строка, поле, новое значение)] для отличающихся полей. None — изменился
+    состав ячеек или их положение / форма, и правкой на месте не обойтись.
+    """
+    row_of_index = {cell["index"]: row for row, cell in enumerate(cells)}
+    if len(row_of_index) != len(cells) or len(cells_data) != len(cells):
+        return None
+    changes = []
+    seen = set()
+    for new in cells_data:
+        row = row_of_index.get(new["index"])
+        if row is None or row in seen:
+            return None
+        seen.add(row)
+        cell = cells[row]
+        if cell["q"] != new["q"] or cell["r"] != new["r"] or cell["shape"] != new["shape"]:
+            return None
+        if cell.get("shape_source") != new.get("shape_source"):
+            return None
+        for field in RELOAD_FIELDS:
+            if field == "extra":
+                value = dict(new.get("extra") or {})
+                if (cell.get("extra") or {}) != value:
+                    changes.append((row, field, value))
+                continue
+            value = new.get(field, "")
+            if cell.get(field, "") != value:
+                changes.append((row, field, value))
+    return changes
+
+
+# ---------- Фоновые задачи: экспорт и сохранение ----------
+
+EXPORT_WORKERS = 2          # одновременно выполняемых экспортов
+EXPORT_EPS_SCALE = 4        # масштаб растеризации EPS (повышенное разрешение)
+EXPORT_PROGRESS_STEP = 2000 # элементов между обновлениями прогресса / проверками отмены
+JOB_POLL_MS = 100
+
+
+class JobCancelled(Exception):
+    """Фоновая задача отменена пользователем."""
+
+
+class BackgroundJob:
+    """
+    Состояние фоновой задачи для панели прогресса. Рабочий поток сообщает
+    долю выполнения через progress() (там же проверяется отмена), поток Tk
+    читает fraction / stage и вызывает cancel().
+    """
+
+    def __init__(self, title):
+        self.title = title
+        self.fraction = 0.0
+        self.stage = ""
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def check(self):
+        if self._cancelled.is_set():
+            raise JobCancelled(self.title)
+
+    def progress(self, fraction, stage=None):
+        self.fraction = min(max(float(fraction), 0.0), 1.0)
+        if stage is not None:
+            self.stage = stage
+        self.check()
+
+
+class CartogramScene:
+    """
+    Неизменяемый снимок картограммы для отрисовки вне потока Tk (SVG, Pillow):
+    shapes — (вид "oval" | "polygon", координаты, заливка, контур),
+    texts — (x, y, размер шрифта в пунктах, текст, цвет, жирный).
+    """
+
+    __slots__ = ("width", "height", "shapes", "texts")
+
+    def __init__(self, width, height, shapes, texts):
+        self.width = width
+        self.height = height
+        self.shapes = tuple(shapes)
+        self.texts = tuple(texts)
+
+
+def svg_lines(scene, job=None):
+    """Строки SVG-документа для сцены (job — прогресс и отмена)."""
+    total = max(len(scene.shapes) + len(scene.texts), 1)
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+    yield (
+        f'<svg xmlns="http://www.w3.org/2000/svg" '
+        f'width="{scene.width}" height="{scene.height}" '
+        f'viewBox="0 0 {scene.width} {scene.height}">\n'
+    )
+
+    # Фигуры: цвет fill, снятый с холста (учитывает градиент)
+    for i, (kind, coords, fill_color, stroke_color) in enumerate(scene.shapes):
+        if job is not None and i % EXPORT_PROGRESS_STEP == 0:
+            job.progress(i / total, "фигуры")
+        fill_color = fill_color or "none"
+        stroke_color = stroke_color or "none"
+        if kind == "oval" and len(coords) == 4:
+            x1, y1, x2, y2 = coords
+            cx = (x1 + x2) / 2.0
+            cy = (y1 + y2) / 2.0
+            r = (min(x2 - x1, y2 - y1)) / 2.0
+            yield (
+                f'  <circle cx="{cx:.2f}" cy="{cy:.2f}" r="{r:.2f}" '
+                f'stroke="{stroke_color}" fill="{fill_color}"/>\n'
+            )
+        elif kind == "polygon" and len(coords) >= 6:
+            points = " ".join(
+                f"{coords[k]:.2f},{coords[k+1]:.2f}"
+                for k in range(0, len(coords), 2)
+            )
+            yield (
+                f'  <polygon points="{points}" '
+                f'stroke="{stroke_color}" fill="{fill_color}"/>\n'
+            )
+
+    # Тексты
+    done = len(scene.shapes)
+    for i, (x, y, size, text, color, bold) in enumerate(scene.texts):
+        if job is not None and i % EXPORT_PROGRESS_STEP == 0:
+            job.progress((done + i) / total, "подписи")
+        weight = ' font-weight="bold"' if bold else ""
+        yield (
+            f'  <text x="{x:.2f}" y="{y:.2f}" '
+            f'font-family="Arial" font-size="{size}"{weight} fill="{color or "black"}" '
+            f'text-anchor="middle" dominant-baseline="middle">'
+            f'{saxutils.escape(str(text))}</text>\n'
+        )
+
+    yield '</svg>\n'
+
+
+def write_svg(filename, scene, job=None):
+    """Записать сцену в SVG (через временный файл; при отмене файл не создаётся)."""
+    with atomic_output(filename) as tmp:
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.writelines(svg_lines(scene, job))
+        if job is not None:
+            job.check()
+
+
+def rasterize_eps(eps_file, filename, fmt, job=None, scale=EXPORT_EPS_SCALE):
+    """
+    Растеризовать EPS холста (Pillow + Ghostscript) и сохранить в PNG / TIFF / JPEG.
+    EPS удаляется по завершении; при отмене итоговый файл не создаётся.
+    """
+    from PIL import Image  # pip install pillow
+
+    try:
+        with atomic_output(filename) as tmp:
+            if job is not None:
+                job.progress(0.05, "растеризация")
+            img = Image.open(eps_file)
+            img.load(scale=scale)
+            if job is not None:
+                job.progress(0.7, "кодирование")
+
+            if fmt == "JPEG":
+                img = img.convert("RGB")
+                img.save(tmp, "JPEG", quality=95)
+            elif fmt == "TIFF":
+                img.save(tmp, "TIFF")
+            else:
+                img.save(tmp, "PNG")
+            if job is not None:
+                job.check()
+    finally:
+        if os.path.exists(eps_file):
+            os.remove(eps_file)
+
+
+# ---------- Отрисовка без Tk ----------
+
+LAYOUT_PIXEL_MARGIN = 20    # поля холста, пикс.
+LAYOUT_HEX_MARGIN = 1.2     # поля решётки, в размерах гекса
+RENDER_SUPERSAMPLE = 2      # сглаживание: рисуем крупнее и уменьшаем
+RENDER_SUPERSAMPLE_MAX_PIXELS = 16_000_000  # холст больше — без сглаживания (RGB, ~48 МБ)
+POINTS_TO_PIXELS = 96.0 / 72.0
+
+_HEX_CORNERS = tuple(
+    (math.cos(math.radians(60 * i - 30)), math.sin(math.radians(60 * i - 30)))
+    for i in range(6)
+)
+
+
+def cell_layout(q, r, rotation_deg, width, height, zoom=1.0):
+    """
+    Центры ячеек (q, r) на холсте width×height — как при построении картограммы:
+    поворот, вписывание решётки с полями, масштаб zoom (без сдвига вида).
+    Возвращает (xs, ys, размер гекса, размер гекса при zoom=1).
+    """
+    import numpy as np
+
+    q = np.asarray(q, dtype=np.float64)
+    r = np.asarray(r, dtype=np.float64)
+    angle_rad = math.radians(rotation_deg % 360)
+    cos_a = math.cos(angle_rad)
+    sin_a = math.sin(angle_rad)
+
+    x_raw = math.sqrt(3) * q + math.sqrt(3) / 2 * r
+    y_raw = 1.5 * r
+    x_rot = x_raw * cos_a - y_raw * sin_a
+    y_rot = x_raw * sin_a + y_raw * cos_a
+
+    min_x, max_x = float(x_rot.min()), float(x_rot.max())
+    min_y, max_y = float(y_rot.min()), float(y_rot.max())
+    width_raw = max_x - min_x + 2 * LAYOUT_HEX_MARGIN
+    height_raw = max_y - min_y + 2 * LAYOUT_HEX_MARGIN
+
+    base_hex_size = min(
+        (width - 2 * LAYOUT_PIXEL_MARGIN) / width_raw,
+        (height - 2 * LAYOUT_PIXEL_MARGIN) / height_raw,
+    )
+    hex_size = base_hex_size * zoom
+    xs = (x_rot - (min_x + max_x) / 2.0) * hex_size + width / 2.0
+    ys = (y_rot - (min_y + max_y) / 2.0) * hex_size + height / 2.0
+    return xs, ys, hex_size, base_hex_size
+
+
+def label_font_sizes(hex_size):
+    """Размеры шрифтов (пункты) подписи позиции и нижней подписи при данном размере гекса."""
+    return max(6, int(hex_size * 0.35)), max(5, int(hex_size * 0.28))
+
+
+class SceneGeometry:
+    """
+    Геометрия сцены без цветов для одного поворота и размера холста:
+    rows — строки ячеек, shapes — (вид, координаты), pos_texts / label_texts —
+    (x, y, размер шрифта) подписей позиции и нижней подписи. Одна геометрия
+    окрашивается любым числом раскрасок (CartogramModel.styled_scene).
+    """
+
+    __slots__ = ("width", "height", "rows", "shapes", "pos_texts", "label_texts")
+
+    def __init__(self, width, height, rows, shapes, pos_texts, label_texts):
+        self.width = width
+        self.height = height
+        self.rows = tuple(rows)
+        self.shapes = tuple(shapes)
+        self.pos_texts = tuple(pos_texts)
+        self.label_texts = tuple(label_texts)
+
+
+class CartogramModel:
+    """
+    Картограмма без Tk для фоновой и пакетной отрисовки: ячейки (как из
+    cells_data_from_rows), типы ТВС и столбцы CellColumns. Не меняется после
+    создания, поэтому её можно передавать в рабочие потоки и процессы.
+    """
+
+    def __init__(self, cells_data, fuel_types, name="", columns=None):
+        import numpy as np
+
+        self.name = name
+        self.cells_data = tuple(cells_data)
+        self.fuel_types = tuple(dict(ft) for ft in fuel_types)
+        # готовые столбцы тех же ячеек (снимок из окна) не пересчитываются
+        self.columns = columns if columns is not None else CellColumns(self.cells_data)
+        self.circle = np.fromiter(
+            (c.get("shape") == "circle" for c in self.cells_data),
+            dtype=bool, count=len(self.cells_data)
+        )
+
+    @classmethod
+    def from_rows(cls, rows, fuel_types=None, name=""):
+        types = [dict(ft) for ft in (fuel_types or DEFAULT_FUEL_TYPES)]
+        return cls(cells_data_from_rows(rows, types), types, name)
+
+    @classmethod
+    def from_csv(cls, path, fuel_types=None):
+        name = os.path.splitext(os.path.basename(path))[0]
+        return cls.from_rows(read_cartogram_csv(path), fuel_types, name)
+
+    @property
+    def fuel_colors(self):
+        return [ft["color"] for ft in self.fuel_types]
+
+    def styles(self, mode=COLOR_MODE_TYPES, selected_type=0, center_swing=None):
+        """Стили ячеек для режима окраски; нет значений для градиента — окраска по типам."""
+        result = mode_cell_styles(self.columns, mode, self.fuel_colors, selected_type, center_swing)
+        if result is None:
+            return type_cell_styles(self.columns, self.fuel_colors)
+        return result[0]
+
+    def scene(self, styles, width, height, rotation_deg=0, zoom=1.0, font_scale=1.0, labels=True):
+        """Сцена для отрисовки: фигуры и подписи ячеек на холсте width×height."""
+        return self.styled_scene(
+            self.geometry(width, height, rotation_deg, zoom, font_scale), styles, labels
+        )
+
+    def scene_rows(self, styles, rows, xs, ys, hex_size, width, height,
+                   font_scale=1.0, labels=True):
+        """
+        Сцена из ячеек rows; xs, ys — их центры в координатах сцены (для тайла
+        плаката — уже со сдвигом к углу тайла), styles — по всем строкам.
+        """
+        return self.styled_scene(
+            self.geometry_rows(rows, xs, ys, hex_size, width, height, font_scale), styles, labels
+        )
+
+    def geometry(self, width, height, rotation_deg=0, zoom=1.0, font_scale=1.0):
+        """Геометрия всех ячеек на холсте width×height (без цветов)."""
+        import numpy as np
+
+        cols = self.columns
+        if not cols.n:
+            return SceneGeometry(width, height, (), (), (), ())
+        xs, ys, hex_size, _ = cell_layout(cols.q, cols.r, rotation_deg, width, height, zoom)
+        return self.geometry_rows(np.arange(cols.n), xs, ys, hex_size, width, height, font_scale)
+
+    def geometry_rows(self, rows, xs, ys, hex_size, width, height, font_scale=1.0):
+        """Геометрия ячеек rows с центрами xs, ys (как в scene_rows)."""
+        pos_size, factory_size = label_font_sizes(hex_size)
+        pos_size = int(pos_size * font_scale)
+        factory_size = int(factory_size * font_scale)
+        dy = hex_size * 0.25
+        hex_radius = hex_size * 0.9
+        circle_radius = hex_size * 0.72
+        circles = self.circle
+
+        rows = rows.tolist()
+        shapes = []
+        pos_texts = []
+        label_texts = []
+        for row, x, y in zip(rows, xs.tolist(), ys.tolist()):
+            if circles[row]:
+                shapes.append((
+                    "oval",
+                    (x - circle_radius, y - circle_radius, x + circle_radius, y + circle_radius),
+                ))
+            else:
+                shapes.append((
+                    "polygon",
+                    tuple(v for cx, cy in _HEX_CORNERS for v in (x + hex_radius * cx, y + hex_radius * cy)),
+                ))
+            pos_texts.append((x, y - dy, pos_size))
+            label_texts.append((x, y + dy, factory_size))
+        return SceneGeometry(width, height, rows, shapes, pos_texts, label_texts)
+
+    def styled_scene(self, geometry, styles, labels=True):
+        """Сцена из готовой геометрии и стилей ячеек (по всем строкам модели)."""
+        pos_labels = self.columns.pos_label
+        shapes = []
+        texts = []
+        for row, (kind, coords), pos_at, label_at in zip(
+            geometry.rows, geometry.shapes, geometry.pos_texts, geometry.label_texts
+        ):
+            fill, outline, _, label, label_fill = styles[row]
+            shapes.append((kind, coords, fill, outline))
+            if labels:
+                pos_label = pos_labels[row]
+                if pos_label:
+                    texts.append(pos_at + (pos_label, "black", True))
+                if label:
+                    texts.append(label_at + (label, label_fill, False))
+        return CartogramScene(geometry.width, geometry.height, shapes, texts)
+
+
+_SCENE_FONTS = {}
+
+
+def _scene_font(pixels, bold):
+    """Шрифт Pillow заданного размера в пикселях (TrueType, если найден)."""
+    key = (pixels, bold)
+    font = _SCENE_FONTS.get(key)
+    if font is None:
+        from PIL import ImageFont
+        names = (
+            ("DejaVuSans-Bold.ttf", "arialbd.ttf", "Arial Bold.ttf") if bold
+            else ("DejaVuSans.ttf", "arial.ttf", "Arial.ttf")
+        )
+        for name in names:
+            try:
+                font = ImageFont.truetype(name, pixels)
+                break
+            except OSError:
+                continue
+        else:
+            try:
+                font = ImageFont.load_default(size=pixels)
+            except TypeError:       # Pillow < 10.1: только растровый шрифт
+                font = ImageFont.load_default()
+        _SCENE_FONTS[key] = font
+    return font
+
+
+def render_scene(scene, supersample=RENDER_SUPERSAMPLE, background="white", job=None):
+    """
+    Растровое изображение сцены (Pillow), со сглаживанием через supersample;
+    кратность уменьшается, пока холст больше RENDER_SUPERSAMPLE_MAX_PIXELS.
+    """
+    from PIL import Image, ImageDraw
+
+    k = max(1, int(supersample))
+    while k > 1 and scene.width * scene.height * k * k > RENDER_SUPERSAMPLE_MAX_PIXELS:
+        k -= 1
+    img = Image.new("RGB", (scene.width * k, scene.height * k), background)
+    draw = ImageDraw.Draw(img)
+    total = max(len(scene.shapes) + len(scene.texts), 1)
+
+    for i, (kind, coords, fill, outline) in enumerate(scene.shapes):
+        if job is not None and i % EXPORT_PROGRESS_STEP == 0:
+            job.progress(0.8 * i / total, "фигуры")
+        points = [v * k for v in coords]
+        if kind == "oval":
+            draw.ellipse(points, fill=fill or None, outline=outline or None, width=k)
+        else:
+            draw.polygon(points, fill=fill or None, outline=outline or None, width=k)
+
+    done = len(scene.shapes)
+    for i, (x, y, size, text, color, bold) in enumerate(scene.texts):
+        if job is not None and i % EXPORT_PROGRESS_STEP == 0:
+            job.progress(0.8 * (done + i) / total, "подписи")
+        font = _scene_font(max(1, round(size * POINTS_TO_PIXELS * k)), bold)
+        draw.text((x * k, y * k), str(text), fill=color or "black", font=font, anchor="mm")
+
+    if k > 1:
+        img = img.resize((scene.width, scene.height), Image.LANCZOS)
+    return img
+
+
+def encode_image(img, fmt):
+    """Изображение Pillow в байты PNG / JPEG / TIFF."""
+    buf = io.BytesIO()
+    if fmt == "JPEG":
+        img.convert("RGB").save(buf, "JPEG", quality=95)
+    elif fmt == "TIFF":
+        img.save(buf, "TIFF")
+    else:
+        img.save(buf, "PNG")
+    return buf.getvalue()
+
+
+# ---------- Плакат: тайловый экспорт высокого разрешения ----------
+
+POSTER_DEFAULT_SIDE = 20000  # пикс. по большей стороне
+POSTER_MAX_SIDE = 60000
+POSTER_TILE = 2048           # сторона тайла (набор PNG)
+POSTER_STRIP = 256           # высота полосы при потоковой записи одного PNG
+POSTER_SUPERSAMPLE = 1       # при таком разрешении сглаживание почти не заметно
+POSTER_REACH = 2.0           # запас отбора ячеек у края области, в размерах гекса
+
+
+class PosterRenderer:
+    """
+    Отрисовка произвольной прямоугольной области плаката width×height без
+    построения всей сцены: центры ячеек считаются один раз, для области
+    по пространственному индексу отбираются только ячейки, задевающие её
+    (с запасом на фигуру и подписи). Память — на одну область, а не на плакат.
+    """
+
+    def __init__(self, model, styles, width, height, rotation_deg=0, font_scale=1.0,
+                 labels=True, supersample=POSTER_SUPERSAMPLE, zoom=1.0):
+        self.model = model
+        self.styles = styles
+        self.width = int(width)
+        self.height = int(height)
+        self.font_scale = font_scale
+        self.labels = labels
+        self.supersample = supersample
+        cols = model.columns
+        if cols.n:
+            self.xs, self.ys, self.hex_size, _ = cell_layout(
+                cols.q, cols.r, rotation_deg, self.width, self.height, zoom
+            )
+        else:
+            self.xs = self.ys = ()
+            self.hex_size = 0.0
+        self.reach = self.hex_size * POSTER_REACH * max(font_scale, 1.0) + 2
+        self.index = CellSpatialIndex(self.xs, self.ys, self.hex_size * 4)
+
+    def region(self, x0, y0, width, height):
+        """Изображение Pillow области с левым верхним углом (x0, y0)."""
+        reach = self.reach
+        rows = self.index.in_rect(x0 - reach, y0 - reach, x0 + width + reach, y0 + height + reach)
+        rows.sort()     # порядок наложения — как на целой сцене
+        scene = self.model.scene_rows(
+            self.styles, rows, self.index.xs[rows] - x0, self.index.ys[rows] - y0,
+            self.hex_size, width, height, self.font_scale, self.labels,
+        )
+        return render_scene(scene, self.supersample)
+
+
+def _png_chunk(tag, data):
+    return (
+        struct.pack(">I", len(data)) + tag + data
+        + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+    )
+
+
+def write_poster_png(filename, renderer, job=None, strip=POSTER_STRIP):
+    """
+    Плакат одним PNG: полосы по strip строк рисуются и сразу сжимаются в
+    поток IDAT (фильтр Sub), поэтому в памяти только одна полоса.
+    """
+    import numpy as np
+
+    width, height = renderer.width, renderer.height
+    with atomic_output(filename) as tmp:
+        with open(tmp, "wb") as f:
+            f.write(b"\x89PNG\r\n\x1a\n")
+            f.write(_png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)))
+            compressor = zlib.compressobj(6)
+            for y0 in range(0, height, strip):
+                if job is not None:
+                    job.progress(y0 / height, f"строки {y0}–{min(y0 + strip, height)}")
+                h = min(strip, height - y0)
+                img = renderer.region(0, y0, width, h)
+                pixels = np.frombuffer(img.tobytes(), dtype=np.uint8).reshape(h, width * 3)
+                lines = np.empty((h, width * 3 + 1), dtype=np.uint8)
+                lines[:, 0] = 1                                 # фильтр Sub
+                lines[:, 1:4] = pixels[:, :3]
+                lines[:, 4:] = pixels[:, 3:] - pixels[:, :-3]   # по модулю 256
+                data = compressor.compress(lines.tobytes())
+                if data:
+                    f.write(_png_chunk(b"IDAT", data))
+            f.write(_png_chunk(b"IDAT", compressor.flush()))
+            f.write(_png_chunk(b"IEND", b""))
+        if job is not None:
+            job.check()
+
+
+def poster_tiles_dir(index_file):
+    """Каталог тайлов рядом с индексом: plan.json → plan_tiles/."""
+    return os.path.splitext(index_file)[0] + "_tiles"
+
+
+def write_poster_tiles(index_file, renderer, job=None, tile=POSTER_TILE):
+    """
+    Плакат набором PNG-тайлов tile×tile: каталог <имя>_tiles, индекс JSON
+    (размеры, сетка, имена файлов по строкам) и HTML для просмотра рядом.
+    Тайлы пишутся во временный каталог, при отмене он удаляется.
+    """
+    width, height = renderer.width, renderer.height
+    n_cols = -(-width // tile)
+    n_rows = -(-height // tile)
+    tiles_dir = poster_tiles_dir(index_file)
+    tiles_name = os.path.basename(tiles_dir)
+    tmp_dir = tempfile.mkdtemp(
+        prefix=tiles_name + ".", suffix=".tmp", dir=os.path.dirname(os.path.abspath(tiles_dir))
+    )
+    try:
+        grid = []
+        for ty in range(n_rows):
+            names = []
+            for tx in range(n_cols):
+                if job is not None:
+                    job.progress(
+                        (ty * n_cols + tx) / (n_rows * n_cols),
+                        f"тайл {ty * n_cols + tx + 1} из {n_rows * n_cols}",
+                    )
+                x0, y0 = tx * tile, ty * tile
+                img = renderer.region(x0, y0, min(tile, width - x0), min(tile, height - y0))
+                name = f"tile_{ty:03d}_{tx:03d}.png"
+                img.save(os.path.join(tmp_dir, name), "PNG")
+                names.append(name)
+            grid.append(names)
+        if job is not None:
+            job.check()
+
+        index = {
+            "name": renderer.model.name,
+            "width": width,
+            "height": height,
+            "tile": tile,
+            "rows": n_rows,
+            "cols": n_cols,
+            "dir": tiles_name,
+            "tiles": grid,
+        }
+        html = [
+            "<!DOCTYPE html>\n<html><head><meta charset=\"utf-8\">",
+            f"<title>{saxutils.escape(renderer.model.name or 'Картограмма')}</title>",
+            "<style>body{margin:0}img{display:block}"
+            ".row{display:flex}</style></head><body>",
+        ]
+        for names in grid:
+            html.append(
+                '<div class="row">'
+                + "".join(f'<img src="{tiles_name}/{name}" loading="lazy">' for name in names)
+                + "</div>"
+            )
+        html.append("</body></html>\n")
+
+        os.chmod(tmp_dir, _output_mode(tiles_dir, 0o777))
+        if os.path.isdir(tiles_dir):
+            shutil.rmtree(tiles_dir)
+        os.replace(tmp_dir, tiles_dir)
+        with open(index_file, "w", encoding="utf-8") as f:
+            json.dump(index, f, ensure_ascii=False, indent=1)
+        with open(os.path.splitext(index_file)[0] + ".html", "w", encoding="utf-8") as f:
+            f.write("\n".join(html))
+    finally:
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+
+
+# ---------- Растровый режим просмотра ----------
+
+RASTER_DEBOUNCE_MS = 40     # пауза перед перерисовкой растра после зума / сдвига / правки
+RASTER_LABEL_MIN_HEX = 10   # при меньшем гексе подписи в растр не попадают (нечитаемы)
+RASTER_OVERLAY_MAX = 2000   # векторных ячеек выделения поверх растра (в видимой области)
+
+
+def render_view_png(model, styles, width, height, rotation_deg=0, zoom=1.0, pan=(0.0, 0.0)):
+    """
+    Видимая область картограммы — как на Canvas при этих повороте, масштабе
+    и сдвиге — одним изображением: PNG в base64 для tk.PhotoImage(data=...).
+    Рисуются только ячейки, попадающие в область.
+    """
+    renderer = PosterRenderer(model, styles, width, height, rotation_deg, supersample=1, zoom=zoom)
+    renderer.labels = renderer.hex_size >= RASTER_LABEL_MIN_HEX
+    img = renderer.region(-pan[0], -pan[1], width, height)
+    buf = io.BytesIO()
+    img.save(buf, "PNG", compress_level=1)
+    return base64.b64encode(buf.getvalue()).decode("ascii")
+
+
+MINIMAP_SIZE = 200          # большая сторона обзорной миникарты, пикселей
+MINIMAP_DEBOUNCE_MS = 150
+
+
+def render_minimap_png(model, styles, width, height, rotation_deg, scale):
+    """
+    Обзор всей картограммы — как на холсте width×height при масштабе 1 и
+    без сдвига, уменьшенный в 1/scale раз, без подписей: PNG в base64.
+    """
+    import numpy as np
+
+    cols = model.columns
+    xs, ys, _, base_hex = cell_layout(cols.q, cols.r, rotation_deg, width, height)
+    scene = model.scene_rows(
+        styles, np.arange(cols.n), xs * scale, ys * scale, base_hex * scale,
+        max(1, round(width * scale)), max(1, round(height * scale)), labels=False,
+    )
+    buf = io.BytesIO()
+    render_scene(scene).save(buf, "PNG", compress_level=1)
+    return base64.b64encode(buf.getvalue()).decode("ascii")
+
+
+def write_scene_image(filename, scene, fmt, job=None):
+    """Растр сцены (Pillow) в PNG / TIFF / JPEG через временный файл."""
+    img = render_scene(scene, job=job)
+    if job is not None:
+        job.progress(0.9, "кодирование")
+    data = encode_image(img, fmt)
+    with atomic_output(filename) as tmp:
+        with open(tmp, "wb") as f:
+            f.write(data)
+        if job is not None:
+            job.check()
+
+
+# ---------- Матрица вариантов: повороты × режимы окраски ----------
+
+MATRIX_ROTATIONS = tuple(range(0, 360, 30))  # шаги кнопок поворота
+MATRIX_DEFAULT_SIZE = 1000
+MATRIX_THUMB = 320          # сторона миниатюры на контактном листе
+MATRIX_SHEET_NAME = "contact_sheet.png"
+
+
+def matrix_file_stem(rotation, mode_index, mode):
+    """Имя файла варианта: номер режима, режим (без спецсимволов), поворот."""
+    slug = "".join(ch if ch.isalnum() else "_" for ch in mode).strip("_")
+    while "__" in slug:
+        slug = slug.replace("__", "_")
+    return f"m{mode_index:02d}_{slug}_r{rotation:03d}"
+
+
+def matrix_styles(model, modes, selected_type=0):
+    """Стили ячеек по режимам (один расчёт на режим); без значений — по типам."""
+    return {mode: model.styles(mode, selected_type) for mode in modes}
+
+
+_MATRIX_STATE = {}
+
+
+def _matrix_worker_init(model, styles_by_mode):
+    _render_worker_init()
+    _MATRIX_STATE["model"] = model
+    _MATRIX_STATE["styles"] = styles_by_mode
+
+
+def _matrix_worker(rotation, modes, out_dir, size, fmt, font_scale):
+    """
+    Варианты одного поворота: геометрия строится один раз и окрашивается
+    каждым режимом. Возвращает [(поворот, режим, файл, PNG миниатюры)].
+    """
+    model = _MATRIX_STATE["model"]
+    styles_by_mode = _MATRIX_STATE["styles"]
+    geometry = model.geometry(size, size, rotation, font_scale=font_scale)
+    ext = {"PNG": "png", "JPEG": "jpg", "TIFF": "tiff", "SVG": "svg"}[fmt]
+    results = []
+    for mode in modes:
+        scene = model.styled_scene(geometry, styles_by_mode[mode])
+        filename = os.path.join(
+            out_dir, f"{matrix_file_stem(rotation, list(styles_by_mode).index(mode) + 1, mode)}.{ext}"
+        )
+        img = render_scene(scene)
+        if fmt == "SVG":
+            write_svg(filename, scene)
+        else:
+            with atomic_output(filename) as tmp:
+                with open(tmp, "wb") as f:
+                    f.write(encode_image(img, fmt))
+        img.thumbnail((MATRIX_THUMB, MATRIX_THUMB))
+        results.append((rotation, mode, filename, encode_image(img, "PNG")))
+    return results
+
+
+def matrix_contact_sheet(rotations, modes, thumbs, title=""):
+    """
+    Контактный лист: строки — повороты, столбцы — режимы; thumbs —
+    {(поворот, режим): изображение Pillow}. Подписи режимов — номерами,
+    расшифровка внизу листа.
+    """
+    from PIL import Image, ImageDraw
+
+    pad = 10
+    head = 40
+    left = 70
+    cell = MATRIX_THUMB + pad
+    legend = 26 * len(modes) + 2 * pad
+    width = left + cell * len(modes) + pad
+    height = head + (40 if title else 0) + cell * len(rotations) + legend
+    sheet = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(sheet)
+    top = pad
+    if title:
+        draw.text((pad, top), title, fill="black", font=_scene_font(26, True))
+        top += 40
+    for j, mode in enumerate(modes):
+        draw.text(
+            (left + cell * j + MATRIX_THUMB / 2, top + head / 2), f"{j + 1}",
+            fill="black", font=_scene_font(22, True), anchor="mm",
+        )
+    top += head
+    for i, rotation in enumerate(rotations):
+        y = top + cell * i
+        draw.text((pad, y + MATRIX_THUMB / 2), f"{rotation}°", fill="black",
+                  font=_scene_font(22, True), anchor="lm")
+        for j, mode in enumerate(modes):
+            thumb = thumbs.get((rotation, mode))
+            if thumb is None:
+                continue
+            x = left + cell * j
+            sheet.paste(thumb, (
+                x + (MATRIX_THUMB - thumb.width) // 2, y + (MATRIX_THUMB - thumb.height) // 2
+            ))
+            draw.rectangle((x - 1, y - 1, x + MATRIX_THUMB, y + MATRIX_THUMB), outline="#BBBBBB")
+    y = top + cell * len(rotations) + pad
+    for j, mode in enumerate(modes):
+        draw.text((pad, y + 26 * j), f"{j + 1}: {mode}", fill="black", font=_scene_font(18, False))
+    return sheet
+
+
+def export_matrix(model, styles_by_mode, rotations, out_dir, size=MATRIX_DEFAULT_SIZE,
+                  fmt="PNG", font_scale=1.0, workers=None, job=None):
+    """
+    Все сочетания поворотов и режимов окраски в out_dir и контактный лист.
+    Раскраски (styles_by_mode) посчитаны заранее — по одной на режим — и
+    передаются процессам один раз при запуске; каждая задача — один поворот
+    (или часть его режимов, если поворотов меньше, чем процессов), геометрия
+    поворота строится в ней один раз. Возвращает (файлы, путь листа).
+    """
+    from PIL import Image
+
+    modes = list(styles_by_mode)
+    rotations = list(rotations)
+    workers = workers or os.cpu_count() or 1
+    os.makedirs(out_dir, exist_ok=True)
+    parts = max(1, min(len(modes), workers // max(len(rotations), 1)))
+    tasks = [
+        (rotation, modes[k::parts]) for rotation in rotations for k in range(parts)
+    ]
+    total = len(rotations) * len(modes)
+    files = []
+    thumbs = {}
+    with ProcessPoolExecutor(
+        max_workers=min(workers, len(tasks)) or 1,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_matrix_worker_init,
+        initargs=(model, styles_by_mode),
+    ) as pool:
+        pending = {
+            pool.submit(_matrix_worker, rotation, part, out_dir, size, fmt, font_scale)
+            for rotation, part in tasks
+        }
+        try:
+            while pending:
+                finished, pending = wait(
+                    pending, timeout=JOB_POLL_MS / 1000.0, return_when=FIRST_COMPLETED
+                )
+                for future in finished:
+                    for rotation, mode, filename, thumb in future.result():
+                        files.append(filename)
+                        thumbs[(rotation, mode)] = Image.open(io.BytesIO(thumb))
+                if job is not None:
+                    job.progress(0.95 * len(files) / total, f"{len(files)} из {total}")
+        except BaseException:
+            for future in pending:
+                future.cancel()
+            raise
+
+    if job is not None:
+        job.progress(0.97, "контактный лист")
+    sheet_file = os.path.join(out_dir, MATRIX_SHEET_NAME)
+    sheet = matrix_contact_sheet(rotations, modes, thumbs, model.name)
+    with atomic_output(sheet_file) as tmp:
+        sheet.save(tmp, "PNG")
+    return sorted(files), sheet_file
+
+
+# ---------- Рендер-сервис (--serve) ----------
+
+RENDER_DEFAULT_SIZE = 1000
+RENDER_MAX_SIDE = 8000
+RENDER_MAX_PIXELS = 16_000_000  # ширина × высота: память процесса отрисовки ограничена
+RENDER_FONT_SCALE_RANGE = (0.1, 5.0)    # допустимый font_scale в запросе
+RENDER_SOCKET_TIMEOUT = 15  # секунд: простаивающее keep-alive соединение освобождает поток
+RENDER_MAX_UPLOAD = 64 * 1024 * 1024
+RENDER_CACHE_MEMORY = 64 * 1024 * 1024      # байт готовых изображений в памяти
+RENDER_CACHE_DISK = 512 * 1024 * 1024       # и на диске
+RENDER_CACHE_SCHEMA = 1     # увеличить при изменении отрисовки — прежний кэш не подойдёт
+
+# Формат в запросе -> (формат Pillow или "SVG", Content-Type)
+RENDER_FORMATS = {
+    "png": ("PNG", "image/png"),
+    "jpeg": ("JPEG", "image/jpeg"),
+    "jpg": ("JPEG", "image/jpeg"),
+    "tiff": ("TIFF", "image/tiff"),
+    "svg": ("SVG", "image/svg+xml"),
+}
+
+
+def render_options(query):
+    """
+    Параметры отрисовки из строки запроса (dict из parse_qs): mode (название
+    или номер в HEADLESS_MODES), type, rotation, width, height, format, labels,
+    font_scale. Некорректные значения — ValueError.
+    """
+    def arg(name, default):
+        values = query.get(name)
+        return values[0] if values else default
+
+    mode = arg("mode", COLOR_MODE_TYPES)
+    if mode.isdigit():
+        if int(mode) >= len(HEADLESS_MODES):
+            raise ValueError(f"Нет режима окраски с номером {mode}")
+        mode = HEADLESS_MODES[int(mode)]
+    elif mode not in HEADLESS_MODES:
+        raise ValueError(f"Режим окраски недоступен: {mode}")
+
+    fmt = arg("format", "png").lower()
+    if fmt not in RENDER_FORMATS:
+        raise ValueError(f"Формат не поддерживается: {fmt}")
+
+    width = int(arg("width", RENDER_DEFAULT_SIZE))
+    height = int(arg("height", width))
+    if not (50 <= width <= RENDER_MAX_SIDE and 50 <= height <= RENDER_MAX_SIDE):
+        raise ValueError(f"Размер изображения — от 50 до {RENDER_MAX_SIDE} пикс.")
+    if width * height > RENDER_MAX_PIXELS:
+        raise ValueError(f"Изображение больше {RENDER_MAX_PIXELS // 1_000_000} Мпикс.")
+
+    # большой шрифт надолго занимает процесс отрисовки — диапазон ограничен
+    font_scale = float(arg("font_scale", 1.0))
+    lo, hi = RENDER_FONT_SCALE_RANGE
+    if not (lo <= font_scale <= hi):    # NaN и бесконечность тоже не проходят
+        raise ValueError(f"font_scale — от {lo} до {hi}")
+
+    return {
+        "mode": mode,
+        "type": int(arg("type", 0)),
+        "rotation": int(arg("rotation", 0)) % 360,
+        "width": width,
+        "height": height,
+        "format": RENDER_FORMATS[fmt][0],
+        "labels": arg("labels", "1") not in ("0", "false", "no"),
+        "font_scale": font_scale,
+    }
+
+
+def render_cache_key(data, options):
+    """Ключ кэша: хэш содержимого CSV и нормализованных параметров отрисовки."""
+    h = hashlib.sha256()
+    h.update(json.dumps([RENDER_CACHE_SCHEMA, options], sort_keys=True).encode("utf-8"))
+    h.update(data)
+    return h.hexdigest()
+
+
+def render_cartogram_bytes(data, options):
+    """Отрисовать CSV картограммы (байты) по параметрам render_options — в процессе-обработчике."""
+    rows = parse_cartogram_csv(data.decode("utf-8-sig").splitlines())
+    model = CartogramModel.from_rows(rows)
+    styles = model.styles(options["mode"], options["type"])
+    scene = model.scene(
+        styles, options["width"], options["height"], options["rotation"],
+        font_scale=options["font_scale"], labels=options["labels"]
+    )
+    if options["format"] == "SVG":
+        return "".join(svg_lines(scene)).encode("utf-8")
+    return encode_image(render_scene(scene), options["format"])
+
+
+def _render_worker_init():
+    # тяжёлые модули — заранее, а не в первом запросе
+    import numpy  # noqa: F401
+    from PIL import Image, ImageDraw  # noqa: F401
+
+
+class RenderCache:
+    """
+    Кэш готовых изображений по ключу render_cache_key: LRU в памяти и LRU
+    на диске (порядок — по времени последнего обращения), оба с ограничением объёма.
+    """
+
+    def __init__(self, directory, memory_bytes=RENDER_CACHE_MEMORY, disk_bytes=RENDER_CACHE_DISK):
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._disk = OrderedDict()      # ключ -> размер файла, от давних к недавним
+        self._disk_size = 0
+        self.hits = {"memory": 0, "disk": 0, "miss": 0}
+
+        os.makedirs(directory, exist_ok=True)
+        files = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name.endswith(".img") and os.path.isfile(path):
+                st = os.stat(path)
+                files.append((st.st_mtime, name[:-4], st.st_size))
+        for _, key, size in sorted(files):
+            self._disk[key] = size
+            self._disk_size += size
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".img")
+
+    def get(self, key):
+        """(байты, "memory" | "disk") или (None, "miss")."""
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self.hits["memory"] += 1
+                return data, "memory"
+            on_disk = key in self._disk
+        if on_disk:
+            try:
+                with open(self._path(key), "rb") as f:
+                    data = f.read()
+                os.utime(self._path(key))
+            except OSError:
+                data = None
+            if data is not None:
+                with self._lock:
+                    if key in self._disk:
+                        self._disk.move_to_end(key)
+                    self._remember(key, data)
+                    self.hits["disk"] += 1
+                return data, "disk"
+        with self._lock:
+            self.hits["miss"] += 1
+        return None, "miss"
+
+    def put(self, key, data):
+        path = self._path(key)
+        try:
+            with atomic_output(path) as tmp:
+                with open(tmp, "wb") as f:
+                    f.write(data)
+        except OSError:
+            path = None
+        with self._lock:
+            self._remember(key, data)
+            if path is not None:
+                self._disk_size += len(data) - self._disk.pop(key, 0)
+                self._disk[key] = len(data)
+                self._evict_disk(keep=key)
+
+    def _remember(self, key, data):
+        if len(data) > self.memory_bytes:
+            return
+        self._memory_size += len(data) - len(self._memory.pop(key, b""))
+        self._memory[key] = data
+        while self._memory_size > self.memory_bytes:
+            _, old = self._memory.popitem(last=False)
+            self._memory_size -= len(old)
+
+    def _evict_disk(self, keep):
+        while self._disk_size > self.disk_bytes and len(self._disk) > 1:
+            key, size = next(iter(self._disk.items()))
+            if key == keep:
+                break
+            del self._disk[key]
+            self._disk_size -= size
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                "memory_items": len(self._memory),
+                "memory_bytes": self._memory_size,
+                "disk_items": len(self._disk),
+                "disk_bytes": self._disk_size,
+                "hits": dict(self.hits),
+            }
+
+
+class RenderService:
+    """
+    Отрисовка картограмм по запросам: кэш по содержимому, пул процессов для
+    отрисовки, одинаковые одновременные запросы ждут одну и ту же задачу.
+    Файлы по пути берутся только внутри каталога root. Если процесс отрисовки
+    аварийно завершился (например, по нехватке памяти), пул создаётся заново.
+    """
+
+    def __init__(self, root, cache, workers=None):
+        self.root = os.path.realpath(root)
+        self.cache = cache
+        self.workers = workers
+        self.pool = self._new_pool()
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def _new_pool(self):
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_render_worker_init,
+        )
+
+    def _submit(self, data, options):
+        """Задача отрисовки в пул (под self._lock); сломанный пул заменяется новым."""
+        try:
+            return self.pool.submit(render_cartogram_bytes, data, options)
+        except BrokenProcessPool:
+            self._replace_pool(self.pool)
+            return self.pool.submit(render_cartogram_bytes, data, options)
+
+    def _replace_pool(self, broken):
+        """Заменить пул broken новым (под self._lock), если его ещё не заменили."""
+        if self.pool is broken:
+            self.pool = self._new_pool()
+            broken.shutdown(wait=False, cancel_futures=True)
+
+    def read_path(self, path):
+        """Содержимое CSV по пути относительно root (FileNotFoundError / PermissionError)."""
+        full = os.path.realpath(os.path.join(self.root, path))
+        if os.path.commonpath([full, self.root]) != self.root:
+            raise PermissionError(path)
+        with open(full, "rb") as f:
+            return f.read()
+
+    def render(self, data, options, key=None):
+        """(байты изображения, источник "memory" | "disk" | "render" | "shared")."""
+        if key is None:
+            key = render_cache_key(data, options)
+        body, source = self.cache.get(key)
+        if body is not None:
+            return body, source
+
+        with self._lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._submit(data, options)
+                pool = self.pool
+                self._inflight[key] = future
+        if not owner:
+            return future.result(), "shared"
+        try:
+            try:
+                body = future.result()
+            except BrokenProcessPool:
+                # этот запрос получит ошибку, следующие — новый пул
+                with self._lock:
+                    self._replace_pool(pool)
+                raise
+            # в кэш — до снятия отметки «в работе», чтобы не отрисовать повторно
+            self.cache.put(key, body)
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+        return body, "render"
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+def make_render_server(address, service, threads=16, verbose=False):
+    """
+    HTTP-сервер рендер-сервиса. Соединения обслуживает пул из threads потоков:
+      GET  /render?path=<CSV внутри root>&mode=…&rotation=…&width=…&format=…
+      POST /render?mode=…  (тело — CSV картограммы)
+      GET  /health — состояние кэша (JSON)
+    """
+    class RenderRequestHandler(BaseHTTPRequestHandler):
+        server_version = "CartogramRender/1"
+        protocol_version = "HTTP/1.1"
+        timeout = RENDER_SOCKET_TIMEOUT     # иначе threads простаивающих клиентов займут весь пул
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            if url.path == "/health":
+                body = json.dumps(service.cache.stats()).encode("utf-8")
+                self._send(200, "application/json", body)
+                return
+            if url.path != "/render":
+                self._send_error(404, "Неизвестный адрес")
+                return
+            query = parse_qs(url.query)
+            path = (query.get("path") or [""])[0]
+            if not path:
+                self._send_error(400, "Не указан path (или используйте POST с CSV)")
+                return
+            try:
+                data = service.read_path(path)
+            except PermissionError:
+                self._send_error(403, "Путь вне каталога сервиса")
+                return
+            except OSError:
+                self._send_error(404, f"Файл не найден: {path}")
+                return
+            self._render(data, query)
+
+        def do_POST(self):
+            url = urlsplit(self.path)
+            if url.path != "/render":
+                self._send_error(404, "Неизвестный адрес")
+                return
+            length = int(self.headers.get("Content-Length") or 0)
+            if length <= 0 or length > RENDER_MAX_UPLOAD:
+                self._send_error(413 if length > 0 else 400, "Нужен CSV картограммы в теле запроса")
+                return
+            self._render(self.rfile.read(length), parse_qs(url.query))
+
+        def _render(self, data, query):
+            try:
+                options = render_options(query)
+            except ValueError as e:
+                self._send_error(400, str(e))
+                return
+            key = render_cache_key(data, options)
+            etag = f'"{key}"'
+            if self.headers.get("If-None-Match") == etag:
+                self._send(304, None, b"", {"ETag": etag})
+                return
+            try:
+                body, source = service.render(data, options, key)
+            except (ValueError, KeyError) as e:
+                self._send_error(422, f"Некорректная картограмма: {e}")
+                return
+            except Exception as e:
+                self._send_error(500, f"Ошибка отрисовки: {e}")
+                return
+            content_type = next(ct for f, ct in RENDER_FORMATS.values() if f == options["format"])
+            self._send(200, content_type, body, {"ETag": etag, "X-Cache": source})
+
+        def _send(self, status, content_type, body, headers=None):
+            self.send_response(status)
+            if content_type:
+                self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            if body:
+                self.wfile.write(body)
+
+        def _send_error(self, status, message):
+            self._send(status, "text/plain; charset=utf-8", (message + "\n").encode("utf-8"))
+
+        def log_message(self, format, *args):
+            if verbose:
+                super().log_message(format, *args)
+
+    class RenderHTTPServer(HTTPServer):
+        daemon_threads = True
+
+        def __init__(self):
+            super().__init__(address, RenderRequestHandler)
+            self.connections = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="http")
+
+        def process_request(self, request, client_address):
+            self.connections.submit(self._serve_connection, request, client_address)
+
+        def _serve_connection(self, request, client_address):
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+        def server_close(self):
+            super().server_close()
+            self.connections.shutdown(wait=False, cancel_futures=True)
+
+    return RenderHTTPServer()
+
+
+def serve_render(args):
+    """Запустить рендер-сервис (режим --serve) до Ctrl+C."""
+    cache_dir = args.cache_dir or default_render_cache_dir()
+    cache = RenderCache(
+        cache_dir,
+        memory_bytes=args.cache_memory_mb * 1024 * 1024,
+        disk_bytes=args.cache_disk_mb * 1024 * 1024,
+    )
+    service = RenderService(args.root, cache, workers=args.workers)
+    server = make_render_server((args.host, args.port), service, threads=args.threads, verbose=args.verbose)
+    host, port = server.server_address[:2]
+    print(f"Рендер-сервис: http://{host}:{port}/render (каталог {service.root}, кэш {cache_dir})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+# ---------- Отчёты PDF ----------
+
+REPORT_DPI = 150
+REPORT_PAGE_SIZE = (1240, 1754)     # A4 при 150 dpi
+REPORT_MARGIN = 80
+REPORT_MAP_SIZE = 1080
+REPORT_TABLE_ROWS = 45              # строк таблицы на странице
+REPORT_MODEL_CACHE = 16             # разобранных картограмм в процессе-обработчике
+REPORT_SCHEMA = 1                   # увеличить при изменении вёрстки карт отчёта
+
+# Карты отчёта: окраска по типам и три градиента масс по всем ячейкам
+REPORT_MAP_MODES = [COLOR_MODE_TYPES] + [
+    mode for mode, (_, per_type) in GRADIENT_MODES.items() if not per_type
+]
+
+REPORT_TYPE_COLUMNS = (
+    ("type", "Тип"), ("name", "Название"), ("metric", "Величина"), ("count", "N"),
+    ("mean", "mean"), ("std", "σ"), ("min", "min"),
+) + tuple((f"p{p}", f"P{p}") for p in AGGREGATE_PERCENTILES) + (("max", "max"),)
+
+
+def default_render_cache_dir():
+    return os.path.join(tempfile.gettempdir(), "cartogram_render_cache")
+
+
+def _report_text(draw, xy, text, size, bold=False, fill="black", anchor="la"):
+    draw.text(xy, str(text), fill=fill, font=_scene_font(size, bold), anchor=anchor)
+
+
+def _report_page(title, subtitle=""):
+    """Пустая страница с заголовком; возвращает (изображение, draw, y под заголовком)."""
+    from PIL import Image, ImageDraw
+
+    img = Image.new("RGB", REPORT_PAGE_SIZE, "white")
+    draw = ImageDraw.Draw(img)
+    y = REPORT_MARGIN
+    _report_text(draw, (REPORT_MARGIN, y), title, 34, bold=True)
+    y += 48
+    if subtitle:
+        _report_text(draw, (REPORT_MARGIN, y), subtitle, 22, fill="#444444")
+        y += 34
+    draw.line((REPORT_MARGIN, y, REPORT_PAGE_SIZE[0] - REPORT_MARGIN, y), fill="#888888", width=2)
+    return img, draw, y + 20
+
+
+def _report_map(model, mode, cache=None, data=None):
+    """
+    Карта для режима mode (квадрат REPORT_MAP_SIZE) и результат mode_cell_styles.
+    При заданных cache и data (байты CSV) готовая карта берётся из кэша отрисовки.
+    """
+    from PIL import Image
+
+    result = mode_cell_styles(model.columns, mode, model.fuel_colors)
+    if result is None:
+        return None, None
+    key = None
+    if cache is not None and data is not None:
+        key = render_cache_key(data, {
+            "report": REPORT_SCHEMA, "mode": mode, "size": REPORT_MAP_SIZE,
+            "colors": model.fuel_colors,
+        })
+        cached, _ = cache.get(key)
+        if cached is not None:
+            return Image.open(io.BytesIO(cached)), result
+    scene = model.scene(result[0], REPORT_MAP_SIZE, REPORT_MAP_SIZE)
+    img = render_scene(scene)
+    if key is not None:
+        cache.put(key, encode_image(img, "PNG"))
+    return img, result
+
+
+def _report_map_page(model, mode, cache=None, data=None):
+    """Страница с картой режима и легендой: типы ТВС или шкала градиента."""
+    import numpy as np
+
+    img, draw, y = _report_page(model.name or "Картограмма", mode)
+    picture, result = _report_map(model, mode, cache, data)
+    if picture is None:
+        _report_text(draw, (REPORT_MARGIN, y), "Нет значений для градиента.", 24)
+        return img
+    x = (REPORT_PAGE_SIZE[0] - REPORT_MAP_SIZE) // 2
+    img.paste(picture, (x, y))
+    y += REPORT_MAP_SIZE + 30
+
+    _, dist, center, swing = result
+    if dist is None:
+        types = model.columns.fuel_type
+        counts = np.bincount(types[types >= 0], minlength=len(model.fuel_types))
+        col_x = REPORT_MARGIN
+        top = y
+        for type_id, ft in enumerate(model.fuel_types):
+            if type_id >= counts.size or not counts[type_id]:
+                continue
+            draw.rectangle((col_x, y, col_x + 28, y + 28), fill=ft["color"], outline="black")
+            _report_text(draw, (col_x + 40, y + 14), f"{type_id}: {ft['name']} — {counts[type_id]}", 20, anchor="lm")
+            y += 38
+            if y > REPORT_PAGE_SIZE[1] - REPORT_MARGIN - 38:
+                y = top
+                col_x += (REPORT_PAGE_SIZE[0] - 2 * REPORT_MARGIN) // 2
+        return img
+
+    # шкала градиента: центр ± размах
+    bar_w = REPORT_PAGE_SIZE[0] - 2 * REPORT_MARGIN
+    for i in range(bar_w):
+        v = center - swing + 2.0 * swing * i / max(bar_w - 1, 1)
+        draw.line((REPORT_MARGIN + i, y, REPORT_MARGIN + i, y + 36), fill=gradient_color(v, center, swing))
+    draw.rectangle((REPORT_MARGIN, y, REPORT_MARGIN + bar_w, y + 36), outline="black")
+    y += 44
+    for frac, anchor in ((0.0, "la"), (0.5, "ma"), (1.0, "ra")):
+        v = center - swing + 2.0 * swing * frac
+        _report_text(draw, (REPORT_MARGIN + bar_w * frac, y), f"{v:.4f}", 20, anchor=anchor)
+    y += 40
+    _report_text(
+        draw, (REPORT_MARGIN, y),
+        f"N={dist.n}; mean={dist.mean:.5f}; σ={dist.std:.5f}; "
+        f"min={dist.min:.5f}; max={dist.max:.5f}",
+        20,
+    )
+    return img
+
+
+def _report_table_pages(title, subtitle, headers, rows, aligns):
+    """
+    Таблица на одной или нескольких страницах; rows — списки строк-ячеек,
+    aligns — "l" / "r" по столбцам. Ширина столбцов — по самому длинному
+    тексту; не помещается на страницу — шрифт уменьшается.
+    """
+    from PIL import Image, ImageDraw
+
+    width = REPORT_PAGE_SIZE[0] - 2 * REPORT_MARGIN
+    size = 18
+    measure = ImageDraw.Draw(Image.new("RGB", (1, 1)))
+    col_w = [
+        max(measure.textlength(str(text), font=_scene_font(size, True)) for text in column) + 16
+        for column in zip(headers, *rows)
+    ]
+    if sum(col_w) > width:
+        scale = width / sum(col_w)
+        size = max(8, int(size * scale))
+        col_w = [w * scale for w in col_w]
+    col_w = [w + (width - sum(col_w)) / len(col_w) for w in col_w]
+    lefts = [REPORT_MARGIN + sum(col_w[:i]) for i in range(len(col_w))]
+
+    def put(draw, y, texts, bold=False):
+        for text, x, w, align in zip(texts, lefts, col_w, aligns):
+            if align == "l":
+                _report_text(draw, (x + 6, y), text, size, bold)
+            else:
+                _report_text(draw, (x + w - 6, y), text, size, bold, anchor="ra")
+
+    pages = []
+    chunks = [rows[i:i + REPORT_TABLE_ROWS] for i in range(0, len(rows), REPORT_TABLE_ROWS)] or [[]]
+    for n, chunk in enumerate(chunks):
+        page_title = title if len(chunks) == 1 else f"{title} ({n + 1}/{len(chunks)})"
+        img, draw, y = _report_page(page_title, subtitle)
+        put(draw, y, headers, bold=True)
+        y += 30
+        draw.line((REPORT_MARGIN, y, REPORT_MARGIN + width, y), fill="black")
+        y += 6
+        for k, row in enumerate(chunk):
+            if k % 2:
+                draw.rectangle((REPORT_MARGIN, y - 2, REPORT_MARGIN + width, y + 28), fill="#F2F2F2")
+            put(draw, y, row)
+            y += 30
+        pages.append(img)
+    return pages
+
+
+def _report_number(v, digits=5):
+    return "—" if v is None or (isinstance(v, float) and math.isnan(v)) else f"{v:.{digits}f}"
+
+
+def report_pages(model, cache=None, data=None, job=None):
+    """
+    Страницы отчёта (изображения Pillow): карты REPORT_MAP_MODES, статистика
+    по типам ТВС (как в сводке по типам) и сводка по кольцам.
+    """
+    n_types = len(model.fuel_types)
+    steps = len(REPORT_MAP_MODES) + 2
+    pages = []
+    for i, mode in enumerate(REPORT_MAP_MODES):
+        if job is not None:
+            job.progress(i / steps, mode)
+        pages.append(_report_map_page(model, mode, cache, data))
+
+    if job is not None:
+        job.progress(len(REPORT_MAP_MODES) / steps, "статистика по типам")
+    rows = []
+    for type_id, metric, st in TypeAggregates(model.columns, n_types).table_rows():
+        row = dict(st, type=type_id, name=model.fuel_types[type_id]["name"], metric=metric)
+        rows.append([
+            str(row[key]) if key in ("type", "name", "metric", "count") else _report_number(row[key])
+            for key, _ in REPORT_TYPE_COLUMNS
+        ])
+    pages += _report_table_pages(
+        "Статистика по типам ТВС", model.name,
+        [title for _, title in REPORT_TYPE_COLUMNS], rows,
+        ["l" if key in ("name", "metric") else "r" for key, _ in REPORT_TYPE_COLUMNS],
+    )
+
+    if job is not None:
+        job.progress((len(REPORT_MAP_MODES) + 1) / steps, "сводка по кольцам")
+    rows = []
+    for row in ZoneAggregates(model.columns, "Кольца", n_types).table_rows():
+        content = " ".join(
+            f"{t}:{row[f'type_{t}']}" for t in range(n_types) if row[f"type_{t}"]
+        )
+        rows.append(
+            [str(row["zone"]), str(row["count"])]
+            + [_report_number(row[f"mean_{f}"]) for f in MASS_FIELDS]
+            + [_report_number(row["sum_mass_fuel"], 2), content]
+        )
+    pages += _report_table_pages(
+        "Сводка по кольцам", model.name,
+        ["Кольцо", "N", "mean m_топл", "mean m_бор", "mean m_Gd", "Σ m_топл", "Типы (тип:N)"],
+        rows, "rrrrrrl",
+    )
+    return pages
+
+
+def write_report_pdf(filename, pages, job=None):
+    """Записать страницы одним многостраничным PDF (Pillow), через временный файл."""
+    with atomic_output(filename) as tmp:
+        if job is not None:
+            job.progress(0.95, "PDF")
+        pages[0].save(
+            tmp, "PDF", save_all=True, append_images=pages[1:], resolution=REPORT_DPI
+        )
+        if job is not None:
+            job.check()
+
+
+def write_model_report(filename, model, job=None):
+    """Отчёт по картограмме, уже загруженной в память (без кэша отрисовки)."""
+    write_report_pdf(filename, report_pages(model, job=job), job)
+
+
+_REPORT_MODELS = OrderedDict()
+_REPORT_CACHES = {}
+
+
+def _report_worker(path, out_file, fuel_types, cache_dir):
+    """
+    Отчёт по одному CSV в процессе-обработчике. Разобранные картограммы
+    (по пути, времени изменения и размеру) и кэш отрисовки живут в процессе
+    между задачами; карты кэшируются ещё и на диске, общем для всех процессов.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    key = (os.path.realpath(path), file_signature(path), tuple(
+        (ft["name"], ft["color"]) for ft in fuel_types
+    ))
+    model = _REPORT_MODELS.get(key)
+    if model is None:
+        rows = parse_cartogram_csv(data.decode("utf-8-sig").splitlines())
+        name = os.path.splitext(os.path.basename(path))[0]
+        model = CartogramModel.from_rows(rows, fuel_types, name)
+        _REPORT_MODELS[key] = model
+        while len(_REPORT_MODELS) > REPORT_MODEL_CACHE:
+            _REPORT_MODELS.popitem(last=False)
+    else:
+        _REPORT_MODELS.move_to_end(key)
+
+    cache = None
+    if cache_dir:
+        cache = _REPORT_CACHES.get(cache_dir)
+        if cache is None:
+            cache = _REPORT_CACHES[cache_dir] = RenderCache(cache_dir)
+    pages = report_pages(model, cache, data)
+    write_report_pdf(out_file, pages)
+    return out_file, len(pages)
+
+
+def report_sources(paths):
+    """CSV для пакетного отчёта: файлы как есть, из каталогов — все *.csv по имени."""
+    sources = []
+    for path in paths:
+        if os.path.isdir(path):
+            sources += sorted(
+                os.path.join(path, name) for name in os.listdir(path)
+                if name.lower().endswith(".csv")
+            )
+        else:
+            sources.append(path)
+    return sources
+
+
+def report_batch(paths, out_dir, fuel_types=None, cache_dir=None, workers=None, job=None):
+    """
+    Отчёты PDF по всем CSV из paths (файлы и каталоги) в out_dir — по файлу
+    <имя>.pdf, параллельно в процессах. Возвращает (готовые PDF, [(CSV, ошибка)]).
+    При отмене ещё не начатые задачи снимаются, JobCancelled.
+    """
+    types = [dict(ft) for ft in (fuel_types or DEFAULT_FUEL_TYPES)]
+    sources = report_sources(paths)
+    os.makedirs(out_dir, exist_ok=True)
+    done_files = []
+    failed = []
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_render_worker_init,
+    ) as pool:
+        futures = {
+            pool.submit(
+                _report_worker, path,
+                os.path.join(out_dir, os.path.splitext(os.path.basename(path))[0] + ".pdf"),
+                types, cache_dir,
+            ): path
+            for path in sources
+        }
+        pending = set(futures)
+        try:
+            while pending:
+                finished, pending = wait(
+                    pending, timeout=JOB_POLL_MS / 1000.0, return_when=FIRST_COMPLETED
+                )
+                for future in finished:
+                    try:
+                        done_files.append(future.result()[0])
+                    except Exception as e:
+                        failed.append((futures[future], e))
+                if job is not None:
+                    n = len(futures) - len(pending)
+                    job.progress(n / max(len(futures), 1), f"{n} из {len(futures)}")
+        except JobCancelled:
+            for future in futures:
+                future.cancel()
+            raise
+    return done_files, failed
+
+
+def report_main(args):
+    """Пакетные отчёты из командной строки (--report КАТАЛОГ CSV/каталоги...)."""
+    if not args.csv:
+        print("Укажите CSV или каталоги с CSV для отчётов.", file=sys.stderr)
+        return 2
+    cache_dir = args.cache_dir or default_render_cache_dir()
+    t0 = time.perf_counter()
+    done_files, failed = report_batch(args.csv, args.report, cache_dir=cache_dir, workers=args.workers)
+    for path, error in failed:
+        print(f"{path}: {error}", file=sys.stderr)
+    print(f"Отчётов: {len(done_files)} в {args.report}, ошибок: {len(failed)}, "
+          f"{time.perf_counter() - t0:.1f} с")
+    return 1 if failed else 0
+
 
 class CoreMapGUI:
-    def __init__(self, master):
+    def __init__(self, master, initial_csv=None, startup_timing=False, workspace=None):
         self.master = master
         master.title("Картограмма активной зоны (гекса + круги)")
 
@@ -80,9 +4273,55 @@ class CoreMapGUI:
         self.current_fuel_var = tk.IntVar(value=1)    # текущий тип ТВС
         self.pipette_mode_var = tk.BooleanVar(value=False)  # режим пипетки
 
+        # История правок текущей картограммы (строки CellColumns, а не id фигур —
+        # переживает перестроение Canvas при зуме и повороте)
+        self.history = EditHistory()
+        self._undo_button = None
+        self._redo_button = None
+
+        # Инструменты выделения / кисти; выделение — номера строк CellColumns
+        self.tool_var = tk.StringVar(value=TOOL_EDIT)
+        self.select_ring_var = tk.IntVar(value=1)
+        self.selection_var = tk.StringVar(value="Выделено: 0")
+        self.selected_rows = set()
+        self._row_centres = []      # центры фигур по строкам без сдвига панорамирования
+        self._spatial_index = None  # CellSpatialIndex по _row_centres (лениво)
+        self._tool_state = None     # текущий жест: кисть / рамка / лассо
+
+        # Растровый режим: вся картограмма — одно изображение на Canvas (рисуется
+        # в фоне), векторные фигуры — только под курсором и для выделенных ячеек
+        self.raster_view_var = tk.BooleanVar(value=False)
+        self._raster_mode = False   # режим, в котором построен Canvas
+        self._raster_item = None
+        self._raster_image = None   # tk.PhotoImage (ссылка, иначе изображение пропадёт)
+        self._raster_after = None
+        self._raster_future = None
+        self._raster_pending = False
+        self._raster_token = 0      # номер построения Canvas, для которого рисуется растр
+        self._raster_model = None   # (версия данных, CartogramModel)
+        self._raster_pool = None
+        self._hover_row = -1
+
+        # Обзорная миникарта: миниатюра перерисовывается только при смене окраски
+        self._minimap_image = None
+        self._minimap_item = None
+        self._minimap_key = None
+        self._minimap_after = None
+        self._minimap_future = None
+        self._minimap_pending = False
+        self._minimap_drag = None
+
         # Режим окраски (для градиента)
         self.coloring_mode_var = tk.StringVar(value="По типам ТВС")
 
+        # Масштабирование градиента
+        self.gradient_scaling_var = tk.StringVar(value=SCALING_MEAN_MAX)
+        self.gradient_k_var = tk.DoubleVar(value=2.0)
+        self.gradient_fixed_min_var = tk.StringVar(value="")
+        self.gradient_fixed_max_var = tk.StringVar(value="")
+        self.gradient_q_low_var = tk.DoubleVar(value=0.05)
+        self.gradient_q_high_var = tk.DoubleVar(value=0.95)
+
         # Текстовые поля для статистики масс по выбранному типу
         self.stats_text_fuel = tk.StringVar(value="m_топл: данных нет")
         self.stats_text_abs = tk.StringVar(value="m_погл: данных нет")
@@ -98,12 +4337,149 @@ class CoreMapGUI:
         # Подсветка поиска
         self.highlighted_cells = set()
 
+        # Запросы по атрибутам: текст -> разобранный CellQuery
+        self._query_cache = {}
+        self.query_result_var = tk.StringVar(value="")
+
+        # Вычисляемые столбцы: имя -> ComputedColumn (окраска и сводка по типам)
+        self.computed_columns = {}
+        self.computed_list_var = tk.StringVar(value="")
+
+        # Сравнение с другой картограммой (предыдущий цикл)
+        self.diff_base_cells = None      # ячейки картограммы для сравнения
+        self.diff_base_name = ""
+        self._diff_token = 0             # меняется при загрузке другой картограммы
+        self._diff_cache = None          # ((версия, token), CartogramDiff)
+        self._diff_arrows_key = None
+        self.show_diff_arrows_var = tk.BooleanVar(value=True)
+        self.diff_summary_var = tk.StringVar(value="Сравнение не загружено")
+
+        # Версия данных ячеек: меняется при любой правке/загрузке, по ней
+        # инвалидируются столбцовые массивы и агрегаты
+        self._data_version = 0
+        self._version_counter = itertools.count(1)
+        self._columns_cache = None          # (версия, CellColumns)
+        self._type_aggregates_cache = None  # ((версия, число типов), TypeAggregates)
+        self._zone_aggregates_cache = {}    # кольца/секторы -> ((версия, число типов), ZoneAggregates)
+        self._distribution_cache = {}       # (версия, поле, тип|None) -> ValueDistribution
+
+        # LRU раскрасок: ключ режима -> (стили по строкам, распределение, центр, размах)
+        self._coloring_cache = OrderedDict()
+        # Что сейчас нарисовано на Canvas (стиль по строкам) — для применения разницы
+        self._applied_styles = None
+        # Строка CellColumns -> id фигуры / id нижней метки на Canvas (и обратно)
+        self._row_cids = []
+        self._row_label_ids = []
+        self._cid_row = {}
+
+        # Окно сводной таблицы по типам (если открыто)
+        self.summary_window = None
+        self.summary_tree = None
+        self._summary_sort = ("type", False)
+
+        # Окно анализа симметрии (если открыто)
+        self.symmetry_window = None
+        self.symmetry_group_var = tk.StringVar(value=next(iter(SYMMETRY_GROUPS)))
+        self.symmetry_field_var = tk.StringVar(value=MASS_FIELDS[0])
+        self.symmetry_result_var = tk.StringVar(value="")
+        self._symmetry_trees = None
+
+        # Окно агрегатов по кольцам и секторам (если открыто)
+        self.zone_window = None
+        self.zone_kind_var = tk.StringVar(value=next(iter(ZONE_KINDS)))
+        self.zone_chart_var = tk.StringVar(value=next(iter(self.ZONE_CHART_VALUES)))
+        self._zone_tree = None
+        self._zone_chart = None
+
+        # Матрица вариантов экспорта: повороты × режимы окраски
+        self.matrix_window = None
+        self.matrix_rotation_vars = {
+            rotation: tk.BooleanVar(value=rotation % 90 == 0) for rotation in MATRIX_ROTATIONS
+        }
+        self.matrix_size_var = tk.IntVar(value=MATRIX_DEFAULT_SIZE)
+        self._matrix_modes_list = None
+
+        # Архив картограмм по циклам (SQLite) и раскраска по результату запроса
+        self.fleet_store = None
+        self.fleet_window = None
+        self.fleet_query_var = tk.StringVar(value=next(iter(FLEET_QUERIES)))
+        self.fleet_arg_var = tk.StringVar(value="")
+        self.fleet_type_var = tk.StringVar(value="")
+        self.fleet_last_var = tk.IntVar(value=0)
+        self.fleet_status_var = tk.StringVar(value="Архив не открыт")
+        self.fleet_result_var = tk.StringVar(value="")
+        self._fleet_tree = None
+        self._fleet_type_combo = None
+        self._fleet_source = None       # ("position", (q, r, счётчики)) | ("assembly", {номер: счётчик})
+        self._fleet_token = 0           # меняется с каждым запросом
+
+        # Набор картограмм (циклы) с LRU разобранных моделей и предзагрузкой соседних
+        self.workspace_paths = []
+        self.workspace_pos = -1
+        self.workspace_cache = WorkspaceCache()
+        self.workspace_label_var = tk.StringVar(value="Набор не открыт")
+        self._prefetch_pool = None
+        self._prefetch_futures = {}
+
+        # Журнал правок открытого CSV (восстановление после сбоя) и фоновое сохранение
+        self.document_path = None       # CSV, с которым связан журнал
+        self.journal = None             # EditJournal или None
+        self._unsaved_edits = False     # есть правки после загрузки / сохранения
+        # (строка, поле) правленые после загрузки / сохранения; None — неизвестно
+        # какие (правки восстановлены или перенесены из набора)
+        self._local_edits = set()
+        self.journal_status_var = tk.StringVar(value="Журнал правок: не ведётся")
+        self._io_pool = None            # поток записи файлов
+        self._save_future = None
+        self._export_pool = None        # потоки фонового экспорта изображений
+
+        # Слежение за открытым CSV: изменения на диске применяются к показанной картограмме
+        self.watch_var = tk.BooleanVar(value=False)
+        self.watch_status_var = tk.StringVar(value="")
+        self._watch_after = None
+        self._watch_signature = None    # подпись показанной версии файла
+        self._watch_pending = None      # новая подпись, ждущая конца записи файла
+        self._watch_future = None
+        self._jobs = {}                 # BackgroundJob -> строка панели фоновых задач
+
+        # Проверка данных: при загрузке и перед сохранением
+        self.validation_findings = []
+        self.validation_rows = []       # строки, отмеченные на Canvas кольцами (метка "validation")
+        self.validation_status_var = tk.StringVar(value="")
+        self.validation_window = None
+        self.validation_tree = None
+
+        # Запуск: сначала показываем окно, затем строим решётку (или грузим CSV)
+        self._initial_csv = initial_csv
+        self._initial_workspace = list(workspace or [])
+        self._startup_timing = startup_timing
+
         self._build_widgets()
-        self.build_default_full_lattice()
-        self.update_fuel_type_combo()
-        self.build_legend()
-        self.apply_coloring_mode()
-        self.update_mass_stats_for_selected_type()
+        self.master.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.master.after(STARTUP_DEFER_MS, self._finish_startup)
+
+    def _finish_startup(self):
+        """Отложенная часть запуска: решётка по умолчанию или CSV из командной строки."""
+        t_frame = time.perf_counter()
+        self.master.update_idletasks()
+
+        loaded = False
+        if self._initial_workspace:
+            loaded = self.open_workspace(self._initial_workspace)
+        elif self._initial_csv:
+            loaded = self.load_from_csv(self._initial_csv, notify=False)
+        if not loaded:
+            self.build_default_full_lattice()
+
+        if self._startup_timing:
+            t_ready = time.perf_counter()
+            print(
+                f"Первый кадр: {(t_frame - _PROCESS_T0) * 1000:.0f} мс; "
+                f"готово: {(t_ready - _PROCESS_T0) * 1000:.0f} мс "
+                f"(ячеек: {len(self.cells)})",
+                file=sys.stderr
+            )
+            self.master.after_idle(self.master.destroy)
 
     # ---------- Типы ТВС ----------
 
@@ -113,57 +4489,11 @@ class CoreMapGUI:
 
     @staticmethod
     def _auto_color_for_index(idx: int) -> str:
-        if idx == 0:
-            return "#FFFFFF"
-        palette = [
-            "#FFCC00", "#66CCFF", "#FF6666", "#99CC00",
-            "#CC99FF", "#FF9966", "#00CC99", "#9999FF",
-            "#CCCCCC", "#FFCCFF",
-        ]
-        return palette[(idx - 1) % len(palette)]
+        return auto_type_color(idx)
 
     def get_or_create_fuel_type_index(self, type_label: str) -> int:
-        """
-        Преобразует текстовый ярлык типа ТВС (например, 'ОМ-1' или 'ПЗ-2')
-        во внутренний индекс fuel_type. Если такого типа ещё нет в self.fuel_types,
-        он создаётся с автоматически подобранным цветом.
-
-        Поддерживает старый формат, когда в CSV в fuel_type записывался просто индекс.
-        """
-        if type_label is None:
-            type_label = ""
-        name = str(type_label).strip()
-
-        # Пустое поле считаем "Пусто"
-        if not name:
-            name = "Пусто"
-
-        # СТАРЫЙ ФОРМАТ: если поле целочисленное — трактуем его как индекс
-        if name.isdigit():
-            idx = int(name)
-            # расширяем список типов до нужного индекса
-            while len(self.fuel_types) <= idx:
-                j = len(self.fuel_types)
-                self.fuel_types.append({
-                    "name": f"Тип {j}",
-                    "color": self._auto_color_for_index(j),
-                })
-            return idx
-
-        # НОВЫЙ ФОРМАТ: строковое имя типа ('ОМ-1', 'ПЗ-2', ...)
-        # ищем существующий тип с таким именем
-        for idx, ft in enumerate(self.fuel_types):
-            if ft["name"] == name:
-                return idx
-
-        # если не нашли — создаём новый тип
-        new_idx = len(self.fuel_types)
-        self.fuel_types.append({
-            "name": name,
-            "color": self._auto_color_for_index(new_idx),
-        })
-        return new_idx
-
+        """Внутренний индекс типа ТВС по ярлыку из CSV (новый тип создаётся, см. fuel_type_index)."""
+        return fuel_type_index(self.fuel_types, type_label)
 
     def reset_default_fuel_types(self):
         self.fuel_types = self.make_default_fuel_types()
@@ -188,6 +4518,21 @@ class CoreMapGUI:
             command=self.add_new_type
         ).pack(anchor="w", pady=(5, 0))
 
+        ttk.Label(legend_panel, text="Обзор").pack(anchor="w", pady=(10, 0))
+        scale = self._minimap_scale()
+        self.minimap_canvas = tk.Canvas(
+            legend_panel,
+            width=round(self.canvas_width * scale),
+            height=round(self.canvas_height * scale),
+            bg="white",
+            highlightthickness=1,
+            highlightbackground="#999999",
+        )
+        self.minimap_canvas.pack(anchor="w", pady=(2, 0))
+        self.minimap_canvas.bind("<ButtonPress-1>", self.on_minimap_press)
+        self.minimap_canvas.bind("<B1-Motion>", self.on_minimap_drag)
+        self.minimap_canvas.bind("<ButtonRelease-1>", self.on_minimap_release)
+
         # -------- Центральная область: Canvas --------
         self.canvas = tk.Canvas(
             main_frame,
@@ -270,6 +4615,65 @@ class CoreMapGUI:
             text="Сохранить картограмму (CSV)",
             command=self.save_to_csv
         ).pack(fill="x", pady=2)
+        ttk.Label(
+            control, textvariable=self.journal_status_var,
+            foreground="#666666", wraplength=260
+        ).pack(anchor="w")
+
+        ttk.Checkbutton(
+            control,
+            text="Следить за изменениями файла",
+            variable=self.watch_var,
+            command=self.toggle_watch
+        ).pack(anchor="w")
+        ttk.Label(
+            control, textvariable=self.watch_status_var,
+            foreground="#666666", wraplength=260
+        ).pack(anchor="w")
+
+        ttk.Button(
+            control,
+            text="Импорт паспортов ТВС (CSV)…",
+            command=self.import_passports
+        ).pack(fill="x", pady=2)
+
+        ttk.Button(
+            control,
+            text="Проверка данных…",
+            command=self.show_validation
+        ).pack(fill="x", pady=2)
+        ttk.Label(
+            control, textvariable=self.validation_status_var,
+            foreground="#666666", wraplength=260
+        ).pack(anchor="w")
+
+        # --- Набор картограмм (циклы) ---
+        ttk.Label(control, text="Набор картограмм (циклы):").pack(anchor="w")
+        ws_frame = ttk.Frame(control)
+        ws_frame.pack(anchor="w", pady=(2, 2))
+        ttk.Button(
+            ws_frame,
+            text="Открыть набор…",
+            command=self.open_workspace
+        ).pack(side="left", padx=(0, 4))
+        ttk.Button(
+            ws_frame,
+            text="◀",
+            width=3,
+            command=lambda: self.step_workspace(-1)
+        ).pack(side="left", padx=(0, 2))
+        ttk.Button(
+            ws_frame,
+            text="▶",
+            width=3,
+            command=lambda: self.step_workspace(1)
+        ).pack(side="left")
+        ttk.Label(
+            control,
+            textvariable=self.workspace_label_var,
+            wraplength=260,
+            justify="left"
+        ).pack(anchor="w", pady=(0, 2))
 
         ttk.Separator(control, orient=tk.HORIZONTAL).pack(fill="x", pady=5)
 
@@ -320,25 +4724,44 @@ class CoreMapGUI:
             control,
             text="Экспорт изображения",
             command=self.export_image
-        ).pack(fill="x", pady=(0, 10))
+        ).pack(fill="x", pady=(0, 5))
+
+        ttk.Button(
+            control,
+            text="Плакат высокого разрешения…",
+            command=self.export_poster
+        ).pack(fill="x", pady=(0, 5))
+
+        ttk.Button(
+            control,
+            text="Матрица вариантов…",
+            command=self.show_export_matrix
+        ).pack(fill="x", pady=(0, 5))
+
+        ttk.Button(
+            control,
+            text="Отчёт PDF…",
+            command=self.export_report
+        ).pack(fill="x", pady=(0, 5))
+
+        ttk.Button(
+            control,
+            text="Отчёты PDF по каталогу…",
+            command=self.export_report_batch
+        ).pack(fill="x", pady=(0, 5))
+
+        # фоновые экспорт и сохранение: прогресс и отмена, по строке на задачу
+        self.jobs_frame = ttk.Frame(control)
+        self.jobs_frame.pack(fill="x", pady=(0, 5))
 
         ttk.Separator(control, orient=tk.HORIZONTAL).pack(fill="x", pady=5)
 
         # --- Режим окраски (градиент) ---
         ttk.Label(control, text="Режим окраски картограммы:").pack(anchor="w")
-        color_modes = [
-            "По типам ТВС",
-            "Градиент m_топл (все)",
-            "Градиент m_бор (все)",
-            "Градиент m_гадолиний (все)",
-            "Градиент m_топл (выбранный тип)",
-            "Градиент m_бор (выбранный тип)",
-            "Градиент m_гадолиний (выбранный тип)",
-        ]
         self.color_mode_combo = ttk.Combobox(
             control,
             textvariable=self.coloring_mode_var,
-            values=color_modes,
+            values=COLOR_MODES,
             state="readonly",
             width=30
         )
@@ -350,6 +4773,88 @@ class CoreMapGUI:
 
         self.color_mode_combo.bind("<<ComboboxSelected>>", on_color_mode_change)
 
+        # --- Вычисляемые столбцы ---
+        ttk.Label(
+            control,
+            text="Вычисляемый столбец (имя = выражение,\nнапр. ratio = m_топл / (nz(m_b) + nz(m_gd))):"
+        ).pack(anchor="w")
+        self.computed_entry = ttk.Entry(control, width=34)
+        self.computed_entry.pack(anchor="w", pady=(0, 2))
+        self.computed_entry.bind("<Return>", lambda e: self.add_computed_column())
+
+        computed_btn_frame = ttk.Frame(control)
+        computed_btn_frame.pack(anchor="w", pady=(0, 2))
+        ttk.Button(
+            computed_btn_frame,
+            text="Добавить",
+            command=self.add_computed_column
+        ).pack(side="left", padx=(0, 4))
+        ttk.Button(
+            computed_btn_frame,
+            text="Удалить",
+            command=self.remove_computed_column
+        ).pack(side="left")
+        ttk.Label(
+            control,
+            textvariable=self.computed_list_var,
+            wraplength=260,
+            justify="left"
+        ).pack(anchor="w", pady=(0, 4))
+
+        # --- Масштабирование градиента ---
+        ttk.Label(control, text="Масштаб градиента:").pack(anchor="w")
+        scaling_combo = ttk.Combobox(
+            control,
+            textvariable=self.gradient_scaling_var,
+            values=SCALING_MODES,
+            state="readonly",
+            width=30
+        )
+        scaling_combo.pack(anchor="w", pady=(0, 2))
+        scaling_combo.bind("<<ComboboxSelected>>", lambda e: self.apply_coloring_mode())
+
+        scaling_frame = ttk.Frame(control)
+        scaling_frame.pack(anchor="w", pady=(0, 2))
+        ttk.Label(scaling_frame, text="k:").grid(row=0, column=0, sticky="e")
+        ttk.Spinbox(
+            scaling_frame,
+            from_=0.5,
+            to=10.0,
+            increment=0.5,
+            textvariable=self.gradient_k_var,
+            width=5,
+            command=self.apply_coloring_mode
+        ).grid(row=0, column=1, sticky="w", padx=(2, 8))
+
+        ttk.Label(scaling_frame, text="квантили:").grid(row=0, column=2, sticky="e")
+        for col, var in ((3, self.gradient_q_low_var), (4, self.gradient_q_high_var)):
+            ttk.Spinbox(
+                scaling_frame,
+                from_=0.0,
+                to=1.0,
+                increment=0.01,
+                textvariable=var,
+                width=5,
+                command=self.apply_coloring_mode
+            ).grid(row=0, column=col, sticky="w", padx=(2, 0))
+
+        ttk.Label(scaling_frame, text="диапазон:").grid(row=1, column=0, columnspan=3, sticky="e")
+        for col, var in ((3, self.gradient_fixed_min_var), (4, self.gradient_fixed_max_var)):
+            entry = ttk.Entry(scaling_frame, textvariable=var, width=7)
+            entry.grid(row=1, column=col, sticky="w", padx=(2, 0), pady=(2, 0))
+            entry.bind("<Return>", lambda e: self.apply_coloring_mode())
+
+        # Цветовая шкала с гистограммой распределения
+        self.hist_canvas = tk.Canvas(
+            control,
+            width=260,
+            height=70,
+            bg="white",
+            highlightthickness=1,
+            highlightbackground="#CCCCCC"
+        )
+        self.hist_canvas.pack(anchor="w", pady=(2, 4))
+
         # --- Статистика по массам для выбранного типа ---
         ttk.Label(
             control,
@@ -370,6 +4875,30 @@ class CoreMapGUI:
             justify="left"
         ).pack(anchor="w", pady=(0, 4))
 
+        ttk.Button(
+            control,
+            text="Сводка по всем типам…",
+            command=self.show_type_summary
+        ).pack(fill="x", pady=(0, 4))
+
+        ttk.Button(
+            control,
+            text="Анализ симметрии…",
+            command=self.show_symmetry_analysis
+        ).pack(fill="x", pady=(0, 4))
+
+        ttk.Button(
+            control,
+            text="Кольца и секторы…",
+            command=self.show_zone_aggregates
+        ).pack(fill="x", pady=(0, 4))
+
+        ttk.Button(
+            control,
+            text="Архив циклов…",
+            command=self.show_fleet_store
+        ).pack(fill="x", pady=(0, 4))
+
         ttk.Separator(control, orient=tk.HORIZONTAL).pack(fill="x", pady=5)
 
         # --- Режим клика + пипетка ---
@@ -394,7 +4923,97 @@ class CoreMapGUI:
             control,
             text="Пипетка (копировать тип ТВС)",
             variable=self.pipette_mode_var
-        ).pack(anchor="w", pady=(4, 8))
+        ).pack(anchor="w", pady=(4, 4))
+
+        undo_frame = ttk.Frame(control)
+        undo_frame.pack(anchor="w", pady=(0, 8))
+        self._undo_button = ttk.Button(
+            undo_frame, text="↶ Отменить", command=self.undo, state="disabled"
+        )
+        self._undo_button.pack(side="left", padx=(0, 4))
+        self._redo_button = ttk.Button(
+            undo_frame, text="↷ Повторить", command=self.redo, state="disabled"
+        )
+        self._redo_button.pack(side="left")
+
+        # --- Инструменты: кисть и выделение ---
+        ttk.Label(control, text="Инструмент (ЛКМ):").pack(anchor="w")
+        for text, value in (
+            ("Правка ячейки (диалог)", TOOL_EDIT),
+            ("Кисть текущим типом ТВС", TOOL_BRUSH),
+            ("Выделение рамкой", TOOL_RECT),
+            ("Выделение лассо", TOOL_LASSO),
+        ):
+            ttk.Radiobutton(
+                control, text=text, variable=self.tool_var, value=value
+            ).pack(anchor="w")
+        ttk.Label(
+            control, text="Shift — добавить к выделению", foreground="#666666"
+        ).pack(anchor="w")
+
+        ring_frame = ttk.Frame(control)
+        ring_frame.pack(anchor="w", pady=(4, 2))
+        ttk.Label(ring_frame, text="Кольцо:").pack(side="left")
+        ttk.Spinbox(
+            ring_frame, from_=1, to=999, width=5, textvariable=self.select_ring_var
+        ).pack(side="left", padx=2)
+        ttk.Button(
+            ring_frame, text="Выделить", command=self.select_ring
+        ).pack(side="left", padx=2)
+
+        ttk.Button(
+            control,
+            text="Выделить все ТВС текущего типа",
+            command=self.select_current_type
+        ).pack(fill="x", pady=(0, 2))
+
+        selection_frame = ttk.Frame(control)
+        selection_frame.pack(anchor="w", pady=(0, 2))
+        ttk.Button(
+            selection_frame,
+            text="Назначить текущий тип",
+            command=self.assign_type_to_selection
+        ).pack(side="left", padx=(0, 4))
+        ttk.Button(
+            selection_frame,
+            text="Снять выделение",
+            command=self.clear_selection
+        ).pack(side="left")
+        ttk.Label(control, textvariable=self.selection_var).pack(anchor="w", pady=(0, 8))
+
+        ttk.Separator(control, orient=tk.HORIZONTAL).pack(fill="x", pady=5)
+
+        # --- Сравнение картограмм ---
+        ttk.Label(control, text="Сравнение с другой картограммой:").pack(anchor="w")
+        diff_btn_frame = ttk.Frame(control)
+        diff_btn_frame.pack(anchor="w", pady=(2, 2))
+        ttk.Button(
+            diff_btn_frame,
+            text="Сравнить с CSV…",
+            command=self.load_diff_base
+        ).pack(side="left", padx=(0, 4))
+        ttk.Button(
+            diff_btn_frame,
+            text="Сбросить",
+            command=self.clear_diff
+        ).pack(side="left")
+        ttk.Checkbutton(
+            control,
+            text="Стрелки перемещений",
+            variable=self.show_diff_arrows_var,
+            command=self.draw_diff_arrows
+        ).pack(anchor="w")
+        ttk.Label(
+            control,
+            textvariable=self.diff_summary_var,
+            wraplength=260,
+            justify="left"
+        ).pack(anchor="w")
+        ttk.Button(
+            control,
+            text="Экспорт таблицы различий…",
+            command=self.export_diff_csv
+        ).pack(fill="x", pady=(2, 4))
 
         ttk.Separator(control, orient=tk.HORIZONTAL).pack(fill="x", pady=5)
 
@@ -416,6 +5035,33 @@ class CoreMapGUI:
             command=self.search_by_factory
         ).pack(side="left")
 
+        ttk.Label(
+            control,
+            text="Запрос (напр. mass_fuel < 3050,\ntype = 7 AND m_gd > 0,\nring = 5 AND mass_boron IS MISSING):"
+        ).pack(anchor="w")
+        self.query_entry = ttk.Entry(control, width=34)
+        self.query_entry.pack(anchor="w", pady=(0, 2))
+        self.query_entry.bind("<Return>", lambda e: self.run_query())
+
+        query_btn_frame = ttk.Frame(control)
+        query_btn_frame.pack(anchor="w", pady=(0, 2))
+        ttk.Button(
+            query_btn_frame,
+            text="Выполнить",
+            command=self.run_query
+        ).pack(side="left", padx=(0, 4))
+        ttk.Button(
+            query_btn_frame,
+            text="Экспорт в CSV…",
+            command=self.export_query_csv
+        ).pack(side="left")
+        ttk.Label(
+            control,
+            textvariable=self.query_result_var,
+            wraplength=260,
+            justify="left"
+        ).pack(anchor="w", pady=(0, 8))
+
         ttk.Separator(control, orient=tk.HORIZONTAL).pack(fill="x", pady=5)
 
         # --- Поворот картограммы ---
@@ -452,6 +5098,13 @@ class CoreMapGUI:
             command=self.reset_rotation
         ).pack(anchor="w", pady=(0, 6))
 
+        ttk.Checkbutton(
+            control,
+            text="Растровый режим (большие зоны)",
+            variable=self.raster_view_var,
+            command=self.toggle_raster_view
+        ).pack(anchor="w", pady=(0, 6))
+
         ttk.Separator(control, orient=tk.HORIZONTAL).pack(fill="x", pady=5)
 
         # --- Подсказка по управлению ---
@@ -476,11 +5129,28 @@ class CoreMapGUI:
         self.canvas.bind("<ButtonPress-3>", self.on_drag_start)
         self.canvas.bind("<B3-Motion>", self.on_drag_move)
         self.canvas.bind("<Motion>", self.on_canvas_motion)
+        self.canvas.bind("<ButtonPress-1>", self.on_tool_press)
+        self.canvas.bind("<B1-Motion>", self.on_tool_move)
+        self.canvas.bind("<ButtonRelease-1>", self.on_tool_release)
         self.canvas.bind("<Leave>", self.on_canvas_leave)
 
+        # --- навигация по набору картограмм ---
+        for seq in ("<Prior>", "<Alt-Left>"):
+            self.master.bind(seq, lambda e: self.step_workspace(-1))
+        for seq in ("<Next>", "<Alt-Right>"):
+            self.master.bind(seq, lambda e: self.step_workspace(1))
+
+        # --- отмена / повтор (и в русской раскладке) ---
+        for seq in ("<Control-z>", "<Control-Z>", "<Control-Cyrillic_ya>"):
+            self.master.bind(seq, lambda e: self.undo())
+        for seq in ("<Control-y>", "<Control-Y>", "<Control-Cyrillic_en>"):
+            self.master.bind(seq, lambda e: self.redo())
+
     def update_fuel_type_combo(self):
         values = [f"{i}: {ft['name']}" for i, ft in enumerate(self.fuel_types)]
         self.fuel_combo["values"] = values
+        if self._fleet_type_combo is not None:
+            self._fleet_type_combo["values"] = [""] + [ft["name"] for ft in self.fuel_types]
         cur = self.current_fuel_var.get()
         if not values:
             return
@@ -546,10 +5216,9 @@ class CoreMapGUI:
             row["color_label"].config(bg=hex_color)
 
         # Если режим окраски "по типам" — сразу обновить картограмму
+        # (перекрашиваются только ячейки этого типа)
         if self.coloring_mode_var.get() == "По типам ТВС":
-            for canvas_id, cell in self.cells.items():
-                if cell["fuel_type"] == type_id:
-                    self.canvas.itemconfig(canvas_id, fill=hex_color)
+            self.apply_coloring_mode()
 
     def add_new_type(self):
         new_id = len(self.fuel_types)
@@ -619,6 +5288,11 @@ class CoreMapGUI:
     def build_default_full_lattice(self):
         rings = int(self.rings_var.get())
         axial_coords = self.generate_full_axial_coords(rings)
+        self._leave_workspace_item()
+        self._journal_detach()
+        self.document_path = None
+        self._unsaved_edits = False
+        self._local_edits = set()
 
         self.zoom_factor = 1.0
         self.pan_offset = (0.0, 0.0)
@@ -644,16 +5318,75 @@ class CoreMapGUI:
 
         self.build_from_cells_data(cells_data)
         self.update_fuel_type_combo()
-        self.build_legend()
-        self.apply_coloring_mode()
         self.update_mass_stats_for_selected_type()
 
     # ---------- Построение по списку ячеек ----------
 
-    def build_from_cells_data(self, cells_data):
+    def _create_cell_items(self, x, y, shape, fill, pos_label, label, outline="black", width=1,
+                           label_fill="black", tags=("cell",), text_tags=()):
+        """Фигура ячейки и две подписи на Canvas; возвращает их id."""
+        if shape == "circle":
+            radius = self.hex_size * 0.72
+            cell_id = self.canvas.create_oval(
+                x - radius,
+                y - radius,
+                x + radius,
+                y + radius,
+                outline=outline,
+                width=width,
+                fill=fill,
+                tags=tags
+            )
+        else:
+            points = self.hex_polygon_points(x, y, self.hex_size * 0.9)
+            cell_id = self.canvas.create_polygon(
+                points,
+                outline=outline,
+                width=width,
+                fill=fill,
+                tags=tags
+            )
+
+        dy = self.hex_size * 0.25
+
+        text_pos_id = self.canvas.create_text(
+            x,
+            y - dy,
+            text=str(pos_label),
+            font=self.font_pos,
+            tags=text_tags
+        )
+        text_factory_id = self.canvas.create_text(
+            x,
+            y + dy,
+            text=str(label) if label else "",
+            font=self.font_factory,
+            fill=label_fill,
+            tags=text_tags
+        )
+        return cell_id, text_pos_id, text_factory_id
+
+    def build_from_cells_data(self, cells_data, data_changed=True):
+        if data_changed:
+            self.mark_data_changed()
+            self.reset_history()
+            self.selected_rows = set()
+            self.selection_var.set("Выделено: 0")
+            self.validation_rows = []
         self.canvas.delete("all")
         self.cells.clear()
         self.highlighted_cells.clear()
+        self._row_cids = []
+        self._row_label_ids = []
+        self._cid_row = {}
+        self._applied_styles = None
+        self._row_centres = []
+        self._spatial_index = None
+        self._tool_state = None
+        self._raster_mode = bool(self.raster_view_var.get())
+        self._raster_item = None
+        self._raster_token += 1
+        self._hover_row = -1
 
         if not cells_data:
             return
@@ -666,53 +5399,19 @@ class CoreMapGUI:
                 "color": self._auto_color_for_index(idx)
             })
 
-        angle_rad = math.radians(self.rotation_angle_deg % 360)
-        cos_a = math.cos(angle_rad)
-        sin_a = math.sin(angle_rad)
-
-        raw_positions = []
-        for cell in cells_data:
-            x_raw, y_raw = self.axial_to_pixel(cell["q"], cell["r"], 1.0)
-            x_rot = x_raw * cos_a - y_raw * sin_a
-            y_rot = x_raw * sin_a + y_raw * cos_a
-            raw_positions.append((x_rot, y_rot))
-
-        xs = [p[0] for p in raw_positions]
-        ys = [p[1] for p in raw_positions]
-        min_x, max_x = min(xs), max(xs)
-        min_y, max_y = min(ys), max(ys)
-
-        width_centers_raw = max_x - min_x
-        height_centers_raw = max_y - min_y
-
-        hex_margin_raw = 1.2
-        width_raw = width_centers_raw + 2 * hex_margin_raw
-        height_raw = height_centers_raw + 2 * hex_margin_raw
-
-        pixel_margin = 20
-        available_width = self.canvas_width - 2 * pixel_margin
-        available_height = self.canvas_height - 2 * pixel_margin
-
-        scale_x = available_width / width_raw
-        scale_y = available_height / height_raw
-
-        self.base_hex_size = min(scale_x, scale_y)
-        self.hex_size = self.base_hex_size * self.zoom_factor
+        xs, ys, self.hex_size, self.base_hex_size = cell_layout(
+            [cell["q"] for cell in cells_data],
+            [cell["r"] for cell in cells_data],
+            self.rotation_angle_deg, self.canvas_width, self.canvas_height, self.zoom_factor
+        )
 
-        pos_size = max(6, int(self.hex_size * 0.35))
-        factory_size = max(5, int(self.hex_size * 0.28))
+        pos_size, factory_size = label_font_sizes(self.hex_size)
         self.font_pos = tkFont.Font(family="Arial", size=pos_size, weight="bold")
         self.font_factory = tkFont.Font(family="Arial", size=factory_size)
 
-        center_raw_x = (min_x + max_x) / 2.0
-        center_raw_y = (min_y + max_y) / 2.0
-
-        canvas_center_x = self.canvas_width / 2.0
-        canvas_center_y = self.canvas_height / 2.0
-
         pan_x, pan_y = self.pan_offset
 
-        for cell, (x_raw, y_raw) in zip(cells_data, raw_positions):
+        for cell, x_centre, y_centre in zip(cells_data, xs.tolist(), ys.tolist()):
             q = cell["q"]
             r = cell["r"]
             index = cell["index"]
@@ -727,48 +5426,21 @@ class CoreMapGUI:
             if fuel_type < 0 or fuel_type >= len(self.fuel_types):
                 fuel_type = 0
 
-            x = (x_raw - center_raw_x) * self.hex_size + canvas_center_x + pan_x
-            y = (y_raw - center_raw_y) * self.hex_size + canvas_center_y + pan_y
+            x = x_centre + pan_x
+            y = y_centre + pan_y
+            self._row_centres.append((x_centre, y_centre))
 
             base_color = self.fuel_types[fuel_type]["color"]
 
-            if shape == "circle":
-                radius = self.hex_size * 0.72
-                cell_id = self.canvas.create_oval(
-                    x - radius,
-                    y - radius,
-                    x + radius,
-                    y + radius,
-                    outline="black",
-                    width=1,
-                    fill=base_color,
-                    tags=("cell",)
-                )
+            if self._raster_mode:
+                # фигур нет: ключ ячейки — отрицательный номер, не id на Canvas
+                cell_id = -1 - len(self.cells)
+                text_pos_id = text_factory_id = None
             else:
-                points = self.hex_polygon_points(x, y, self.hex_size * 0.9)
-                cell_id = self.canvas.create_polygon(
-                    points,
-                    outline="black",
-                    width=1,
-                    fill=base_color,
-                    tags=("cell",)
+                cell_id, text_pos_id, text_factory_id = self._create_cell_items(
+                    x, y, shape, base_color, pos_label, factory_id
                 )
 
-            dy = self.hex_size * 0.25
-
-            text_pos_id = self.canvas.create_text(
-                x,
-                y - dy,
-                text=str(pos_label),
-                font=self.font_pos
-            )
-            text_factory_id = self.canvas.create_text(
-                x,
-                y + dy,
-                text=str(factory_id) if factory_id else "",
-                font=self.font_factory
-            )
-
             self.cells[cell_id] = {
                 "index": index,
                 "q": q,
@@ -783,18 +5455,41 @@ class CoreMapGUI:
                 "text_pos_id": text_pos_id,
                 "text_factory_id": text_factory_id,
             }
-
-        self.canvas.configure(scrollregion=self.canvas.bbox("all"))
+            if cell.get("extra"):
+                self.cells[cell_id]["extra"] = dict(cell["extra"])
+            if cell.get("shape_source") is not None:
+                self.cells[cell_id]["shape_source"] = cell["shape_source"]
+
+        self._diff_arrows_key = None
+        self._row_cids = list(self.cells)
+        self._row_label_ids = [cell["text_factory_id"] for cell in self.cells.values()]
+        self._cid_row = {cid: i for i, cid in enumerate(self._row_cids)}
+        # новые фигуры нарисованы цветами типов — раскраску применяем целиком
+        self._applied_styles = None
+
+        if self._raster_mode:
+            self.canvas.configure(scrollregion=(0, 0, self.canvas_width, self.canvas_height))
+        else:
+            self.canvas.configure(scrollregion=self.canvas.bbox("all"))
         self.canvas.tag_bind("cell", "<Button-1>", self.on_cell_click)
+        self._draw_minimap_viewport()
 
         self.recalculate_type_stats()
         self.build_legend()
         self.apply_coloring_mode()
         self.update_mass_stats_for_selected_type()
+        if self.selected_rows:
+            # строки при перестроении (зум, поворот) не меняются — выделение остаётся
+            self.highlight_cells(self._row_cids[row] for row in self.selected_rows)
+        self._draw_validation_marks()
 
     def _rebuild_from_current_state(self):
         if not self.cells:
             return
+        if self._raster_mode and self.raster_view_var.get():
+            # растровый режим: ячейки и их данные прежние — только новая раскладка
+            self._raster_relayout()
+            return
         cells_data = []
         for cell in self.cells.values():
             cells_data.append({
@@ -808,16 +5503,149 @@ class CoreMapGUI:
                 "mass_fuel": cell.get("mass_fuel", ""),
                 "mass_boron": cell.get("mass_boron", ""),
                 "mass_gd": cell.get("mass_gd", ""),
+                "extra": cell.get("extra"),
             })
-        cells_data.sort(key=lambda c: c["index"])
-        self.build_from_cells_data(cells_data)
+            if "shape_source" in cell:
+                cells_data[-1]["shape_source"] = cell["shape_source"]
+        # порядок ячеек сохраняется: строки CellColumns остаются действительными
+        self.build_from_cells_data(cells_data, data_changed=False)
+
+    # ---------- Версия данных и столбцовые массивы ----------
+
+    def mark_data_changed(self):
+        """
+        Отметить изменение данных ячеек (сбрасывает кэши массивов и агрегатов).
+        Номера версий не повторяются: к версии можно вернуться (набор картограмм),
+        не рискуя совпасть с чужими кэшами.
+        """
+        self._data_version = next(self._version_counter)
+
+    def get_columns(self):
+        """CellColumns для текущих данных (строится один раз на версию данных)."""
+        cache = self._columns_cache
+        if cache is None or cache[0] != self._data_version:
+            columns = CellColumns(self.cells.values())
+            if cache is not None:
+                # решётка обычно та же — соседи, кольца и секторы не пересчитываются
+                columns.adopt_geometry(cache[1])
+            cache = (self._data_version, columns)
+            self._columns_cache = cache
+        return cache[1]
+
+    def get_zone_aggregates(self, kind):
+        """Агрегаты по кольцам или секторам (кэш; при правке обновляются по строкам)."""
+        key = (self._data_version, len(self.fuel_types))
+        cache = self._zone_aggregates_cache.get(kind)
+        if cache is None or cache[0] != key:
+            cache = (key, ZoneAggregates(self.get_columns(), kind, len(self.fuel_types)))
+            self._zone_aggregates_cache[kind] = cache
+        return cache[1]
+
+    def apply_cell_changes(self, changes, record=True):
+        """
+        Применить правки ячеек [(id фигуры, поле, новое значение)] одним шагом.
+
+        Столбцовые массивы и агрегаты по зонам не строятся заново, а обновляются
+        только для изменённых строк. Возвращает фактические изменения
+        [(строка, поле, было, стало)]; при record они записываются в историю
+        одной транзакцией.
+        """
+        applied = []
+        for cid, field, value in changes:
+            cell = self.cells.get(cid)
+            if cell is None:
+                continue
+            old = cell.get(field, "")
+            if old == value:
+                continue
+            cell[field] = value
+            if field == "pos_label" and cell["text_pos_id"]:
+                self.canvas.itemconfigure(cell["text_pos_id"], text=value)
+            applied.append((self._cid_row[cid], field, old, value))
+        if not applied:
+            return applied
+        if record:
+            self.history.push(applied)
+            self._update_undo_buttons()
+        self._unsaved_edits = True
+        if self._local_edits is not None:
+            self._local_edits.update((row, field) for row, field, _, _ in applied)
+        self._journal_append(applied)
+
+        old_version = self._data_version
+        old_cache = self._columns_cache
+        self.mark_data_changed()
+        if old_cache is not None and old_cache[0] == old_version:
+            rows = sorted({row for row, _, _, _ in applied})
+            old_columns = old_cache[1]
+            new_columns = old_columns.with_rows_updated(
+                rows, [self.cells[self._row_cids[row]] for row in rows]
+            )
+            self._columns_cache = (self._data_version, new_columns)
+            n_types = len(self.fuel_types)
+            for kind, (key, aggregates) in list(self._zone_aggregates_cache.items()):
+                if key == (old_version, n_types):
+                    aggregates.update_rows(rows, old_columns, new_columns)
+                    self._zone_aggregates_cache[kind] = ((self._data_version, n_types), aggregates)
+
+        self.recalculate_type_stats()
+        self.apply_coloring_mode()
+        self.update_mass_stats_for_selected_type()
+        return applied
+
+    # ---------- Отмена / повтор ----------
+
+    def undo(self):
+        """Отменить последнюю транзакцию правок (перерисовываются только её ячейки)."""
+        deltas = self.history.pop_undo()
+        if deltas is not None:
+            self.apply_cell_changes(
+                [(self._row_cids[row], field, old) for row, field, old, _ in reversed(deltas)],
+                record=False,
+            )
+        self._update_undo_buttons()
+
+    def redo(self):
+        """Повторить отменённую транзакцию."""
+        deltas = self.history.pop_redo()
+        if deltas is not None:
+            self.apply_cell_changes(
+                [(self._row_cids[row], field, new) for row, field, _, new in deltas],
+                record=False,
+            )
+        self._update_undo_buttons()
+
+    def reset_history(self):
+        """Забыть историю (загружена другая картограмма или другой элемент набора)."""
+        self.history.clear()
+        self._update_undo_buttons()
+
+    def _update_undo_buttons(self):
+        if self._undo_button is None:
+            return
+        self._undo_button.configure(state="normal" if self.history.can_undo() else "disabled")
+        self._redo_button.configure(state="normal" if self.history.can_redo() else "disabled")
+
+    def get_type_aggregates(self):
+        """Статистика по всем типам и величинам (кэш до изменения данных)."""
+        computed = tuple((c.name, c.text) for c in self.computed_columns.values())
+        key = (self._data_version, len(self.fuel_types), computed)
+        cache = self._type_aggregates_cache
+        if cache is None or cache[0] != key:
+            extra = {
+                name: (lambda cols, c=column: cols.computed(c))
+                for name, column in self.computed_columns.items()
+            }
+            cache = (key, TypeAggregates(self.get_columns(), len(self.fuel_types), extra))
+            self._type_aggregates_cache = cache
+        return cache[1]
 
     def recalculate_type_stats(self):
-        self.type_counts = {i: 0 for i in range(len(self.fuel_types))}
-        for cell in self.cells.values():
-            t = cell.get("fuel_type", 0)
-            if 0 <= t < len(self.fuel_types):
-                self.type_counts[t] += 1
+        import numpy as np
+        n_types = len(self.fuel_types)
+        types = self.get_columns().fuel_type
+        counts = np.bincount(types[(types >= 0) & (types < n_types)], minlength=n_types)
+        self.type_counts = dict(enumerate(counts.tolist()))
         for t, row in self.legend_rows.items():
             count = self.type_counts.get(t, 0)
             row["count_label"].config(text=str(count))
@@ -825,17 +5653,34 @@ class CoreMapGUI:
     # ---------- Подсветка поиска ----------
 
     def clear_highlight(self):
+        if self._raster_mode:
+            self.highlighted_cells.clear()
+            self._draw_raster_overlay()
+            return
+        call = self.canvas.tk.call
+        path = str(self.canvas)
         for cid in self.highlighted_cells:
             if cid in self.cells:
-                self.canvas.itemconfig(cid, outline="black", width=1)
+                outline, width = self._applied_outline(cid)
+                call(path, "itemconfigure", cid, "-outline", outline, "-width", width)
+        self.canvas.dtag("highlight", "highlight")
         self.highlighted_cells.clear()
 
     def highlight_cells(self, cell_ids):
+        """Подсветить ячейки: метка "highlight" на фигурах и одна общая перенастройка."""
         self.clear_highlight()
+        if self._raster_mode:
+            self.highlighted_cells.update(cid for cid in cell_ids if cid in self.cells)
+            self._draw_raster_overlay()
+            return
+        call = self.canvas.tk.call
+        path = str(self.canvas)
         for cid in cell_ids:
             if cid in self.cells:
-                self.canvas.itemconfig(cid, outline="red", width=3)
+                call(path, "addtag", "highlight", "withtag", cid)
                 self.highlighted_cells.add(cid)
+        if self.highlighted_cells:
+            self.canvas.itemconfig("highlight", outline="red", width=3)
 
     # ---------- Вспомогательные для масс и цветов ----------
 
@@ -870,235 +5715,953 @@ class CoreMapGUI:
         Применить выбранный режим окраски (по типам или градиент по массам).
 
         Градиент сделан по принципу VBA:
-        - задаётся "центр" (здесь берем среднее по выбранной выборке);
+        - задаётся "центр" и размах (по умолчанию — среднее и макс. отклонение,
+          см. "Масштаб градиента");
         - отклонения вниз от центра -> холодные тона (R,G снижаются, B=255);
         - отклонения вверх -> тёплые (R=255, G,B снижаются);
         - при нулевом отклонении ячейка почти белая (R=G=B=255).
         Цвета не уходят в тёмные: компоненты ограничены диапазоном [100..255].
+
+        Рассчитанные раскраски запоминаются (LRU) по режиму, выбранному типу,
+        масштабу и версии данных; на Canvas применяются только изменившиеся ячейки.
         """
         if not self.cells:
             return
 
         mode = self.coloring_mode_var.get()
+        if mode not in COLOR_MODES and self._computed_column_of(mode) is None:
+            # неизвестный режим — вернуться к типам
+            self.coloring_mode_var.set("По типам ТВС")
+            self.color_mode_combo.set("По типам ТВС")
+            mode = COLOR_MODE_TYPES
 
-        # Режим по типам ТВС — просто вернуть базовые цвета и заводские номера
-        if mode == "По типам ТВС":
-            for cid, cell in self.cells.items():
-                t = cell.get("fuel_type", 0)
-                if 0 <= t < len(self.fuel_types):
-                    color = self.fuel_types[t]["color"]
-                else:
-                    color = "#FFFFFF"
+        if mode in DIFF_MODES and self.diff_base_cells is None:
+            messagebox.showinfo(
+                "Сравнение",
+                "Сначала загрузите картограмму для сравнения.\n"
+                "Режим окраски возвращён к типам ТВС."
+            )
+            self.coloring_mode_var.set("По типам ТВС")
+            self.color_mode_combo.set("По типам ТВС")
+            mode = COLOR_MODE_TYPES
+
+        if mode == FLEET_MODE and self._fleet_source is None:
+            messagebox.showinfo(
+                "Архив циклов",
+                "Сначала выполните запрос в окне «Архив циклов».\n"
+                "Режим окраски возвращён к типам ТВС."
+            )
+            self.coloring_mode_var.set("По типам ТВС")
+            self.color_mode_combo.set("По типам ТВС")
+            mode = COLOR_MODE_TYPES
+
+        result = self._get_coloring(mode)
+        if result is None:
+            messagebox.showinfo(
+                "Градиентная окраска",
+                "Нет ненулевых значений масс для выбранного режима.\n"
+                "Режим окраски возвращён к типам ТВС."
+            )
+            self.coloring_mode_var.set("По типам ТВС")
+            self.color_mode_combo.set("По типам ТВС")
+            self.apply_coloring_mode()
+            return
 
-                self.canvas.itemconfig(cid, fill=color, outline="black", width=1)
+        styles, dist, center, swing = result
+        self.draw_gradient_histogram(dist, center, swing)
+        self._apply_cell_styles(styles)
+        self.draw_diff_arrows()
+
+    def _coloring_key(self, mode):
+        """Ключ кэша раскраски: всё, от чего зависит результат для данного режима."""
+        if mode == COLOR_MODE_TYPES:
+            colors = tuple(ft["color"] for ft in self.fuel_types)
+            return (mode, None, self._data_version, colors)
+        if mode in DIFF_MODES:
+            return (mode, None, self._data_version, self._diff_token)
+
+        column = self._computed_column_of(mode)
+        if mode in LOCAL_MODES or mode in ZONE_MODES or mode == FLEET_MODE or column is not None:
+            per_type = False
+        else:
+            field, per_type = GRADIENT_MODES[mode]
+        selected_type = self.current_fuel_var.get() if per_type else None
+        scaling = (
+            self.gradient_scaling_var.get(),
+            self.gradient_k_var.get(),
+            self.gradient_fixed_min_var.get(),
+            self.gradient_fixed_max_var.get(),
+            self.gradient_q_low_var.get(),
+            self.gradient_q_high_var.get(),
+        )
+        if mode == FLEET_MODE:
+            return (mode, None, self._data_version, scaling, self._fleet_token)
+        if column is not None:
+            return (mode, None, self._data_version, scaling, column.text)
+        return (mode, selected_type, self._data_version, scaling)
 
-                fact_text_id = cell.get("text_factory_id")
-                if fact_text_id:
-                    self.canvas.itemconfig(
-                        fact_text_id,
-                        text=cell.get("factory_id", ""),
-                        fill="black",
-                    )
+    def _safe_coloring_key(self, mode):
+        try:
+            return self._coloring_key(mode)
+        except (tk.TclError, ValueError):
+            return None
+
+    def _get_coloring(self, mode):
+        """Раскраска для режима из LRU-кэша или расчёт. None — нет значений для градиента."""
+        key = self._safe_coloring_key(mode)
+        if key is not None and key in self._coloring_cache:
+            self._coloring_cache.move_to_end(key)
+            return self._coloring_cache[key]
+
+        result = self._compute_coloring(mode)
+        # gradient_center_swing мог заменить некорректное масштабирование —
+        # результат кэшируется под фактическими настройками, а не под запрошенными
+        key = self._safe_coloring_key(mode)
+        if result is not None and key is not None:
+            self._coloring_cache[key] = result
+            while len(self._coloring_cache) > COLORING_CACHE_SIZE:
+                self._coloring_cache.popitem(last=False)
+        return result
+
+    def _compute_coloring(self, mode):
+        cols = self.get_columns()
+
+        if mode == COLOR_MODE_TYPES:
+            colors = [ft["color"] for ft in self.fuel_types]
+            return type_cell_styles(cols, colors), None, None, None
+        if mode in DIFF_MODES:
+            return self._compute_diff_coloring(DIFF_MODES[mode])
+        if mode in LOCAL_MODES:
+            return self._compute_local_coloring(*LOCAL_MODES[mode])
+        if mode in ZONE_MODES:
+            return self._compute_zone_coloring(*ZONE_MODES[mode])
+        if mode == FLEET_MODE:
+            return self._compute_fleet_coloring()
+        column = self._computed_column_of(mode)
+        if column is not None:
+            return computed_cell_styles(cols.computed(column), self.gradient_center_swing)
+
+        field, per_type = GRADIENT_MODES[mode]
+        type_id = self.current_fuel_var.get() if per_type else None
+        dist = self.get_value_distribution(field, type_id)
+        return mass_gradient_styles(cols, field, type_id, dist, self.gradient_center_swing)
+
+    def _compute_local_coloring(self, field, kind):
+        return local_cell_styles(self.get_columns(), field, kind, self.gradient_center_swing)
+
+    def _compute_zone_coloring(self, kind, field):
+        return zone_cell_styles(self.get_zone_aggregates(kind), field, self.gradient_center_swing)
+
+    def _compute_diff_coloring(self, field):
+        """Раскраска по сравнению: классы ячеек или градиент разности масс (центр 0)."""
+        import numpy as np
+
+        diff = self.get_diff()
+        if field is None:
+            styles = [
+                (DIFF_CATEGORY_COLORS[c], "black", 1, fid, "black")
+                for c, fid in zip(diff.category.tolist(), diff.new.factory_id)
+            ]
+            return styles, None, None, None
+
+        values = diff.delta[field]
+        active = ~np.isnan(values)
+        if not active.any():
+            return None
+        dist = ValueDistribution(values[active])
+        swing = max(abs(dist.min), abs(dist.max))
+        styles = gradient_cell_styles(values, active, 0.0, swing, absolute_labels=True)
+        return styles, dist, 0.0, swing
+
+    def _apply_cell_styles(self, styles):
+        """
+        Перенести стили на Canvas. Обновляются только строки, чей стиль отличается
+        от уже нарисованного; вызовы Tcl идут напрямую, без разбора опций tkinter.
+        """
+        if self._raster_mode:
+            self._applied_styles = list(styles)
+            self._request_raster()
+            self._draw_raster_overlay()
+            self._request_minimap()
+            return
+
+        applied = self._applied_styles
+        if applied is None or len(applied) != len(styles):
+            changed = range(len(styles))
+        else:
+            changed = [i for i, (a, b) in enumerate(zip(applied, styles)) if a != b]
+
+        call = self.canvas.tk.call
+        path = str(self.canvas)
+        row_cids = self._row_cids
+        row_label_ids = self._row_label_ids
+        highlighted = self.highlighted_cells
+        for i in changed:
+            fill, outline, width, label, label_fill = styles[i]
+            cid = row_cids[i]
+            if cid in highlighted:
+                call(path, "itemconfigure", cid, "-fill", fill)
+            else:
+                call(path, "itemconfigure", cid, "-fill", fill, "-outline", outline, "-width", width)
+            call(path, "itemconfigure", row_label_ids[i], "-text", label, "-fill", label_fill)
+
+        self._applied_styles = list(styles)
+        self._request_minimap()
+
+    def _applied_outline(self, cid):
+        """Контур ячейки согласно текущей раскраске (для снятия подсветки)."""
+        applied = self._applied_styles
+        row = self._cid_row.get(cid)
+        if applied is not None and row is not None and row < len(applied):
+            style = applied[row]
+            return style[1], style[2]
+        return "black", 1
+
+    def get_value_distribution(self, field, type_id=None):
+        """Распределение ненулевых значений поля (всех ячеек или одного типа), с кэшем."""
+        if self._distribution_cache.get("version") != self._data_version:
+            self._distribution_cache = {"version": self._data_version}
+        key = (field, type_id)
+        dist = self._distribution_cache.get(key)
+        if dist is None:
+            cols = self.get_columns()
+            values = cols.mass[field]
+            mask = values > 0.0
+            if type_id is not None:
+                mask &= cols.fuel_type == type_id
+            dist = ValueDistribution(values[mask])
+            self._distribution_cache[key] = dist
+        return dist
+
+    def gradient_center_swing(self, dist):
+        """Центр и размах градиента для выбранного масштабирования."""
+        scaling = self.gradient_scaling_var.get()
+        try:
+            k = float(self.gradient_k_var.get())
+        except (tk.TclError, ValueError):
+            k = 2.0
+        try:
+            quantiles = (float(self.gradient_q_low_var.get()), float(self.gradient_q_high_var.get()))
+        except (tk.TclError, ValueError):
+            quantiles = (0.05, 0.95)
+
+        fixed_range = None
+        if scaling == SCALING_FIXED:
+            lo = mass_or_nan(self.gradient_fixed_min_var.get())
+            hi = mass_or_nan(self.gradient_fixed_max_var.get())
+            if math.isnan(lo) or math.isnan(hi) or lo == hi:
+                messagebox.showwarning(
+                    "Градиентная окраска",
+                    "Задайте корректный диапазон (мин. и макс.).\n"
+                    "Использовано масштабирование по среднему."
+                )
+                self.gradient_scaling_var.set(SCALING_MEAN_MAX)
+                scaling = SCALING_MEAN_MAX
+            else:
+                fixed_range = (lo, hi)
+
+        return dist.center_swing(scaling, k=k, fixed_range=fixed_range, quantiles=quantiles)
+
+    def draw_gradient_histogram(self, dist=None, center=None, swing=None):
+        """Гистограмма выборки, раскрашенная цветами градиента, и цветовая шкала под ней."""
+        hc = self.hist_canvas
+        hc.delete("all")
+        width = int(hc.cget("width"))
+        height = int(hc.cget("height"))
+        if dist is None or not dist.n:
+            hc.create_text(width / 2, height / 2, text="градиент не выбран", fill="#999999")
+            return
+
+        lo = dist.min
+        hi = dist.max
+        if swing and swing > 0:
+            lo = min(lo, center - swing)
+            hi = max(hi, center + swing)
+        if hi <= lo:
+            hi = lo + 1.0
+
+        bar_h = 8
+        plot_h = height - bar_h - 14
+
+        def x_of(v):
+            return 2 + (v - lo) / (hi - lo) * (width - 4)
+
+        counts = dist.hist_counts
+        edges = dist.hist_edges
+        peak = max(int(counts.max()), 1)
+        for i, c in enumerate(counts.tolist()):
+            if not c:
+                continue
+            x0 = x_of(edges[i])
+            x1 = max(x_of(edges[i + 1]), x0 + 1)
+            h = plot_h * c / peak
+            mid = (edges[i] + edges[i + 1]) / 2.0
+            hc.create_rectangle(
+                x0, plot_h + 2 - h, x1, plot_h + 2,
+                fill=gradient_color(mid, center, swing), outline="#888888"
+            )
+
+        # цветовая шкала
+        steps = 64
+        for i in range(steps):
+            v0 = lo + (hi - lo) * i / steps
+            v1 = lo + (hi - lo) * (i + 1) / steps
+            color = gradient_color((v0 + v1) / 2.0, center, swing)
+            hc.create_rectangle(
+                x_of(v0), plot_h + 3, x_of(v1), plot_h + 3 + bar_h,
+                fill=color, outline=color
+            )
+
+        # границы центр ± размах и центр
+        for v, color in ((center - swing, "#666666"), (center + swing, "#666666"), (center, "black")):
+            if lo <= v <= hi:
+                hc.create_line(x_of(v), 0, x_of(v), plot_h + 3 + bar_h, fill=color, dash=(2, 2))
+
+        font = ("Arial", 7)
+        hc.create_text(2, height - 1, text=f"{lo:.4g}", anchor="sw", font=font)
+        hc.create_text(width - 2, height - 1, text=f"{hi:.4g}", anchor="se", font=font)
+        hc.create_text(width / 2, height - 1, text=f"N={dist.n}", anchor="s", font=font)
+
+    # ---------- Статистика масс по выбранному типу ----------
+
+    def update_mass_stats_for_selected_type(self):
+        """Показать min/max/σ по массам для выбранного типа ТВС (из сводных агрегатов)."""
+        if not self.cells:
+            self.stats_text_fuel.set("m_топл: данных нет")
+            self.stats_text_abs.set("m_погл: данных нет")
+            self.refresh_type_summary()
+            return
+
+        aggregates = self.get_type_aggregates()
+        t_sel = self.current_fuel_var.get()
+
+        def format_stats(name: str):
+            st = aggregates.row(name, t_sel)
+            if not st["count"]:
+                return f"{name}: данных нет"
+            return (
+                f"{name}: N={st['count']}; "
+                f"mean={st['mean']:.5f}; "
+                f"min={st['min']:.5f}; max={st['max']:.5f}; "
+                f"σ={st['std']:.5f}"
+            )
+
+        self.stats_text_fuel.set(format_stats("m_топл"))
+        self.stats_text_abs.set(format_stats("m_погл"))
+        self.refresh_type_summary()
+        self.refresh_zone_aggregates()
+
+    # ---------- Сводная таблица по типам ----------
+
+    SUMMARY_COLUMNS = (
+        ("type", "Тип", 40),
+        ("name", "Название", 90),
+        ("metric", "Величина", 70),
+        ("count", "N", 45),
+        ("mean", "mean", 80),
+        ("std", "σ", 70),
+        ("min", "min", 80),
+    ) + tuple(
+        (f"p{p}", f"P{p}", 80) for p in AGGREGATE_PERCENTILES
+    ) + (
+        ("max", "max", 80),
+    )
+
+    def _type_summary_rows(self):
+        """Строки сводной таблицы в виде словарей (для Treeview и экспорта)."""
+        if not self.cells:
+            return []
+        rows = []
+        for type_id, metric, st in self.get_type_aggregates().table_rows():
+            row = dict(st)
+            row["type"] = type_id
+            row["name"] = self.fuel_types[type_id]["name"]
+            row["metric"] = metric
+            rows.append(row)
+        return rows
+
+    def show_type_summary(self):
+        """Немодальное окно со сводной таблицей по всем типам и величинам."""
+        if self.summary_window is not None and self.summary_window.winfo_exists():
+            self.summary_window.lift()
+            self.refresh_type_summary()
+            return
+
+        win = tk.Toplevel(self.master)
+        win.title("Сводка по типам ТВС")
+        win.transient(self.master)
+
+        columns = [c[0] for c in self.SUMMARY_COLUMNS]
+        tree = ttk.Treeview(win, columns=columns, show="headings", height=18)
+        for key, title, width in self.SUMMARY_COLUMNS:
+            tree.heading(key, text=title, command=lambda k=key: self._sort_type_summary(k))
+            tree.column(key, width=width, anchor="e" if key not in ("name", "metric") else "w")
+        scroll = ttk.Scrollbar(win, orient="vertical", command=tree.yview)
+        tree.configure(yscrollcommand=scroll.set)
+
+        tree.grid(row=0, column=0, sticky="nsew", padx=(5, 0), pady=5)
+        scroll.grid(row=0, column=1, sticky="ns", pady=5)
+        win.rowconfigure(0, weight=1)
+        win.columnconfigure(0, weight=1)
+
+        btn_frame = ttk.Frame(win)
+        btn_frame.grid(row=1, column=0, columnspan=2, sticky="w", padx=5, pady=(0, 5))
+        ttk.Button(
+            btn_frame,
+            text="Экспорт в CSV…",
+            command=self.export_type_summary_csv
+        ).pack(side="left")
+
+        def on_close():
+            self.summary_window = None
+            self.summary_tree = None
+            win.destroy()
+
+        win.protocol("WM_DELETE_WINDOW", on_close)
+        self.summary_window = win
+        self.summary_tree = tree
+        self.refresh_type_summary()
+
+    def _sort_type_summary(self, key):
+        cur_key, descending = self._summary_sort
+        descending = (not descending) if cur_key == key else False
+        self._summary_sort = (key, descending)
+        self.refresh_type_summary()
+
+    def refresh_type_summary(self):
+        """Перезаполнить открытую сводную таблицу (агрегаты берутся из кэша)."""
+        tree = self.summary_tree
+        if tree is None:
+            return
+
+        rows = self._type_summary_rows()
+        key, descending = self._summary_sort
+
+        def sort_key(row):
+            v = row.get(key)
+            if isinstance(v, str):
+                return (0, v)
+            if v is None or v != v:  # NaN — в конец
+                return (1, 0.0)
+            return (0, v)
+
+        rows.sort(key=sort_key, reverse=descending)
+
+        tree.delete(*tree.get_children())
+        for row in rows:
+            values = []
+            for col, _, _ in self.SUMMARY_COLUMNS:
+                v = row.get(col, "")
+                if isinstance(v, float):
+                    v = f"{v:.5f}"
+                values.append(v)
+            tree.insert("", "end", values=values)
+
+    def export_type_summary_csv(self):
+        rows = self._type_summary_rows()
+        if not rows:
+            messagebox.showwarning("Экспорт", "Нет данных для сводки.")
+            return
+
+        filename = filedialog.asksaveasfilename(
+            title="Сохранить сводку по типам в CSV",
+            defaultextension=".csv",
+            filetypes=[("CSV файлы", "*.csv"), ("Все файлы", "*.*")]
+        )
+        if not filename:
+            return
+
+        try:
+            with open(filename, "w", newline="", encoding="utf-8") as f:
+                writer = csv.writer(f, delimiter=";")
+                writer.writerow([title for _, title, _ in self.SUMMARY_COLUMNS])
+                for row in rows:
+                    writer.writerow([row.get(col, "") for col, _, _ in self.SUMMARY_COLUMNS])
+            messagebox.showinfo("Экспорт", "Сводка сохранена.")
+        except Exception as e:
+            messagebox.showerror("Ошибка", f"Не удалось сохранить CSV:\n{e}")
+
+    # ---------- Агрегаты по кольцам и секторам ----------
+
+    # Величина на диаграмме: название -> ключ строки ZoneAggregates.table_rows
+    # (None — число ТВС по типам столбиками с цветами типов)
+    ZONE_CHART_VALUES = {
+        "Число ТВС по типам": None,
+        "Σ m_топл": "sum_mass_fuel",
+        "Среднее m_топл": "mean_mass_fuel",
+        "Σ m_бор": "sum_mass_boron",
+        "Среднее m_бор": "mean_mass_boron",
+        "Σ m_гадолиний": "sum_mass_gd",
+        "Среднее m_гадолиний": "mean_mass_gd",
+    }
+
+    def _zone_table_columns(self):
+        columns = [("zone", "№", 40), ("count", "ТВС", 50)]
+        for t, ft in enumerate(self.fuel_types):
+            columns.append((f"type_{t}", ft["name"], 60))
+        for field in MASS_FIELDS:
+            columns.append((f"sum_{field}", f"Σ {field}", 100))
+            columns.append((f"mean_{field}", f"ср. {field}", 90))
+        return columns
+
+    def show_zone_aggregates(self):
+        """Немодальное окно: таблица и диаграмма агрегатов по кольцам / секторам."""
+        if self.zone_window is not None and self.zone_window.winfo_exists():
+            self.zone_window.lift()
+            self.refresh_zone_aggregates()
+            return
+
+        win = tk.Toplevel(self.master)
+        win.title("Кольца и секторы")
+        win.transient(self.master)
+
+        top = ttk.Frame(win)
+        top.grid(row=0, column=0, columnspan=2, sticky="ew", padx=5, pady=5)
+        ttk.Label(top, text="Зоны:").pack(side="left")
+        kind_combo = ttk.Combobox(
+            top, textvariable=self.zone_kind_var,
+            values=list(ZONE_KINDS), state="readonly", width=10
+        )
+        kind_combo.pack(side="left", padx=(2, 8))
+        ttk.Label(top, text="Диаграмма:").pack(side="left")
+        chart_combo = ttk.Combobox(
+            top, textvariable=self.zone_chart_var,
+            values=list(self.ZONE_CHART_VALUES), state="readonly", width=20
+        )
+        chart_combo.pack(side="left", padx=2)
+        kind_combo.bind("<<ComboboxSelected>>", lambda e: self.refresh_zone_aggregates())
+        chart_combo.bind("<<ComboboxSelected>>", lambda e: self.refresh_zone_aggregates())
+
+        tree = ttk.Treeview(win, show="headings", height=12)
+        scroll = ttk.Scrollbar(win, orient="horizontal", command=tree.xview)
+        tree.configure(xscrollcommand=scroll.set)
+        tree.grid(row=1, column=0, sticky="nsew", padx=5)
+        scroll.grid(row=2, column=0, sticky="ew", padx=5)
+
+        chart = tk.Canvas(win, width=520, height=180, bg="white", highlightthickness=0)
+        chart.grid(row=3, column=0, sticky="ew", padx=5, pady=5)
+        win.rowconfigure(1, weight=1)
+        win.columnconfigure(0, weight=1)
+
+        def on_close():
+            self.zone_window = None
+            self._zone_tree = None
+            self._zone_chart = None
+            win.destroy()
+
+        win.protocol("WM_DELETE_WINDOW", on_close)
+        self.zone_window = win
+        self._zone_tree = tree
+        self._zone_chart = chart
+        self.refresh_zone_aggregates()
+
+    def refresh_zone_aggregates(self):
+        """Перезаполнить открытое окно зон (агрегаты из кэша, при правке — по строкам)."""
+        tree = self._zone_tree
+        if tree is None:
+            return
+        aggregates = self.get_zone_aggregates(self.zone_kind_var.get())
+        rows = aggregates.table_rows()
+
+        columns = self._zone_table_columns()
+        keys = [c[0] for c in columns]
+        if tuple(tree["columns"]) != tuple(keys):
+            tree.configure(columns=keys)
+            for key, title, width in columns:
+                tree.heading(key, text=title)
+                tree.column(key, width=width, anchor="e", stretch=False)
+
+        tree.delete(*tree.get_children())
+        for row in rows:
+            values = []
+            for key in keys:
+                v = row.get(key, "")
+                if isinstance(v, float):
+                    v = "—" if v != v else f"{v:.3f}"
+                values.append(v)
+            tree.insert("", "end", values=values)
+
+        self._draw_zone_chart(aggregates, rows)
+
+    def _draw_zone_chart(self, aggregates, rows):
+        """Столбчатая диаграмма по зонам (для числа ТВС — с разбивкой по типам)."""
+        chart = self._zone_chart
+        chart.delete("all")
+        width = int(chart.cget("width"))
+        height = int(chart.cget("height"))
+        if not rows:
+            chart.create_text(width / 2, height / 2, text="нет данных", fill="#999999")
             return
 
-        # Определение режима и области
-        metric = None  # "fuel" | "boron" | "gd"
-        per_type = False
-
-        if mode == "Градиент m_топл (все)":
-            metric = "fuel"
-            per_type = False
-        elif mode == "Градиент m_бор (все)":
-            metric = "boron"
-            per_type = False
-        elif mode == "Градиент m_гадолиний (все)":
-            metric = "gd"
-            per_type = False
-        elif mode == "Градиент m_топл (выбранный тип)":
-            metric = "fuel"
-            per_type = True
-        elif mode == "Градиент m_бор (выбранный тип)":
-            metric = "boron"
-            per_type = True
-        elif mode == "Градиент m_гадолиний (выбранный тип)":
-            metric = "gd"
-            per_type = True
+        key = self.ZONE_CHART_VALUES[self.zone_chart_var.get()]
+        if key is None:
+            stacks = aggregates.type_counts.tolist()
+            colors = [ft["color"] for ft in self.fuel_types]
         else:
-            # неизвестный режим — вернуться к типам
-            self.coloring_mode_var.set("По типам ТВС")
-            self.color_mode_combo.set("По типам ТВС")
-            self.apply_coloring_mode()
+            stacks = [[0.0 if row[key] != row[key] else max(row[key], 0.0)] for row in rows]
+            colors = ["#4F81BD"]
+
+        peak = max((sum(s) for s in stacks), default=0) or 1.0
+        left, bottom, top = 4, height - 14, 12
+        step = (width - 2 * left) / len(stacks)
+        bar_w = max(step * 0.8, 1.0)
+        for z, stack in enumerate(stacks):
+            x0 = left + z * step + (step - bar_w) / 2
+            y = bottom
+            for part, color in zip(stack, colors):
+                if not part:
+                    continue
+                h = (bottom - top) * part / peak
+                chart.create_rectangle(x0, y - h, x0 + bar_w, y, fill=color, outline="#666666")
+                y -= h
+            if len(stacks) <= 40 or z % 5 == 0:
+                chart.create_text(x0 + bar_w / 2, bottom + 1, text=str(z + 1), anchor="n", font=("Arial", 7))
+        chart.create_text(left, 1, text=f"макс. {peak:.4g}", anchor="nw", font=("Arial", 7))
+
+    # ---------- Анализ симметрии ----------
+
+    SYMMETRY_WORST_COLUMNS = [
+        ("pos", "Позиция", 70),
+        ("q", "q", 40),
+        ("r", "r", 40),
+        ("value", "Значение", 90),
+        ("mean", "Среднее по орбите", 110),
+        ("rel", "Откл., %", 70),
+    ]
+
+    def show_symmetry_analysis(self):
+        """Немодальное окно: суммы по секторам и самые несимметричные позиции."""
+        if self.symmetry_window is not None and self.symmetry_window.winfo_exists():
+            self.symmetry_window.lift()
+            self.run_symmetry_analysis()
             return
 
-        selected_type = self.current_fuel_var.get()
+        win = tk.Toplevel(self.master)
+        win.title("Анализ симметрии")
+        win.transient(self.master)
 
-        # --- собираем значения и считаем min/max/mean ---
-        values = {}  # cid -> v
-        v_min = None
-        v_max = None
-        sum_v = 0.0
+        top = ttk.Frame(win)
+        top.grid(row=0, column=0, sticky="ew", padx=5, pady=5)
+        ttk.Label(top, text="Симметрия:").pack(side="left")
+        group_combo = ttk.Combobox(
+            top, textvariable=self.symmetry_group_var,
+            values=list(SYMMETRY_GROUPS), state="readonly", width=24
+        )
+        group_combo.pack(side="left", padx=(2, 8))
+        ttk.Label(top, text="Величина:").pack(side="left")
+        field_combo = ttk.Combobox(
+            top, textvariable=self.symmetry_field_var,
+            values=list(MASS_FIELDS), state="readonly", width=12
+        )
+        field_combo.pack(side="left", padx=2)
+        group_combo.bind("<<ComboboxSelected>>", lambda e: self.run_symmetry_analysis())
+        field_combo.bind("<<ComboboxSelected>>", lambda e: self.run_symmetry_analysis())
+
+        sector_cols = ["sector"] + list(MASS_FIELDS)
+        sector_tree = ttk.Treeview(win, columns=sector_cols, show="headings", height=6)
+        sector_tree.heading("sector", text="Сектор")
+        sector_tree.column("sector", width=60, anchor="w")
+        for field in MASS_FIELDS:
+            sector_tree.heading(field, text=f"Σ {field}")
+            sector_tree.column(field, width=110, anchor="e")
+        sector_tree.grid(row=1, column=0, sticky="ew", padx=5)
+
+        ttk.Label(win, textvariable=self.symmetry_result_var, justify="left").grid(
+            row=2, column=0, sticky="w", padx=5, pady=4
+        )
 
-        for cid, cell in self.cells.items():
-            if per_type and cell.get("fuel_type") != selected_type:
-                continue
+        worst_cols = [c[0] for c in self.SYMMETRY_WORST_COLUMNS]
+        worst_tree = ttk.Treeview(win, columns=worst_cols, show="headings", height=12)
+        for key, title, width in self.SYMMETRY_WORST_COLUMNS:
+            worst_tree.heading(key, text=title)
+            worst_tree.column(key, width=width, anchor="w" if key == "pos" else "e")
+        worst_tree.grid(row=3, column=0, sticky="nsew", padx=5, pady=(0, 5))
+        win.rowconfigure(3, weight=1)
+        win.columnconfigure(0, weight=1)
+
+        def on_close():
+            self.symmetry_window = None
+            self._symmetry_trees = None
+            self.clear_highlight()
+            win.destroy()
 
-            if metric == "fuel":
-                v = self._parse_mass(cell.get("mass_fuel", ""))
-            elif metric == "boron":
-                v = self._parse_mass(cell.get("mass_boron", ""))
-            else:  # metric == "gd"
-                v = self._parse_mass(cell.get("mass_gd", ""))
+        win.protocol("WM_DELETE_WINDOW", on_close)
+        self.symmetry_window = win
+        self._symmetry_trees = (sector_tree, worst_tree)
+        self.run_symmetry_analysis()
 
-            # считаем только ненулевые значения
-            if v <= 0.0:
-                continue
+    def run_symmetry_analysis(self):
+        """Пересчитать анализ симметрии и подсветить худшие позиции."""
+        if self._symmetry_trees is None:
+            return
+        sector_tree, worst_tree = self._symmetry_trees
+        columns = self.get_columns()
+        field = self.symmetry_field_var.get()
+        analysis = SymmetryAnalysis(columns, self.symmetry_group_var.get())
+
+        sector_tree.delete(*sector_tree.get_children())
+        for k in range(analysis.sector_count):
+            sector_tree.insert("", "end", values=[k + 1] + [
+                f"{analysis.sector_sums[f][k]:.5f}" for f in MASS_FIELDS
+            ])
+
+        max_rel = analysis.max_rel_deviation(field)
+        lines = [
+            f"Макс. отклонение {field} от среднего по орбите: "
+            + ("—" if max_rel != max_rel else f"{max_rel * 100:.2f}%")
+        ]
+        if analysis.incomplete_count:
+            lines.append(f"Ячеек без симметричного партнёра: {analysis.incomplete_count}")
+        self.symmetry_result_var.set("\n".join(lines))
+
+        worst = analysis.worst_rows(field)
+        values = columns.mass[field]
+        mean = analysis.orbit_mean[field]
+        rel = analysis.rel_deviation[field]
+        worst_tree.delete(*worst_tree.get_children())
+        for row in worst:
+            row = int(row)
+            worst_tree.insert("", "end", values=[
+                columns.pos_label[row],
+                int(columns.q[row]),
+                int(columns.r[row]),
+                f"{values[row]:.5f}",
+                f"{mean[row]:.5f}",
+                f"{rel[row] * 100:+.2f}",
+            ])
+        self.highlight_cells(self._row_cids[int(row)] for row in worst)
+
+    # ---------- Архив картограмм по циклам ----------
+
+    def show_fleet_store(self):
+        """Немодальное окно архива циклов: загрузка CSV, запросы и раскраска по результату."""
+        if self.fleet_window is not None and self.fleet_window.winfo_exists():
+            self.fleet_window.lift()
+            return
 
-            values[cid] = v
-            sum_v += v
-            if v_min is None or v < v_min:
-                v_min = v
-            if v_max is None or v > v_max:
-                v_max = v
+        win = tk.Toplevel(self.master)
+        win.title("Архив циклов")
+        win.transient(self.master)
 
-        if not values:
-            messagebox.showinfo(
-                "Градиентная окраска",
-                "Нет ненулевых значений масс для выбранного режима.\n"
-                "Режим окраски возвращён к типам ТВС."
+        top = ttk.Frame(win)
+        top.grid(row=0, column=0, columnspan=2, sticky="ew", padx=5, pady=5)
+        ttk.Button(top, text="Открыть / создать…", command=self.open_fleet_store).pack(side="left")
+        ttk.Button(
+            top, text="Добавить CSV…", command=lambda: self.fleet_ingest()
+        ).pack(side="left", padx=(4, 0))
+        ttk.Button(
+            top, text="Добавить набор", command=lambda: self.fleet_ingest(self.workspace_paths)
+        ).pack(side="left", padx=(4, 0))
+        ttk.Label(top, textvariable=self.fleet_status_var).pack(side="left", padx=(8, 0))
+
+        query = ttk.Frame(win)
+        query.grid(row=1, column=0, columnspan=2, sticky="ew", padx=5)
+        ttk.Combobox(
+            query, textvariable=self.fleet_query_var,
+            values=list(FLEET_QUERIES), state="readonly", width=30
+        ).pack(side="left")
+        ttk.Label(query, text="№ / позиция:").pack(side="left", padx=(6, 2))
+        ttk.Entry(query, textvariable=self.fleet_arg_var, width=12).pack(side="left")
+        ttk.Label(query, text="Тип:").pack(side="left", padx=(6, 2))
+        self._fleet_type_combo = ttk.Combobox(
+            query, textvariable=self.fleet_type_var,
+            values=[""] + [ft["name"] for ft in self.fuel_types], width=14
+        )
+        self._fleet_type_combo.pack(side="left")
+        ttk.Label(query, text="Последних циклов (0 — все):").pack(side="left", padx=(6, 2))
+        ttk.Spinbox(
+            query, from_=0, to=999, increment=1, textvariable=self.fleet_last_var, width=4
+        ).pack(side="left")
+        ttk.Button(query, text="Выполнить", command=self.run_fleet_query).pack(side="left", padx=(6, 0))
+
+        tree = ttk.Treeview(win, show="headings", height=14)
+        vscroll = ttk.Scrollbar(win, orient="vertical", command=tree.yview)
+        tree.configure(yscrollcommand=vscroll.set)
+        tree.grid(row=2, column=0, sticky="nsew", padx=(5, 0), pady=5)
+        vscroll.grid(row=2, column=1, sticky="ns", padx=(0, 5), pady=5)
+        ttk.Label(win, textvariable=self.fleet_result_var).grid(
+            row=3, column=0, columnspan=2, sticky="w", padx=5, pady=(0, 5)
+        )
+        win.rowconfigure(2, weight=1)
+        win.columnconfigure(0, weight=1)
+
+        def on_close():
+            self.fleet_window = None
+            self._fleet_tree = None
+            self._fleet_type_combo = None
+            win.destroy()
+
+        win.protocol("WM_DELETE_WINDOW", on_close)
+        self.fleet_window = win
+        self._fleet_tree = tree
+        self._update_fleet_status()
+
+    def open_fleet_store(self, path=None):
+        """Открыть файл архива SQLite (несуществующий создаётся)."""
+        if not path:
+            path = filedialog.asksaveasfilename(
+                title="Архив циклов (SQLite)",
+                defaultextension=".sqlite",
+                filetypes=[("База SQLite", "*.sqlite *.db"), ("Все файлы", "*.*")],
+                confirmoverwrite=False
             )
-            self.coloring_mode_var.set("По типам ТВС")
-            self.color_mode_combo.set("По типам ТВС")
-            self.apply_coloring_mode()
+            if not path:
+                return False
+        try:
+            store = FleetStore(path)
+        except Exception as e:
+            messagebox.showerror("Архив циклов", f"Не удалось открыть архив:\n{e}")
+            return False
+        if self.fleet_store is not None:
+            self.fleet_store.close()
+        self.fleet_store = store
+        self._update_fleet_status()
+        return True
+
+    def _update_fleet_status(self):
+        store = self.fleet_store
+        if store is None:
+            self.fleet_status_var.set("Архив не открыт")
             return
+        cycles = store.cycles()
+        self.fleet_status_var.set(
+            f"{os.path.basename(store.path)}: циклов {cycles['cycle'].size}, "
+            f"ячеек {int(cycles['count'].sum())}"
+        )
 
-        # --- центр и "амплитуда" отклонений (аналог dblValueCenter / dblSwing) ---
-        n_vals = len(values)
-        center = sum_v / n_vals  # аналог dblValueCenter; в VBA он был 1.0, здесь — среднее
-
-        # swing = max(|v_min - center|, |v_max - center|)
-        swing = max(abs(v_min - center), abs(v_max - center))
-        if swing <= 0.0:
-            # все значения одинаковы – красим как почти белые для участвующих ячеек
-            for cid, cell in self.cells.items():
-                if per_type and cell.get("fuel_type") != selected_type:
-                    # другие типы — белые
-                    self.canvas.itemconfig(cid, fill="#FFFFFF", outline="black", width=1)
-                else:
-                    if cid in values:
-                        self.canvas.itemconfig(cid, fill="#FFFFFF", outline="black", width=1)
-                        fact_text_id = cell.get("text_factory_id")
-                        if fact_text_id:
-                            self.canvas.itemconfig(fact_text_id, text="+0.000", fill="black")
-                    else:
-                        # нулевые/отсутствующие – белые
-                        self.canvas.itemconfig(cid, fill="#F0F0F0", outline="#CCCCCC", width=1)
-                        fact_text_id = cell.get("text_factory_id")
-                        if fact_text_id:
-                            self.canvas.itemconfig(fact_text_id, text="", fill="#CCCCCC")
-            return
-
-        # параметры цвета, как в VBA
-        intColorMax = 255
-        intColorMin = 100
-        color_range = intColorMax - intColorMin
-
-        # --- окраска ячеек ---
-        inactive_fill = "#F0F0F0"
-        inactive_outline = "#CCCCCC"
-        for cid, cell in self.cells.items():
-            if cid in values:
-                v = values[cid]
-                # нормированное отклонение от центра
-                dev = abs(v - center) / swing  # 0..(примерно 1)
-                if dev > 1.0:
-                    dev = 1.0
-                intDeltaColor = int(dev * color_range)
-
-                if v < center:  # ниже центра — холодные тона (как ветка "value < center" в VBA)
-                    intG = intColorMax - intDeltaColor
-                    intB = intColorMax
-                    intR = intColorMax - intDeltaColor
-                elif v > center:  # выше центра — тёплые тона (как "value >= center" в VBA)
-                    intR = intColorMax
-                    intG = intColorMax - intDeltaColor
-                    intB = intColorMax - intDeltaColor
-                else:
-                    intR = intColorMax
-                    intG = intColorMax
-                    intB = intColorMax
-
-                color = f"#{intR:02X}{intG:02X}{intB:02X}"
-                self.canvas.itemconfig(cid, fill=color, outline="black", width=1)
-
-                # относительное отклонение от среднего (в долях)
-                rel_dev = 0.0 if center == 0 else (v - center) / center
-                fact_text_id = cell.get("text_factory_id")
-                if fact_text_id:
-                    self.canvas.itemconfig(
-                        fact_text_id,
-                        text=f"{rel_dev:+.3f}",
-                        fill="black",
-                    )
-
-            else:
-                # для ячеек без значения в текущем режиме:
-                self.canvas.itemconfig(
-                    cid,
-                    fill=inactive_fill,
-                    outline=inactive_outline,
-                    width=1,
-                )
-
-                fact_text_id = cell.get("text_factory_id")
-                if fact_text_id:
-                    self.canvas.itemconfig(fact_text_id, text="", fill=inactive_outline)
-
-    # ---------- Статистика масс по выбранному типу ----------
-
-    def update_mass_stats_for_selected_type(self):
-        """Пересчитать min/max/σ по массам для выбранного типа ТВС."""
-        if not self.cells:
-            self.stats_text_fuel.set("m_топл: данных нет")
-            self.stats_text_abs.set("m_погл: данных нет")
+    def fleet_ingest(self, paths=None):
+        """Загрузить картограммы CSV в архив фоновой задачей (одна транзакция)."""
+        if self.fleet_store is None and not self.open_fleet_store():
+            return
+        if not paths:
+            paths = filedialog.askopenfilenames(
+                title="Картограммы для архива",
+                filetypes=[("CSV файлы", "*.csv"), ("Все файлы", "*.*")]
+            )
+        paths = list(paths or [])
+        if not paths:
             return
 
-        t_sel = self.current_fuel_var.get()
+        store = self.fleet_store
+        job = BackgroundJob(f"Архив: {len(paths)} CSV")
+        fuel_types = [dict(ft) for ft in self.fuel_types]     # копия: задача идёт в другом потоке
+        future = self._io_executor().submit(store.ingest, paths, job, fuel_types)
 
-        vals_fuel = []
-        vals_abs = []  # m_B + m_Gd
+        def done():
+            try:
+                n_cells = future.result()
+            except JobCancelled:
+                return
+            except Exception as e:
+                messagebox.showerror("Архив циклов", f"Не удалось загрузить картограммы:\n{e}")
+                return
+            if store is self.fleet_store:
+                self._update_fleet_status()
+                self.fleet_result_var.set(f"Загружено картограмм: {len(paths)}, ячеек: {n_cells}.")
+
+        self._run_job(job, future, done)
+
+    def _fleet_default_arg(self, kind):
+        """Параметр запроса по умолчанию — из первой выделенной ячейки."""
+        if not self.selected_rows:
+            return ""
+        cell = self.cells[self._row_cids[min(self.selected_rows)]]
+        return str(cell.get("factory_id" if kind == "assembly" else "pos_label", "") or "")
+
+    def run_fleet_query(self):
+        """Выполнить запрос к архиву: таблица результата и раскраска карты по позициям / ТВС."""
+        import numpy as np
+
+        store = self.fleet_store
+        if store is None:
+            messagebox.showinfo("Архив циклов", "Сначала откройте архив.")
+            return
+        kind = FLEET_QUERIES[self.fleet_query_var.get()]
+        fuel_type = self.fleet_type_var.get().strip() or None
+        try:
+            last = int(self.fleet_last_var.get())
+        except (tk.TclError, ValueError):
+            last = 0
+
+        arg = self.fleet_arg_var.get().strip()
+        if kind in ("assembly", "position") and not arg:
+            arg = self._fleet_default_arg(kind)
+            self.fleet_arg_var.set(arg)
+            if not arg:
+                messagebox.showinfo(
+                    "Архив циклов",
+                    "Укажите заводской номер или позицию (или выделите ячейку)."
+                )
+                return
 
-        for cell in self.cells.values():
-            if cell.get("fuel_type") != t_sel:
-                continue
+        if kind == "assembly":
+            result = store.assembly_history(arg, last)
+        elif kind == "position":
+            result = store.position_history(arg, fuel_type, last)
+        elif kind == "position_counts":
+            result = store.position_counts(fuel_type, last)
+        else:
+            result = store.residence_counts(last)
 
-            mf = self._parse_mass(cell.get("mass_fuel", ""))
-            mb = self._parse_mass(cell.get("mass_boron", ""))
-            mg = self._parse_mass(cell.get("mass_gd", ""))
-            ma = mb + mg
+        # источник раскраски: счётчики по позициям (q, r) или по заводским номерам
+        if kind == "residence":
+            self._fleet_source = ("assembly", dict(zip(result["factory_id"], result["count"])))
+        elif kind == "position_counts":
+            self._fleet_source = ("position", (result["q"], result["r"], result["count"]))
+        else:
+            qr = np.stack([result["q"], result["r"]], axis=1).reshape(-1, 2)
+            positions, counts = np.unique(qr, axis=0, return_counts=True)
+            self._fleet_source = ("position", (positions[:, 0], positions[:, 1], counts))
+        self._fleet_token += 1
+
+        self._fill_fleet_table(result)
+        n = next(iter(result.values())).size
+        self.fleet_result_var.set(
+            f"Строк: {n}" + (f" (показано {FLEET_TABLE_LIMIT})" if n > FLEET_TABLE_LIMIT else "")
+        )
 
-            if mf > 0.0:
-                vals_fuel.append(mf)
-            if ma > 0.0:
-                vals_abs.append(ma)
+        self.coloring_mode_var.set(FLEET_MODE)
+        self.color_mode_combo.set(FLEET_MODE)
+        self.apply_coloring_mode()
 
-        def format_stats(name: str, arr):
-            if not arr:
-                return f"{name}: данных нет"
-            n = len(arr)
-            vmin = min(arr)
-            vmax = max(arr)
-            mean = sum(arr) / n
-            var = sum((x - mean) ** 2 for x in arr) / n
-            sigma = var ** 0.5
-            return (
-                f"{name}: N={n}; "
-                f"mean={mean:.5f}; "
-                f"min={vmin:.5f}; max={vmax:.5f}; "
-                f"σ={sigma:.5f}"
+    def _fill_fleet_table(self, result):
+        tree = self._fleet_tree
+        if tree is None:
+            return
+        keys = list(result)
+        if tuple(tree["columns"]) != tuple(keys):
+            tree.configure(columns=keys)
+            for key in keys:
+                tree.heading(key, text=key)
+                tree.column(key, width=90, anchor="w", stretch=False)
+        tree.delete(*tree.get_children())
+        columns = [result[key][:FLEET_TABLE_LIMIT].tolist() for key in keys]
+        for values in zip(*columns):
+            tree.insert("", "end", values=[
+                "—" if isinstance(v, float) and v != v else v for v in values
+            ])
+
+    def _compute_fleet_coloring(self):
+        """Градиент по результату запроса к архиву (0 — позиция / ТВС не найдены)."""
+        import numpy as np
+
+        cols = self.get_columns()
+        kind, payload = self._fleet_source
+        if kind == "assembly":
+            values = np.fromiter(
+                (payload.get(fid, 0) for fid in cols.factory_id), dtype=np.float64, count=cols.n
             )
-
-        self.stats_text_fuel.set(format_stats("m_топл", vals_fuel))
-        self.stats_text_abs.set(format_stats("m_погл", vals_abs))
+        else:
+            q, r, counts = payload
+            rows = axial_join(q, r, cols.q, cols.r)
+            values = np.where(rows >= 0, counts[np.maximum(rows, 0)], 0).astype(np.float64)
+        active = values > 0.0
+        if not active.any():
+            return None
+        dist = ValueDistribution(values[active])
+        center, swing = self.gradient_center_swing(dist)
+        styles = gradient_cell_styles(values, active, center, swing)
+        return styles, dist, center, swing
 
     # ---------- Диалог редактирования ячейки ----------
 
@@ -1185,15 +6748,31 @@ class CoreMapGUI:
 
     # ---------- Клик по ячейке ----------
 
+    def _cell_at_event(self, event):
+        """
+        id ячейки под курсором: фигура под указателем или, в растровом режиме
+        (фигур нет), ближайший центр по пространственному индексу.
+        """
+        if self._raster_mode:
+            if not self.cells:
+                return None
+            _, _, x, y = self._event_point(event)
+            row = self.get_spatial_index().nearest(x, y, self.hex_size * 0.9)
+            return self._row_cids[row] if row >= 0 else None
+        for cid in self.canvas.find_withtag("current"):
+            if cid in self.cells:
+                return cid
+        return None
+
     def on_cell_click(self, event):
-        current = self.canvas.find_withtag("current")
-        if not current:
-            return
-        cell_id = current[0]
+        cell_id = self._cell_at_event(event)
         cell = self.cells.get(cell_id)
         if not cell:
             return
 
+        if self.tool_var.get() != TOOL_EDIT:
+            return  # работает инструмент кисти / выделения
+
         # Режим пипетки: только копирование типа
         if self.pipette_mode_var.get():
             fuel_idx = cell.get("fuel_type", 0)
@@ -1211,20 +6790,168 @@ class CoreMapGUI:
         new_type = new_data.get("fuel_type", old_type)
         if new_type < 0 or new_type >= len(self.fuel_types):
             new_type = old_type
-        cell["fuel_type"] = new_type
 
-        cell["factory_id"] = new_data.get("factory_id", cell.get("factory_id", ""))
-        self.canvas.itemconfig(
-            cell["text_factory_id"],
-            text=cell["factory_id"] if cell["factory_id"] else ""
+        changes = [(cell_id, "fuel_type", new_type)]
+        for field in ("factory_id",) + MASS_FIELDS:
+            changes.append((cell_id, field, new_data.get(field, cell.get(field, ""))))
+        # подпись с заводским номером обновится вместе со стилем ячейки
+        self.apply_cell_changes(changes)
+
+    # ---------- Кисть и выделение ----------
+
+    def get_spatial_index(self):
+        """Сетка по центрам ячеек (строится при первом запросе после перестроения)."""
+        if self._spatial_index is None:
+            xs = [c[0] for c in self._row_centres]
+            ys = [c[1] for c in self._row_centres]
+            self._spatial_index = CellSpatialIndex(xs, ys, self.hex_size * 2.0)
+        return self._spatial_index
+
+    def _event_point(self, event):
+        """(x, y) события на Canvas и те же координаты в системе индекса (без панорамы)."""
+        cx = self.canvas.canvasx(event.x)
+        cy = self.canvas.canvasy(event.y)
+        pan_x, pan_y = self.pan_offset
+        return cx, cy, cx - pan_x, cy - pan_y
+
+    def on_tool_press(self, event):
+        tool = self.tool_var.get()
+        if tool == TOOL_EDIT or not self.cells:
+            return
+        cx, cy, x, y = self._event_point(event)
+        add = bool(event.state & 0x0001)  # Shift
+        if tool == TOOL_BRUSH:
+            self._tool_state = {"tool": tool, "painted": set(), "last": (x, y)}
+            self._brush_at(x, y)
+        elif tool == TOOL_RECT:
+            item = self.canvas.create_rectangle(
+                cx, cy, cx, cy, outline="#0060C0", dash=(4, 2), tags=("selection_shape",)
+            )
+            self._tool_state = {"tool": tool, "start": (cx, cy), "item": item, "add": add}
+        elif tool == TOOL_LASSO:
+            item = self.canvas.create_line(
+                cx, cy, cx, cy, fill="#0060C0", dash=(4, 2), tags=("selection_shape",)
+            )
+            self._tool_state = {"tool": tool, "points": [cx, cy], "item": item, "add": add}
+
+    def on_tool_move(self, event):
+        state = self._tool_state
+        if state is None:
+            return
+        cx, cy, x, y = self._event_point(event)
+        tool = state["tool"]
+        if tool == TOOL_BRUSH:
+            # промежуточные точки — чтобы быстрое движение не пропускало ячейки
+            lx, ly = state["last"]
+            step = max(self.hex_size * 0.5, 1.0)
+            n = max(int(math.hypot(x - lx, y - ly) / step), 1)
+            for i in range(1, n + 1):
+                self._brush_at(lx + (x - lx) * i / n, ly + (y - ly) * i / n)
+            state["last"] = (x, y)
+        elif tool == TOOL_RECT:
+            x0, y0 = state["start"]
+            self.canvas.coords(state["item"], x0, y0, cx, cy)
+        elif tool == TOOL_LASSO:
+            state["points"].extend((cx, cy))
+            self.canvas.coords(state["item"], *state["points"])
+
+    def on_tool_release(self, event):
+        state = self._tool_state
+        self._tool_state = None
+        if state is None:
+            return
+        self.canvas.delete("selection_shape")
+        pan_x, pan_y = self.pan_offset
+        tool = state["tool"]
+        if tool == TOOL_BRUSH:
+            self._finish_brush(state["painted"])
+        elif tool == TOOL_RECT:
+            cx, cy, _, _ = self._event_point(event)
+            x0, y0 = state["start"]
+            rows = self.get_spatial_index().in_rect(x0 - pan_x, y0 - pan_y, cx - pan_x, cy - pan_y)
+            self.set_selection(rows.tolist(), add=state["add"])
+        elif tool == TOOL_LASSO:
+            pts = state["points"]
+            polygon = [(pts[i] - pan_x, pts[i + 1] - pan_y) for i in range(0, len(pts), 2)]
+            rows = self.get_spatial_index().in_polygon(polygon)
+            self.set_selection(rows.tolist(), add=state["add"])
+
+    def _brush_at(self, x, y):
+        """Закрасить ячейку под кистью цветом текущего типа (только на Canvas)."""
+        row = self.get_spatial_index().nearest(x, y, self.hex_size * 0.9)
+        state = self._tool_state
+        if row < 0 or row in state["painted"]:
+            return
+        state["painted"].add(row)
+        t = self.current_fuel_var.get()
+        if not 0 <= t < len(self.fuel_types):
+            return
+        if self._raster_mode:
+            # предпросмотр мазка — векторной фигурой поверх растра до его перерисовки
+            x, y = self._row_centres[row]
+            px, py = self.pan_offset
+            cell = self.cells[self._row_cids[row]]
+            self._create_cell_items(
+                x + px, y + py, cell["shape"], self.fuel_types[t]["color"],
+                cell["pos_label"], "", tags=("brush_preview",), text_tags=("brush_preview",)
+            )
+            return
+        self.canvas.tk.call(
+            str(self.canvas), "itemconfigure", self._row_cids[row],
+            "-fill", self.fuel_types[t]["color"]
         )
-        cell["mass_fuel"] = new_data.get("mass_fuel", cell.get("mass_fuel", ""))
-        cell["mass_boron"] = new_data.get("mass_boron", cell.get("mass_boron", ""))
-        cell["mass_gd"] = new_data.get("mass_gd", cell.get("mass_gd", ""))
+        if self._applied_styles is not None:
+            # предпросмотр расходится с раскраской — строку перекрасить заново
+            self._applied_styles[row] = None
+
+    def _finish_brush(self, rows):
+        """Записать мазок кистью одной транзакцией: одна перекраска и пересчёт в конце."""
+        t = self.current_fuel_var.get()
+        if not rows:
+            return
+        applied = []
+        if 0 <= t < len(self.fuel_types):
+            applied = self.apply_cell_changes(
+                [(self._row_cids[row], "fuel_type", t) for row in sorted(rows)]
+            )
+        if not applied:
+            self.apply_coloring_mode()  # вернуть стиль ячеек после предпросмотра
+
+    def set_selection(self, rows, add=False):
+        """Выделить строки (с Shift — добавить к текущему выделению)."""
+        rows = set(rows)
+        self.selected_rows = (self.selected_rows | rows) if add else rows
+        self.highlight_cells(self._row_cids[row] for row in sorted(self.selected_rows))
+        self.selection_var.set(f"Выделено: {len(self.selected_rows)}")
+
+    def clear_selection(self):
+        self.selected_rows = set()
+        self.clear_highlight()
+        self.selection_var.set("Выделено: 0")
 
-        self.recalculate_type_stats()
-        self.apply_coloring_mode()
-        self.update_mass_stats_for_selected_type()
+    def select_ring(self):
+        import numpy as np
+        try:
+            ring = int(self.select_ring_var.get())
+        except (tk.TclError, ValueError):
+            messagebox.showerror("Выделение", "Номер кольца должен быть целым числом.")
+            return
+        cols = self.get_columns()
+        self.set_selection(np.flatnonzero(cols.ring == ring).tolist())
+
+    def select_current_type(self):
+        import numpy as np
+        cols = self.get_columns()
+        self.set_selection(np.flatnonzero(cols.fuel_type == self.current_fuel_var.get()).tolist())
+
+    def assign_type_to_selection(self):
+        """Назначить выделенным ячейкам текущий тип ТВС одной транзакцией."""
+        t = self.current_fuel_var.get()
+        if not self.selected_rows or not 0 <= t < len(self.fuel_types):
+            return
+        self.apply_cell_changes(
+            [(self._row_cids[row], "fuel_type", t) for row in sorted(self.selected_rows)]
+        )
 
     # ---------- Масштабирование и панорамирование ----------
 
@@ -1251,10 +6978,267 @@ class CoreMapGUI:
         dx = event.x - x0
         dy = event.y - y0
         self._drag_start = (event.x, event.y)
+        self._pan_by(dx, dy)
 
+    def _pan_by(self, dx, dy):
+        """
+        Сдвиг вида без перестроения: все элементы Canvas переносятся целиком
+        (центры ячеек хранятся без сдвига, индекс и раскраска не меняются).
+        """
+        if not dx and not dy:
+            return
         px, py = self.pan_offset
         self.pan_offset = (px + dx, py + dy)
-        self._rebuild_from_current_state()
+        self.canvas.move("all", dx, dy)
+        if self._raster_mode:
+            self._request_raster()
+        else:
+            self.canvas.configure(scrollregion=self.canvas.bbox("all"))
+        self._draw_minimap_viewport()
+
+    # ---------- Растровый режим ----------
+
+    def toggle_raster_view(self):
+        """Переключить Canvas между фигурами всех ячеек и одним растровым изображением."""
+        self.on_canvas_leave(None)
+        if self.cells:
+            self._rebuild_from_current_state()
+
+    def _raster_relayout(self):
+        """Новые центры ячеек после зума или поворота; растр перерисовывается в фоне."""
+        cols = self.get_columns()
+        xs, ys, self.hex_size, self.base_hex_size = cell_layout(
+            cols.q, cols.r, self.rotation_angle_deg,
+            self.canvas_width, self.canvas_height, self.zoom_factor
+        )
+        self._row_centres = list(zip(xs.tolist(), ys.tolist()))
+        self._spatial_index = None
+        pos_size, factory_size = label_font_sizes(self.hex_size)
+        self.font_pos.configure(size=pos_size)
+        self.font_factory.configure(size=factory_size)
+        row = self._hover_row
+        self._hover_row = -1
+        self._set_hover_row(row)
+        self._draw_raster_overlay()
+        self._draw_validation_marks()
+        self._diff_arrows_key = None
+        self.draw_diff_arrows()
+        self._request_raster()
+        self._draw_minimap_viewport()
+        self._request_minimap()     # поворот меняет и миниатюру
+
+    def _raster_view_model(self):
+        """CartogramModel текущих данных для отрисовки растра (одна на версию данных)."""
+        cache = self._raster_model
+        if cache is None or cache[0] != self._data_version:
+            model = CartogramModel(self._current_cells_data(), self.fuel_types, "", self.get_columns())
+            cache = (self._data_version, model)
+            self._raster_model = cache
+        return cache[1]
+
+    def _request_raster(self):
+        """Перерисовать растр после короткой паузы (серия событий — одна перерисовка)."""
+        if self._raster_after is not None:
+            self.master.after_cancel(self._raster_after)
+        self._raster_after = self.master.after(RASTER_DEBOUNCE_MS, self._start_raster_render)
+
+    def _start_raster_render(self):
+        self._raster_after = None
+        if not self._raster_mode or not self.cells or self._applied_styles is None:
+            return
+        if self._raster_future is not None:
+            self._raster_pending = True     # дорисовать после текущей задачи
+            return
+        styles = [style or BLANK_STYLE for style in self._applied_styles]
+        pan = self.pan_offset
+        token = self._raster_token
+        future = self._render_pool().submit(
+            render_view_png, self._raster_view_model(), styles,
+            self.canvas_width, self.canvas_height,
+            self.rotation_angle_deg, self.zoom_factor, pan,
+        )
+        self._raster_future = future
+        self._when_done(future, lambda: self._finish_raster_render(future, pan, token), poll_ms=20)
+
+    def _finish_raster_render(self, future, pan, token):
+        """Показать готовый растр: сдвиг, сделанный за время отрисовки, учитывается."""
+        self._raster_future = None
+        if self._raster_pending:
+            self._raster_pending = False
+            self._start_raster_render()
+        try:
+            data = future.result()
+        except Exception as e:
+            messagebox.showerror("Растровый режим", f"Не удалось нарисовать картограмму:\n{e}")
+            return
+        if not self._raster_mode or token != self._raster_token:
+            return      # Canvas перестроен — растр устарел
+
+        image = tk.PhotoImage(master=self.canvas, data=data, format="png")
+        px, py = self.pan_offset
+        x = px - pan[0]
+        y = py - pan[1]
+        if self._raster_item is None:
+            self._raster_item = self.canvas.create_image(
+                x, y, image=image, anchor="nw", tags=("raster", "cell")
+            )
+            self.canvas.tag_lower(self._raster_item)
+        else:
+            self.canvas.itemconfigure(self._raster_item, image=image)
+            self.canvas.coords(self._raster_item, x, y)
+        self._raster_image = image
+        if self._tool_state is None:
+            self.canvas.delete("brush_preview")
+
+    def _create_row_overlay(self, row, tag, highlighted):
+        """Векторная ячейка строки row поверх растра (стиль — как в текущей раскраске)."""
+        x, y = self._row_centres[row]
+        px, py = self.pan_offset
+        cell = self.cells[self._row_cids[row]]
+        applied = self._applied_styles
+        fill, outline, width, label, label_fill = (
+            applied[row] if applied is not None and applied[row] is not None else BLANK_STYLE
+        )
+        if highlighted:
+            outline, width = "red", 3
+        self._create_cell_items(
+            x + px, y + py, cell["shape"], fill, cell["pos_label"], label,
+            outline=outline, width=width, label_fill=label_fill,
+            tags=(tag, "cell"), text_tags=(tag, "cell"),
+        )
+
+    def _draw_raster_overlay(self):
+        """Подсвеченные (выделенные, найденные) ячейки в видимой области — векторными фигурами."""
+        self.canvas.delete("overlay")
+        if not self.highlighted_cells:
+            return
+        px, py = self.pan_offset
+        margin = self.hex_size
+        x0, y0 = -px - margin, -py - margin
+        x1, y1 = x0 + self.canvas_width + 2 * margin, y0 + self.canvas_height + 2 * margin
+        shown = 0
+        for cid in self.highlighted_cells:
+            row = self._cid_row.get(cid)
+            if row is None:
+                continue
+            x, y = self._row_centres[row]
+            if not (x0 <= x <= x1 and y0 <= y <= y1):
+                continue
+            self._create_row_overlay(row, "overlay", True)
+            shown += 1
+            if shown >= RASTER_OVERLAY_MAX:
+                break
+        self.canvas.tag_raise("hover")
+
+    def _set_hover_row(self, row):
+        """Векторная ячейка под курсором (row = -1 — убрать)."""
+        if row == self._hover_row:
+            return
+        self.canvas.delete("hover")
+        self._hover_row = row
+        if row >= 0:
+            self._create_row_overlay(row, "hover", self._row_cids[row] in self.highlighted_cells)
+
+    # ---------- Обзорная миникарта ----------
+
+    def _minimap_scale(self):
+        """Во сколько раз миникарта меньше холста."""
+        return MINIMAP_SIZE / max(self.canvas_width, self.canvas_height)
+
+    def _render_pool(self):
+        """Один фоновый поток для отрисовки Pillow (растр вида, миниатюра)."""
+        if self._raster_pool is None:
+            self._raster_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="raster")
+        return self._raster_pool
+
+    def _request_minimap(self):
+        """Перерисовать миниатюру, если изменились цвета ячеек или поворот."""
+        if not self.cells or self._applied_styles is None:
+            return
+        if self._minimap_after is not None:
+            self.master.after_cancel(self._minimap_after)
+        self._minimap_after = self.master.after(MINIMAP_DEBOUNCE_MS, self._start_minimap_render)
+
+    def _start_minimap_render(self):
+        self._minimap_after = None
+        if not self.cells or self._applied_styles is None:
+            return
+        cols = self.get_columns()
+        styles = [style or BLANK_STYLE for style in self._applied_styles]
+        key = (self.rotation_angle_deg, cols.q.tobytes(), cols.r.tobytes(), styles)
+        if key == self._minimap_key:
+            return      # цвета и расположение те же — миниатюра актуальна
+        if self._minimap_future is not None:
+            self._minimap_pending = True
+            return
+        future = self._render_pool().submit(
+            render_minimap_png, self._raster_view_model(), styles,
+            self.canvas_width, self.canvas_height, self.rotation_angle_deg, self._minimap_scale(),
+        )
+        self._minimap_future = future
+        self._when_done(future, lambda: self._finish_minimap_render(future, key))
+
+    def _finish_minimap_render(self, future, key):
+        self._minimap_future = None
+        if self._minimap_pending:
+            self._minimap_pending = False
+            self._start_minimap_render()
+        try:
+            data = future.result()
+        except Exception:
+            return      # миникарта вспомогательная — без сообщения
+        image = tk.PhotoImage(master=self.minimap_canvas, data=data, format="png")
+        if self._minimap_item is None:
+            self._minimap_item = self.minimap_canvas.create_image(0, 0, image=image, anchor="nw")
+            self.minimap_canvas.tag_lower(self._minimap_item)
+        else:
+            self.minimap_canvas.itemconfigure(self._minimap_item, image=image)
+        self._minimap_image = image
+        self._minimap_key = key
+
+    def _minimap_view_centre(self):
+        """Центр видимой области в координатах миникарты."""
+        z = self.zoom_factor
+        s = self._minimap_scale()
+        px, py = self.pan_offset
+        return (self.canvas_width / 2.0 - px / z) * s, (self.canvas_height / 2.0 - py / z) * s
+
+    def _draw_minimap_viewport(self):
+        """Прямоугольник видимой области поверх миниатюры."""
+        s = self._minimap_scale()
+        cx, cy = self._minimap_view_centre()
+        half_w = self.canvas_width * s / (2.0 * self.zoom_factor)
+        half_h = self.canvas_height * s / (2.0 * self.zoom_factor)
+        coords = (cx - half_w, cy - half_h, cx + half_w, cy + half_h)
+        if self.minimap_canvas.find_withtag("viewport"):
+            self.minimap_canvas.coords("viewport", *coords)
+        else:
+            self.minimap_canvas.create_rectangle(*coords, outline="red", width=2, tags=("viewport",))
+
+    def _minimap_pan(self, dx, dy):
+        """Сдвиг рамки на миникарте на (dx, dy) пикселей — сдвиг вида в обратную сторону."""
+        k = self.zoom_factor / self._minimap_scale()
+        self._pan_by(-dx * k, -dy * k)
+
+    def on_minimap_press(self, event):
+        """Щелчок вне рамки переносит вид в эту точку; дальше рамку можно тянуть."""
+        if not self.cells:
+            return
+        x0, y0, x1, y1 = self.minimap_canvas.coords("viewport") or (0, 0, 0, 0)
+        if not (x0 <= event.x <= x1 and y0 <= event.y <= y1):
+            cx, cy = self._minimap_view_centre()
+            self._minimap_pan(event.x - cx, event.y - cy)
+        self._minimap_drag = (event.x, event.y)
+
+    def on_minimap_drag(self, event):
+        if self._minimap_drag is None:
+            return
+        x0, y0 = self._minimap_drag
+        self._minimap_drag = (event.x, event.y)
+        self._minimap_pan(event.x - x0, event.y - y0)
+
+    def on_minimap_release(self, event):
+        self._minimap_drag = None
 
     # ---------- Поворот картограммы ----------
 
@@ -1303,19 +7287,17 @@ class CoreMapGUI:
             f"m_B: {mass_boron}",
             f"m_Gd: {mass_gd}",
         ]
+        for key, value in (cell.get("extra") or {}).items():
+            lines.append(f"{key}: {value}")
         return "\n".join(lines)
 
     def on_canvas_motion(self, event):
-        ids = self.canvas.find_withtag("current")
-        cell_id = None
-        for cid in ids:
-            if cid in self.cells:
-                cell_id = cid
-                break
-
+        cell_id = self._cell_at_event(event)
         if cell_id is None:
             self.on_canvas_leave(event)
             return
+        if self._raster_mode:
+            self._set_hover_row(self._cid_row[cell_id])
 
         cell = self.cells[cell_id]
         text = self.build_tooltip_text(cell)
@@ -1344,12 +7326,401 @@ class CoreMapGUI:
         self.tooltip_cell_id = cell_id
 
     def on_canvas_leave(self, event):
+        if self._raster_mode:
+            self._set_hover_row(-1)
         if self.tooltip_window is not None:
             self.tooltip_window.destroy()
             self.tooltip_window = None
             self.tooltip_label = None
             self.tooltip_cell_id = None
 
+    # ---------- Набор картограмм (циклы) ----------
+
+    def open_workspace(self, paths=None):
+        """Открыть набор картограмм (последовательность циклов) и показать первую."""
+        if not paths:
+            paths = filedialog.askopenfilenames(
+                title="Набор картограмм (CSV)",
+                filetypes=[("CSV файлы", "*.csv"), ("Все файлы", "*.*")]
+            )
+        paths = [os.path.abspath(p) for p in (paths or [])]
+        if not paths:
+            return False
+
+        self._leave_workspace_item()
+        self.workspace_paths = paths
+        self.workspace_pos = -1
+        return self.show_workspace_item(0, reset_view=True)
+
+    def step_workspace(self, delta):
+        if not self.workspace_paths:
+            return
+        pos = self.workspace_pos if self.workspace_pos >= 0 else 0
+        pos = max(0, min(len(self.workspace_paths) - 1, pos + delta))
+        if pos != self.workspace_pos:
+            self.show_workspace_item(pos)
+
+    def _leave_workspace_item(self):
+        """Запомнить состояние текущей картограммы набора (с правками) перед переключением."""
+        if not (0 <= self.workspace_pos < len(self.workspace_paths)):
+            return
+        path = self.workspace_paths[self.workspace_pos]
+        entry = self.workspace_cache.get(path)
+        if entry is None:
+            entry = WorkspaceEntry(path)
+        if entry.version != self._data_version:
+            # картограмму правили — сохраняем её текущее состояние
+            entry.cells_data = self._current_cells_data()
+            entry.type_names = [ft["name"] for ft in self.fuel_types]
+            entry.version = self._data_version
+            entry.dirty = True
+        cache = self._columns_cache
+        if cache is not None and cache[0] == entry.version:
+            entry.columns = cache[1]
+        self.workspace_cache.put(entry)
+        self._set_workspace_pos(-1)
+
+    def _set_workspace_pos(self, pos, dirty=False):
+        """Текущий элемент набора (-1 — показана картограмма не из набора) и его подпись."""
+        self.workspace_pos = pos
+        n = len(self.workspace_paths)
+        if not (0 <= pos < n):
+            self.workspace_label_var.set(f"—/{n}: картограмма не из набора")
+            return
+        name = os.path.basename(self.workspace_paths[pos])
+        self.workspace_label_var.set(f"{pos + 1}/{n}: {name}{' *' if dirty else ''}")
+
+    def _workspace_saved(self, path, cells_data, type_names, version):
+        """
+        Картограмма записана в path. Если это текущий элемент набора, он больше
+        не правленый (и может вытесняться из кэша); другой элемент набора с этим
+        путём перечитывается с диска при следующем показе.
+        """
+        path = os.path.abspath(path)
+        if path not in self.workspace_paths:
+            return
+        pos = self.workspace_pos
+        if not (0 <= pos < len(self.workspace_paths)) or self.workspace_paths[pos] != path:
+            self.workspace_cache.discard(path)
+            return
+        entry = WorkspaceEntry(path, mtime=os.path.getmtime(path))
+        entry.cells_data = cells_data       # в порядке строк, как показаны при сохранении
+        entry.type_names = type_names
+        entry.version = version
+        self.workspace_cache.put(entry)
+        self._set_workspace_pos(pos, dirty=self._data_version != version)
+
+    def _current_cells_data(self):
+        """Снимок ячеек в порядке строк (без id Canvas)."""
+        keys = ("index", "q", "r", "shape", "fuel_type", "pos_label",
+                "factory_id", "mass_fuel", "mass_boron", "mass_gd", "extra")
+        cells_data = []
+        for cell in self.cells.values():
+            data = {k: cell.get(k, "") for k in keys}
+            if "shape_source" in cell:
+                data["shape_source"] = cell["shape_source"]
+            cells_data.append(data)
+        return cells_data
+
+    def _workspace_entry(self, path):
+        """Запись набора из кэша, из фоновой предзагрузки или прочитанная сейчас."""
+        entry = self.workspace_cache.get(path)
+        if entry is not None and not entry.dirty and entry.mtime is not None:
+            try:
+                if os.path.getmtime(path) != entry.mtime:
+                    entry = None    # файл изменился на диске — перечитать
+            except OSError:
+                pass
+        if entry is not None:
+            return entry
+
+        future = self._prefetch_futures.pop(path, None)
+        if future is not None:
+            try:
+                entry = future.result()
+            except Exception:
+                entry = None
+        if entry is None or entry.mtime != os.path.getmtime(path):
+            entry = read_workspace_entry(path)
+        self.workspace_cache.put(entry)
+        return entry
+
+    def show_workspace_item(self, pos, reset_view=False):
+        """Показать картограмму набора с номером pos."""
+        path = self.workspace_paths[pos]
+        previous = self.workspace_pos
+        self._leave_workspace_item()
+
+        def restore():
+            # картограмма не сменилась — текущим остаётся прежний элемент набора
+            entry = None
+            if 0 <= previous < len(self.workspace_paths):
+                entry = self.workspace_cache.get(self.workspace_paths[previous])
+            self._set_workspace_pos(previous, entry is not None and entry.dirty)
+
+        try:
+            entry = self._workspace_entry(path)
+        except ValueError as e:
+            restore()
+            messagebox.showerror("Ошибка", f"{os.path.basename(path)}:\n{e}")
+            return False
+        except Exception as e:
+            restore()
+            messagebox.showerror("Ошибка", f"Не удалось прочитать CSV:\n{e}")
+            return False
+
+        if not entry.dirty:
+            recovered = self._recover_from_journal(path, entry.rows)
+            if recovered is not None:
+                # правки из журнала — как несохранённые правки элемента набора
+                entry.rows = recovered
+                entry.cells_data = None
+                entry.type_names = None
+                entry.dirty = True
+
+        # индексы типов действительны, пока список типов только дополнялся
+        names = [ft["name"] for ft in self.fuel_types]
+        types_valid = (
+            entry.cells_data is not None
+            and entry.type_names is not None
+            and names[:len(entry.type_names)] == entry.type_names
+        )
+        if not types_valid:
+            if entry.dirty and entry.cells_data is not None:
+                # правки сохранены со старыми индексами — переводим через названия
+                rows = [
+                    dict(c, fuel_type=entry.type_names[c["fuel_type"]])
+                    for c in entry.cells_data
+                ]
+            else:
+                rows = entry.rows
+            try:
+                entry.cells_data = self._cells_data_from_rows(rows)
+            except Exception as e:
+                restore()
+                messagebox.showerror("Ошибка", f"Некорректный формат CSV:\n{e}")
+                return False
+            entry.type_names = [ft["name"] for ft in self.fuel_types]
+            entry.version = None
+            entry.columns = None
+
+        # версия данных назначается до перерисовки, чтобы кэши раскрасок
+        # и столбцов относились именно к этой картограмме; если картограмма
+        # уже показывалась, её прежние раскраски берутся из LRU
+        if entry.version is None:
+            entry.version = next(self._version_counter)
+        self._data_version = entry.version
+        if entry.columns is not None:
+            self._columns_cache = (entry.version, entry.columns)
+
+        cells_data = entry.cells_data
+        if not reset_view and self._same_geometry(cells_data):
+            # та же решётка: только обновить данные ячеек и перекрасить
+            # (на Canvas уходят только отличия раскраски)
+            self._replace_cells_data_in_place(cells_data)
+            self.recalculate_type_stats()
+            self.build_legend()
+            self.apply_coloring_mode()
+        else:
+            self.zoom_factor = 1.0
+            self.pan_offset = (0.0, 0.0)
+            self.build_from_cells_data(cells_data, data_changed=False)
+        self.reset_history()
+        self.clear_selection()
+        self._journal_attach(path, unsaved=entry.dirty)
+        self.update_fuel_type_combo()
+        self.update_mass_stats_for_selected_type()
+        self.validate_current(None if entry.dirty else entry.rows)
+        self._set_workspace_pos(pos, entry.dirty)
+        self._prefetch_workspace_neighbours(pos)
+        return True
+
+    def _same_geometry(self, cells_data):
+        """Совпадает ли решётка (q, r, форма в том же порядке) с текущей на Canvas."""
+        if len(cells_data) != len(self.cells) or not self.cells:
+            return False
+        for cell, new in zip(self.cells.values(), cells_data):
+            if cell["q"] != new["q"] or cell["r"] != new["r"] or cell["shape"] != new["shape"]:
+                return False
+        return True
+
+    def _replace_cells_data_in_place(self, cells_data):
+        """Заменить данные ячеек, не пересоздавая фигуры на Canvas."""
+        call = self.canvas.tk.call
+        path = str(self.canvas)
+        n_types = len(self.fuel_types)
+        for cell, new in zip(self.cells.values(), cells_data):
+            fuel_type = int(new.get("fuel_type", 0))
+            cell["fuel_type"] = fuel_type if 0 <= fuel_type < n_types else 0
+            cell["index"] = new["index"]
+            cell["factory_id"] = str(new.get("factory_id", "") or "")
+            for field in MASS_FIELDS:
+                cell[field] = str(new.get(field, "") or "")
+            if new.get("extra"):
+                cell["extra"] = dict(new["extra"])
+            else:
+                cell.pop("extra", None)
+            if new.get("shape_source") is not None:
+                cell["shape_source"] = new["shape_source"]
+            else:
+                cell.pop("shape_source", None)
+            pos_label = str(new.get("pos_label", new["index"]))
+            if pos_label != cell["pos_label"]:
+                cell["pos_label"] = pos_label
+                if cell["text_pos_id"]:
+                    call(path, "itemconfigure", cell["text_pos_id"], "-text", pos_label)
+        self.clear_highlight()
+
+    def _prefetch_workspace_neighbours(self, pos):
+        """Фоновая предзагрузка соседних картограмм набора."""
+        if self._prefetch_pool is None:
+            self._prefetch_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch")
+        for p in (pos + 1, pos - 1):
+            if not (0 <= p < len(self.workspace_paths)):
+                continue
+            path = self.workspace_paths[p]
+            if self.workspace_cache.get(path) is not None or path in self._prefetch_futures:
+                continue
+            self._prefetch_futures[path] = self._prefetch_pool.submit(read_workspace_entry, path)
+
+    # ---------- Сравнение картограмм ----------
+
+    def load_diff_base(self):
+        """Загрузить картограмму для сравнения с текущей (например, предыдущий цикл)."""
+        if not self.cells:
+            messagebox.showwarning("Сравнение", "Нет текущей картограммы.")
+            return
+        filename = filedialog.askopenfilename(
+            title="Картограмма для сравнения (CSV)",
+            filetypes=[("CSV файлы", "*.csv"), ("Все файлы", "*.*")]
+        )
+        if not filename:
+            return
+
+        try:
+            rows = read_cartogram_csv(filename)
+            n_types = len(self.fuel_types)
+            base_cells = self._cells_data_from_rows(rows)
+        except Exception as e:
+            messagebox.showerror("Ошибка", f"Не удалось прочитать CSV:\n{e}")
+            return
+
+        if len(self.fuel_types) != n_types:
+            # в сравниваемой картограмме встретились новые типы ТВС
+            self.recalculate_type_stats()
+            self.build_legend()
+            self.update_fuel_type_combo()
+
+        self.diff_base_cells = base_cells
+        self.diff_base_name = os.path.basename(filename)
+        self._diff_token += 1
+        self._diff_cache = None
+
+        self.coloring_mode_var.set("Сравнение: классы ячеек")
+        self.color_mode_combo.set("Сравнение: классы ячеек")
+        self.apply_coloring_mode()
+
+    def clear_diff(self):
+        self.diff_base_cells = None
+        self.diff_base_name = ""
+        self._diff_token += 1
+        self._diff_cache = None
+        self.diff_summary_var.set("Сравнение не загружено")
+        self.canvas.delete("diff_arrow")
+        self._diff_arrows_key = None
+        if self.coloring_mode_var.get() in DIFF_MODES:
+            self.coloring_mode_var.set("По типам ТВС")
+            self.color_mode_combo.set("По типам ТВС")
+        self.apply_coloring_mode()
+
+    def get_diff(self):
+        """CartogramDiff текущей картограммы с загруженной для сравнения (кэш по версии)."""
+        if self.diff_base_cells is None:
+            return None
+        key = (self._data_version, self._diff_token)
+        cache = self._diff_cache
+        if cache is None or cache[0] != key:
+            diff = CartogramDiff(CellColumns(self.diff_base_cells), self.get_columns())
+            cache = (key, diff)
+            self._diff_cache = cache
+
+            counts = diff.counts()
+            parts = [f"{name}: {count}" for name, count in counts.items() if count]
+            self.diff_summary_var.set(
+                f"С {self.diff_base_name}:\n" + "; ".join(parts)
+            )
+        return cache[1]
+
+    def _cell_center(self, cid):
+        """Центр ячейки на Canvas (с учётом сдвига; фигуры в растровом режиме нет)."""
+        x, y = self._row_centres[self._cid_row[cid]]
+        px, py = self.pan_offset
+        return x + px, y + py
+
+    def draw_diff_arrows(self):
+        """Стрелки от прежней позиции к текущей для перемещённых ТВС."""
+        diff = self.get_diff() if self.show_diff_arrows_var.get() else None
+        key = None if diff is None else (self._data_version, self._diff_token)
+        if key == self._diff_arrows_key and key is not None:
+            return
+        self.canvas.delete("diff_arrow")
+        self._diff_arrows_key = key
+        if diff is None:
+            return
+
+        import numpy as np
+
+        new = diff.new
+        pos_row = {(q, r): i for i, (q, r) in enumerate(zip(new.q.tolist(), new.r.tolist()))}
+        width = max(1, int(self.hex_size * 0.12))
+        for i in np.flatnonzero(diff.category == DIFF_MOVED).tolist():
+            k = int(diff.moved_from_row[i])
+            src = pos_row.get((int(diff.old.q[k]), int(diff.old.r[k])))
+            if src is None:
+                continue
+            x0, y0 = self._cell_center(self._row_cids[src])
+            x1, y1 = self._cell_center(self._row_cids[i])
+            self.canvas.create_line(
+                x0, y0, x1, y1,
+                arrow=tk.LAST,
+                fill="#0055CC",
+                width=width,
+                tags=("diff_arrow",)
+            )
+
+    def export_diff_csv(self):
+        diff = self.get_diff()
+        if diff is None:
+            messagebox.showwarning("Экспорт", "Сравнение не загружено.")
+            return
+
+        filename = filedialog.asksaveasfilename(
+            title="Сохранить таблицу различий в CSV",
+            defaultextension=".csv",
+            filetypes=[("CSV файлы", "*.csv"), ("Все файлы", "*.*")]
+        )
+        if not filename:
+            return
+
+        def type_name(idx):
+            return self.fuel_types[idx]["name"] if 0 <= idx < len(self.fuel_types) else ""
+
+        try:
+            with open(filename, "w", newline="", encoding="utf-8") as f:
+                writer = csv.writer(f, delimiter=";")
+                writer.writerow(DIFF_TABLE_COLUMNS)
+                for row in diff.table_rows(type_name):
+                    values = []
+                    for col in DIFF_TABLE_COLUMNS:
+                        v = row[col]
+                        if isinstance(v, float):
+                            v = "" if math.isnan(v) else f"{v:.6g}"
+                        values.append(v)
+                    writer.writerow(values)
+            messagebox.showinfo("Экспорт", "Таблица различий сохранена.")
+        except Exception as e:
+            messagebox.showerror("Ошибка", f"Не удалось сохранить CSV:\n{e}")
+
     # ---------- Поиск ----------
 
     def search_by_pos(self):
@@ -1375,14 +7746,124 @@ class CoreMapGUI:
         if not query:
             messagebox.showinfo("Поиск", "Введите заводской номер.")
             return
-        matches = [cid for cid, cell in self.cells.items()
-                   if str(cell.get("factory_id", "")).strip() == query]
-        if not matches:
-            self.clear_highlight()
-            messagebox.showinfo("Поиск", "Ячейки с таким заводским номером не найдено.")
+        matches = [cid for cid, cell in self.cells.items()
+                   if str(cell.get("factory_id", "")).strip() == query]
+        if not matches:
+            self.clear_highlight()
+            messagebox.showinfo("Поиск", "Ячейки с таким заводским номером не найдено.")
+            return
+        self.highlight_cells(matches)
+        messagebox.showinfo("Поиск", f"Найдено ячеек: {len(matches)}.")
+
+    def _evaluate_query(self):
+        """Разобрать (с кэшем) и выполнить запрос; вернуть номера строк или None."""
+        text = self.query_entry.get().strip()
+        if not text:
+            messagebox.showinfo("Запрос", "Введите условие запроса.")
+            return None
+
+        query = self._query_cache.get(text)
+        if query is None:
+            try:
+                query = CellQuery(text)
+            except ValueError as e:
+                messagebox.showerror("Запрос", f"Ошибка в запросе:\n{e}")
+                return None
+            self._query_cache[text] = query
+
+        import numpy as np
+        return np.flatnonzero(query.evaluate(self.get_columns()))
+
+    # ---------- Вычисляемые столбцы ----------
+
+    def _computed_column_of(self, mode):
+        """ComputedColumn режима окраски «Вычисл.: имя» или None."""
+        if not mode.startswith(COMPUTED_MODE_PREFIX):
+            return None
+        return self.computed_columns.get(mode[len(COMPUTED_MODE_PREFIX):])
+
+    def _update_computed_columns(self):
+        """Список режимов окраски и подпись после добавления / удаления столбца."""
+        self.color_mode_combo.configure(
+            values=COLOR_MODES + [COMPUTED_MODE_PREFIX + name for name in self.computed_columns]
+        )
+        self.computed_list_var.set("\n".join(
+            f"{c.name} = {c.text}" for c in self.computed_columns.values()
+        ))
+        self.update_mass_stats_for_selected_type()
+
+    def add_computed_column(self):
+        """Добавить (или заменить) столбец из строки «имя = выражение»."""
+        name, sep, text = self.computed_entry.get().partition("=")
+        name = name.strip()
+        text = text.strip()
+        if not sep or not name or not text:
+            messagebox.showinfo("Вычисляемый столбец", "Введите «имя = выражение».")
+            return
+        if name in STAT_METRICS:
+            messagebox.showerror("Вычисляемый столбец", f"Имя {name!r} занято встроенной величиной.")
+            return
+        try:
+            column = ComputedColumn(name, text)
+            if self.cells:
+                self.get_columns().computed(column)     # ошибка — сразу, а не при окраске
+        except ValueError as e:
+            messagebox.showerror("Вычисляемый столбец", f"Ошибка в выражении:\n{e}")
+            return
+
+        self.computed_columns[name] = column
+        self._update_computed_columns()
+        if self._computed_column_of(self.coloring_mode_var.get()) is column:
+            self.apply_coloring_mode()      # выражение показанного столбца изменилось
+
+    def remove_computed_column(self):
+        """Удалить столбец, имя которого введено в поле (до «=»)."""
+        name = self.computed_entry.get().partition("=")[0].strip()
+        if name not in self.computed_columns:
+            messagebox.showinfo("Вычисляемый столбец", f"Нет столбца {name!r}.")
+            return
+        shown = self._computed_column_of(self.coloring_mode_var.get()) is not None
+        del self.computed_columns[name]
+        self._update_computed_columns()
+        if shown and self._computed_column_of(self.coloring_mode_var.get()) is None:
+            self.coloring_mode_var.set(COLOR_MODE_TYPES)
+            self.color_mode_combo.set(COLOR_MODE_TYPES)
+            self.apply_coloring_mode()
+
+    def run_query(self):
+        if not self.cells:
+            return
+        rows = self._evaluate_query()
+        if rows is None:
+            return
+        self.highlight_cells(self._row_cids[i] for i in rows.tolist())
+        self.query_result_var.set(f"Найдено ячеек: {rows.size} из {len(self.cells)}")
+
+    def export_query_csv(self):
+        if not self.cells:
+            messagebox.showwarning("Экспорт", "Нет данных картограммы.")
+            return
+        rows = self._evaluate_query()
+        if rows is None:
+            return
+        if not rows.size:
+            messagebox.showinfo("Экспорт", "Запросу не соответствует ни одна ячейка.")
+            return
+
+        filename = filedialog.asksaveasfilename(
+            title="Сохранить результаты запроса в CSV",
+            defaultextension=".csv",
+            filetypes=[("CSV файлы", "*.csv"), ("Все файлы", "*.*")]
+        )
+        if not filename:
             return
-        self.highlight_cells(matches)
-        messagebox.showinfo("Поиск", f"Найдено ячеек: {len(matches)}.")
+
+        entries = [self.cells[self._row_cids[i]] for i in rows.tolist()]
+        try:
+            self._write_cells_csv(filename, entries)
+            messagebox.showinfo("Экспорт", f"Сохранено ячеек: {len(entries)}.")
+        except Exception as e:
+            messagebox.showerror("Ошибка", f"Не удалось сохранить CSV:\n{e}")
 
     # ---------- Сохранение / загрузка CSV ----------
 
@@ -1391,6 +7872,14 @@ class CoreMapGUI:
             messagebox.showwarning("Сохранение", "Нет данных картограммы.")
             return
 
+        findings = self.validate_current()
+        errors = [f for f in findings if f.severity == VALIDATION_ERROR]
+        if errors:
+            self.show_validation()
+            text = "\n".join(f.message for f in errors)
+            if not messagebox.askyesno("Сохранение", f"В данных есть ошибки:\n{text}\n\nСохранить всё равно?"):
+                return
+
         filename = filedialog.asksaveasfilename(
             title="Сохранить картограмму в CSV",
             defaultextension=".csv",
@@ -1399,129 +7888,571 @@ class CoreMapGUI:
         if not filename:
             return
 
-        entries = list(self.cells.values())
-        entries.sort(key=lambda c: c["index"])
-
-        try:
-            with open(filename, "w", newline="", encoding="utf-8") as f:
-                writer = csv.writer(f, delimiter=";")
-                writer.writerow(
-                    [
-                        "index", "q", "r", "shape", "fuel_type",
-                        "pos_label", "factory_id",
-                        "mass_fuel", "mass_boron", "mass_gd"
-                    ]
-                )
-                for cell in entries:
-                    ft_idx = cell.get("fuel_type", 0)
-                    if 0 <= ft_idx < len(self.fuel_types):
-                        ft_name = self.fuel_types[ft_idx]["name"]
-                    else:
-                        ft_name = ""
-
-                    writer.writerow([
-                        cell["index"],
-                        cell["q"],
-                        cell["r"],
-                        cell["shape"],
-                        ft_name,                      # пишем НАЗВАНИЕ типа ТВС
-                        cell.get("pos_label", ""),
-                        cell.get("factory_id", ""),
-                        cell.get("mass_fuel", ""),
-                        cell.get("mass_boron", ""),
-                        cell.get("mass_gd", ""),
-                    ])
+        if self._save_future is not None and not self._save_future.done():
+            messagebox.showwarning("Сохранение", "Предыдущее сохранение ещё не завершено.")
+            return
 
+        # копия данных — запись идёт в фоне, правки в это время не мешают
+        cells_data = self._current_cells_data()
+        entries = sorted(cells_data, key=lambda c: c["index"])
+        type_names = [ft["name"] for ft in self.fuel_types]
+        version = self._data_version
+
+        job = BackgroundJob(f"CSV: {os.path.basename(filename)}")
+        future = self._io_executor().submit(write_cells_csv, filename, entries, type_names, job)
+        self._save_future = future
+        self.journal_status_var.set(f"Сохранение {os.path.basename(filename)}…")
+
+        def done():
+            try:
+                future.result()
+            except JobCancelled:
+                self._update_journal_status()
+                return
+            except Exception as e:
+                self._update_journal_status()
+                messagebox.showerror("Ошибка", f"Не удалось сохранить CSV:\n{e}")
+                return
+            if filename != self.document_path:
+                # «сохранить как»: журнал прежнего файла больше не нужен
+                self._journal_detach(discard=True)
+            self._journal_attach(filename, unsaved=self._data_version != version)
+            self._workspace_saved(filename, cells_data, type_names, version)
             messagebox.showinfo("Сохранение", "Картограмма сохранена.")
+
+        self._run_job(job, future, done)
+
+    def _io_executor(self):
+        if self._io_pool is None:
+            self._io_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="io")
+        return self._io_pool
+
+    def _when_done(self, future, callback, poll_ms=50):
+        """Вызвать callback в потоке Tk, когда фоновая задача завершится."""
+        if future.done():
+            callback()
+        else:
+            self.master.after(poll_ms, lambda: self._when_done(future, callback, poll_ms))
+
+    def _export_executor(self):
+        if self._export_pool is None:
+            self._export_pool = ThreadPoolExecutor(
+                max_workers=EXPORT_WORKERS, thread_name_prefix="export"
+            )
+        return self._export_pool
+
+    def _run_job(self, job, future, on_done):
+        """
+        Показать фоновую задачу в панели (прогресс и кнопка отмены)
+        и вызвать on_done() в потоке Tk, когда она завершится.
+        """
+        row = ttk.Frame(self.jobs_frame)
+        row.pack(fill="x", pady=1)
+        label = ttk.Label(row, text=job.title)
+        label.pack(anchor="w")
+        bar = ttk.Progressbar(row, mode="determinate", maximum=1.0, length=120)
+        bar.pack(side="left", fill="x", expand=True)
+
+        def cancel():
+            job.cancel()
+            label.configure(text=f"{job.title} — отмена…")
+
+        ttk.Button(row, text="Отмена", width=7, command=cancel).pack(side="left", padx=(4, 0))
+        self._jobs[job] = row
+
+        def tick():
+            if job in self._jobs:
+                bar.configure(value=job.fraction)
+                if job.stage and not job.cancelled:
+                    label.configure(text=f"{job.title} — {job.stage}")
+                self.master.after(JOB_POLL_MS, tick)
+
+        def finish():
+            self._jobs.pop(job, None)
+            row.destroy()
+            on_done()
+
+        tick()
+        self._when_done(future, finish, JOB_POLL_MS)
+
+    def _write_cells_csv(self, filename, entries):
+        """Записать ячейки в CSV картограммы (тип ТВС — по названию)."""
+        write_cells_csv(filename, entries, [ft["name"] for ft in self.fuel_types])
+
+    # ---------- Журнал правок ----------
+
+    def _journal_attach(self, path, unsaved):
+        """
+        Вести журнал правок для CSV path. unsaved — показанные данные уже
+        отличаются от файла (восстановлены или перенесены): тогда сразу пишется снимок.
+        """
+        if self.journal is None or self.journal.source_path != path:
+            # прежний журнал закрывается со своим признаком несохранённых правок
+            self._journal_detach()
+            self.document_path = path
+            self.journal = EditJournal(path)
+            self._local_edits = None
+        self._unsaved_edits = unsaved
+        if not unsaved:
+            self._local_edits = set()
+        if unsaved:
+            self._journal_compact()
+        else:
+            self.journal.start(len(self.cells))
+        self._update_journal_status()
+        self._watch_reset()
+
+    def _journal_detach(self, discard=None):
+        """Закрыть журнал; без несохранённых правок журнал и снимок удаляются."""
+        if self.journal is None:
+            return
+        self.journal.close(discard=not self._unsaved_edits if discard is None else discard)
+        self.journal = None
+        self._update_journal_status()
+
+    def _journal_append(self, applied):
+        journal = self.journal
+        if journal is None:
+            return
+        if journal.error is not None:
+            error = journal.error
+            self._journal_detach()
+            messagebox.showwarning("Журнал правок", f"Журнал правок отключён:\n{error}")
+            return
+        names = [ft["name"] for ft in self.fuel_types]
+        row_cids = self._row_cids
+        deltas = []
+        for row, field, _, new in applied:
+            if field == "fuel_type":
+                new = names[new] if 0 <= new < len(names) else ""
+            deltas.append((self.cells[row_cids[row]]["index"], field, new))
+        journal.append(deltas)
+        if journal.deltas_since_snapshot >= JOURNAL_COMPACT_DELTAS:
+            self._journal_compact()
+        self._update_journal_status()
+
+    def _journal_compact(self):
+        """Снимок текущих данных (в порядке строк) вместо накопленного журнала."""
+        if self.journal is not None:
+            self.journal.snapshot(self._current_cells_data(), [ft["name"] for ft in self.fuel_types])
+
+    def _update_journal_status(self):
+        if self.journal is None:
+            self.journal_status_var.set("Журнал правок: не ведётся")
+            return
+        name = os.path.basename(self.document_path or "")
+        state = "есть несохранённые правки" if self._unsaved_edits else "изменений нет"
+        self.journal_status_var.set(f"Журнал правок {name}: {state}")
+
+    def _recover_from_journal(self, path, source_rows):
+        """
+        Если для path остался журнал с правками (сбой или закрытие без сохранения),
+        предложить восстановить. Возвращает восстановленные строки CSV или None.
+        """
+        if self.journal is not None and self.journal.source_path == path:
+            return None  # журнал ведётся сейчас этим же окном
+        EditJournal.wait_closed(path)   # ждёт, только если журнал файла ещё закрывается
+        state = read_journal(path)
+        if state is None:
+            return None
+        header, edits = state
+        if not edits and header.get("base") != "snapshot":
+            discard_journal(path)
+            return None
+        if not messagebox.askyesno(
+            "Восстановление",
+            f"Для {os.path.basename(path)} найдены несохранённые правки "
+            f"({len(edits)} изм. после последнего снимка).\n"
+            "Восстановить их?"
+        ):
+            discard_journal(path)
+            return None
+        try:
+            return replay_journal(path, header, edits, source_rows)
         except Exception as e:
-            messagebox.showerror("Ошибка", f"Не удалось сохранить CSV:\n{e}")
+            messagebox.showerror("Восстановление", f"Не удалось восстановить правки:\n{e}")
+            return None
+
+    # ---------- Слежение за файлом ----------
+
+    def toggle_watch(self):
+        """Включить / выключить опрос открытого CSV на изменения."""
+        if self._watch_after is not None:
+            self.master.after_cancel(self._watch_after)
+            self._watch_after = None
+        if not self.watch_var.get():
+            self.watch_status_var.set("")
+            return
+        self._watch_reset()
+        self.watch_status_var.set("Слежение включено")
+        self._watch_after = self.master.after(WATCH_POLL_MS, self._poll_watched_file)
+
+    def _watch_reset(self):
+        """Считать текущую версию открытого файла показанной (после загрузки / сохранения)."""
+        self._watch_signature = file_signature(self.document_path) if self.document_path else None
+        self._watch_pending = None
+
+    def _poll_watched_file(self):
+        self._watch_after = None
+        if not self.watch_var.get():
+            return
+        path = self.document_path
+        busy = (
+            (self._watch_future is not None and not self._watch_future.done())
+            or (self._save_future is not None and not self._save_future.done())
+        )
+        if path and not busy:
+            signature = file_signature(path)
+            if signature is not None and signature != self._watch_signature:
+                if signature == self._watch_pending:
+                    # файл не менялся между опросами — запись закончена
+                    self._watch_pending = None
+                    self._start_watch_reload(path, signature)
+                else:
+                    self._watch_pending = signature
+        self._watch_after = self.master.after(WATCH_POLL_MS, self._poll_watched_file)
+
+    def _start_watch_reload(self, path, signature):
+        """Разобрать изменившийся файл в фоне и применить к картограмме в потоке Tk."""
+        future = self._io_executor().submit(read_cartogram_csv, path)
+        self._watch_future = future
+
+        def done():
+            self._watch_future = None
+            if path != self.document_path:
+                return      # за это время открыта другая картограмма
+            self._watch_signature = signature
+            try:
+                rows = future.result()
+            except Exception as e:
+                self.watch_status_var.set(f"Не удалось перечитать {os.path.basename(path)}: {e}")
+                return
+            self.apply_reloaded_rows(path, rows)
+            self._watch_signature = signature
 
-    def load_from_csv(self):
-        filename = filedialog.askopenfilename(
-            title="Загрузить картограмму из CSV",
-            filetypes=[("CSV файлы", "*.csv"), ("Все файлы", "*.*")]
+        self._when_done(future, done)
+
+    def apply_reloaded_rows(self, path, rows):
+        """
+        Применить перечитанный CSV открытой картограммы: ячейки сопоставляются
+        по index, и меняются только отличающиеся поля (одним шагом истории).
+        Если изменился состав ячеек или решётка, картограмма перестраивается.
+        Масштаб, сдвиг и поворот вида сохраняются.
+        """
+        n_types = len(self.fuel_types)
+        try:
+            cells_data = self._cells_data_from_rows(rows)
+        except Exception as e:
+            self.watch_status_var.set(f"Некорректный формат {os.path.basename(path)}: {e}")
+            return
+        unsaved = self._unsaved_edits
+        local = None if self._local_edits is None else set(self._local_edits)
+        name = os.path.basename(path)
+        stamp = time.strftime("%H:%M:%S")
+
+        changes = cell_changes_by_index(list(self.cells.values()), cells_data)
+        if changes is None:
+            if unsaved and not messagebox.askyesno(
+                "Файл изменён",
+                f"{name} изменён на диске: другой состав ячеек или решётка.\n"
+                "Перечитать его? Несохранённые правки будут потеряны."
+            ):
+                self.watch_status_var.set(f"{stamp} — файл изменён на диске, не перечитан")
+                return
+            self.build_from_cells_data(cells_data)
+            self.update_fuel_type_combo()
+            self.validate_current(rows)
+            unsaved = False
+            summary = f"картограмма перестроена ({len(cells_data)} ячеек)"
+        else:
+            kept = 0
+            if unsaved:
+                # поля со своими правками, у которых в файле другое значение
+                conflicts = [c for c in changes if local is None or (c[0], c[1]) in local]
+                if conflicts:
+                    answer = self._ask_reload_conflicts(name, conflicts)
+                    if answer is None:
+                        self.watch_status_var.set(f"{stamp} — файл изменён на диске, не перечитан")
+                        return
+                    if not answer:
+                        changes = [c for c in changes if c not in conflicts]
+                        kept = len({row for row, _, _ in conflicts})
+            if len(self.fuel_types) != n_types:
+                self.build_legend()
+                self.update_fuel_type_combo()
+            applied = self.apply_cell_changes(
+                [(self._row_cids[row], field, value) for row, field, value in changes]
+            )
+            self._local_edits = local       # значения из файла — не свои правки
+            summary = f"изменено ячеек: {len({row for row, _, _, _ in applied})}"
+            if kept:
+                summary += f", свои правки оставлены в {kept}"
+            self.validate_current()
+
+        # журнал ведётся от новой версии файла; оставленные свои правки — в снимке
+        self._journal_attach(path, unsaved=unsaved)
+        if 0 <= self.workspace_pos < len(self.workspace_paths) \
+                and self.workspace_paths[self.workspace_pos] == path and not unsaved:
+            # элемент набора показывает файл с диска — не помечать его правленым
+            entry = WorkspaceEntry(path, rows=rows, mtime=os.path.getmtime(path))
+            entry.cells_data = self._current_cells_data()
+            entry.type_names = [ft["name"] for ft in self.fuel_types]
+            entry.version = self._data_version
+            self.workspace_cache.put(entry)
+        self.watch_status_var.set(f"{time.strftime('%H:%M:%S')} — {summary}")
+
+    def _ask_reload_conflicts(self, name, conflicts):
+        """
+        Файл изменён там же, где есть несохранённые правки: True — взять значения
+        из файла, False — оставить свои, None — не перечитывать файл.
+        """
+        rows = sorted({row for row, _, _ in conflicts})
+        sample = ", ".join(
+            str(self.cells[self._row_cids[row]].get("pos_label", "")) for row in rows[:VALIDATION_SAMPLE]
         )
+        if len(rows) > VALIDATION_SAMPLE:
+            sample += ", …"
+        return messagebox.askyesnocancel(
+            "Файл изменён",
+            f"{name} изменён на диске, и в нём другие значения в ячейках "
+            f"с несохранёнными правками: {len(rows)} ({sample}).\n\n"
+            "Да — взять значения из файла.\n"
+            "Нет — оставить свои правки (остальные изменения из файла применяются).\n"
+            "Отмена — не перечитывать файл."
+        )
+
+    def on_close(self):
+        """Закрытие окна: дождаться записи файлов и закрыть журнал."""
+        if self._save_future is not None:
+            try:
+                self._save_future.result()
+            except Exception:
+                pass
+        for job in list(self._jobs):
+            job.cancel()
+        if self._watch_after is not None:
+            self.master.after_cancel(self._watch_after)
+            self._watch_after = None
+        if self.fleet_store is not None:
+            self.fleet_store.close()
+        self._leave_workspace_item()
+        self._journal_detach()
+        EditJournal.wait_closed()
+        for attr in ("_raster_after", "_minimap_after"):
+            after_id = getattr(self, attr)
+            if after_id is not None:
+                self.master.after_cancel(after_id)
+                setattr(self, attr, None)
+        for pool in (self._io_pool, self._prefetch_pool, self._export_pool, self._raster_pool):
+            if pool is not None:
+                pool.shutdown(wait=False)
+        self.master.destroy()
+
+    def load_from_csv(self, filename=None, notify=True):
+        """
+        Загрузить картограмму из CSV. Без filename показывается диалог выбора файла.
+        Возвращает True, если картограмма построена.
+        """
         if not filename:
-            return
+            filename = filedialog.askopenfilename(
+                title="Загрузить картограмму из CSV",
+                filetypes=[("CSV файлы", "*.csv"), ("Все файлы", "*.*")]
+            )
+        if not filename:
+            return False
 
         try:
-            with open(filename, "r", encoding="utf-8") as f:
-                reader = csv.DictReader(f, delimiter=";")
-                rows = list(reader)
+            rows = read_cartogram_csv(filename)
+        except ValueError as e:
+            messagebox.showerror("Ошибка", str(e))
+            return False
         except Exception as e:
             messagebox.showerror("Ошибка", f"Не удалось прочитать CSV:\n{e}")
-            return
+            return False
 
-        required = {"index", "q", "r", "shape", "fuel_type"}
-        missing = required - set(reader.fieldnames or [])
-        if missing:
-            messagebox.showerror(
-                "Ошибка",
-                "В CSV отсутствуют столбцы: " + ", ".join(missing)
-            )
-            return
+        recovered = self._recover_from_journal(filename, rows)
+        if recovered is not None:
+            rows = recovered
 
-        cells_data = []
-        used_types = set()
         try:
-            for row in rows:
-                idx = int(row["index"])
-                q = int(row["q"])
-                r = int(row["r"])
-
-                shape = row["shape"].strip().lower()
-                if shape not in ("hex", "circle"):
-                    shape = "hex"
-
-                # читаем тип ТВС как текст и получаем для него внутренний индекс
-                fuel_type_label = row.get("fuel_type", "")
-                fuel_type = self.get_or_create_fuel_type_index(fuel_type_label)
-
-                pos_label = row.get("pos_label") if "pos_label" in row else ""
-                if not pos_label:
-                    pos_label = str(idx)
-
-                factory_id = row.get("factory_id") if "factory_id" in row else ""
-                if factory_id is None:
-                    factory_id = ""
-
-                mass_fuel = row.get("mass_fuel") if "mass_fuel" in row else ""
-                mass_boron = row.get("mass_boron") if "mass_boron" in row else ""
-                mass_gd = row.get("mass_gd") if "mass_gd" in row else ""
-
-                cells_data.append({
-                    "index": idx,
-                    "q": q,
-                    "r": r,
-                    "shape": shape,
-                    "fuel_type": fuel_type,
-                    "pos_label": pos_label,
-                    "factory_id": factory_id,
-                    "mass_fuel": mass_fuel,
-                    "mass_boron": mass_boron,
-                    "mass_gd": mass_gd,
-                })
+            cells_data = self._cells_data_from_rows(rows)
         except Exception as e:
             messagebox.showerror("Ошибка", f"Некорректный формат CSV:\n{e}")
-            return
-
-        if used_types:
-            max_type = max(used_types)
-        else:
-            max_type = 0
+            return False
 
+        self._leave_workspace_item()
         self.zoom_factor = 1.0
         self.pan_offset = (0.0, 0.0)
         self.rotation_angle_deg = 0
         self.update_rotation_label()
 
-        self.build_from_cells_data(cells_data)
-        self.update_fuel_type_combo()
         self.coloring_mode_var.set("По типам ТВС")
         self.color_mode_combo.set("По типам ТВС")
-        self.apply_coloring_mode()
+        self.build_from_cells_data(cells_data)
+        self.update_fuel_type_combo()
         self.update_mass_stats_for_selected_type()
-        messagebox.showinfo("Загрузка", "Картограмма загружена.")
+        self._journal_attach(filename, unsaved=recovered is not None)
+        self.validate_current(rows)
+        if notify:
+            messagebox.showinfo("Загрузка", "Картограмма загружена.")
+            if self.validation_findings:
+                self.show_validation()
+        return True
+
+    def import_passports(self, filename=None):
+        """
+        Импорт масс и дополнительных полей из реестра паспортов по заводскому номеру.
+        После отчёта все изменения применяются одной транзакцией (одна перекраска).
+        """
+        if not self.cells:
+            messagebox.showwarning("Импорт паспортов", "Нет данных картограммы.")
+            return
+        if not filename:
+            filename = filedialog.askopenfilename(
+                title="Реестр паспортов ТВС (CSV)",
+                filetypes=[("CSV файлы", "*.csv"), ("Все файлы", "*.*")]
+            )
+        if not filename:
+            return
+
+        try:
+            header, rows = iter_passport_csv(filename)
+            join = PassportJoin(self.get_columns(), header, rows)
+        except ValueError as e:
+            messagebox.showerror("Импорт паспортов", str(e))
+            return
+        except Exception as e:
+            messagebox.showerror("Ошибка", f"Не удалось прочитать реестр:\n{e}")
+            return
+
+        report = "\n".join(join.report_lines())
+        if not join.updates:
+            messagebox.showinfo("Импорт паспортов", report + "\n\nНечего применять.")
+            return
+        if not messagebox.askyesno("Импорт паспортов", report + "\n\nПрименить данные паспортов?"):
+            return
+
+        row_cids = self._row_cids
+        changes = join.changes(lambda row: self.cells[row_cids[row]])
+        applied = self.apply_cell_changes(
+            [(row_cids[row], field, value) for row, field, value in changes]
+        )
+        messagebox.showinfo(
+            "Импорт паспортов",
+            f"Изменено значений: {len(applied)} в {len({d[0] for d in applied})} ячейках."
+        )
+
+    def _cells_data_from_rows(self, rows):
+        """Преобразовать строки CSV в список ячеек (типы ТВС — во внутренние индексы)."""
+        return cells_data_from_rows(rows, self.fuel_types)
+
+    # ---------- Проверка данных ----------
+
+    def validate_current(self, raw_rows=None):
+        """
+        Проверить показанную картограмму (raw_rows — её строки CSV в том же
+        порядке, если есть); ячейки с замечаниями подсвечиваются.
+        """
+        if not self.cells:
+            findings = []
+        else:
+            findings = validate_cartogram(self.get_columns(), list(self.cells.values()), raw_rows)
+        self.validation_findings = findings
+        self.validation_status_var.set(validation_summary(findings) if self.cells else "")
+        self.refresh_validation()
+        self.mark_validation_rows(row for f in findings for row in f.rows)
+        return findings
+
+    def mark_validation_rows(self, rows):
+        """
+        Отметить ячейки с замечаниями кольцами (метка "validation"). Подсветку
+        выделения и поиска это не трогает: выделенные ячейки остаются видны.
+        """
+        self.validation_rows = sorted(set(rows))
+        self._draw_validation_marks()
+
+    def _draw_validation_marks(self):
+        self.canvas.delete("validation")
+        n_rows = len(self._row_centres)
+        rows = [row for row in self.validation_rows if row < n_rows][:VALIDATION_MARKS_MAX]
+        if not rows:
+            return
+        px, py = self.pan_offset
+        radius = self.hex_size * 0.8
+        width = max(2, round(self.hex_size / 10))
+        for row in rows:
+            x, y = self._row_centres[row]
+            x += px
+            y += py
+            self.canvas.create_oval(
+                x - radius, y - radius, x + radius, y + radius,
+                outline=VALIDATION_MARK_COLOR, width=width, dash=(4, 3),
+                state="disabled", tags=("validation",),
+            )
+        self.canvas.tag_raise("hover")
+
+    def show_validation(self):
+        """Немодальное окно замечаний проверки; выбор строки подсвечивает её ячейки."""
+        if self.validation_window is not None and self.validation_window.winfo_exists():
+            self.validation_window.lift()
+            self.refresh_validation()
+            return
+
+        win = tk.Toplevel(self.master)
+        win.title("Проверка данных")
+        win.transient(self.master)
+
+        tree = ttk.Treeview(win, columns=("severity", "count", "message"), show="headings", height=12)
+        for key, title, width in (
+            ("severity", "Строгость", 110),
+            ("count", "Ячеек", 60),
+            ("message", "Замечание", 560),
+        ):
+            tree.heading(key, text=title)
+            tree.column(key, width=width, anchor="e" if key == "count" else "w")
+        scroll = ttk.Scrollbar(win, orient="vertical", command=tree.yview)
+        tree.configure(yscrollcommand=scroll.set)
+
+        tree.grid(row=0, column=0, sticky="nsew", padx=(5, 0), pady=5)
+        scroll.grid(row=0, column=1, sticky="ns", pady=5)
+        win.rowconfigure(0, weight=1)
+        win.columnconfigure(0, weight=1)
+
+        btn_frame = ttk.Frame(win)
+        btn_frame.grid(row=1, column=0, columnspan=2, sticky="w", padx=5, pady=(0, 5))
+        ttk.Button(
+            btn_frame,
+            text="Проверить снова",
+            command=self.validate_current
+        ).pack(side="left")
+
+        def on_select(event):
+            # выбранные замечания (без выбора — все) отмечаются кольцами
+            findings = [self.validation_findings[int(item)] for item in tree.selection()]
+            self.mark_validation_rows(
+                row for f in (findings or self.validation_findings) for row in f.rows
+            )
+
+        tree.bind("<<TreeviewSelect>>", on_select)
+
+        def on_close():
+            self.validation_window = None
+            self.validation_tree = None
+            win.destroy()
+
+        win.protocol("WM_DELETE_WINDOW", on_close)
+        self.validation_window = win
+        self.validation_tree = tree
+        self.refresh_validation()
+
+    def refresh_validation(self):
+        """Перезаполнить открытое окно проверки."""
+        tree = self.validation_tree
+        if tree is None:
+            return
+        tree.delete(*tree.get_children())
+        for i, finding in enumerate(self.validation_findings):
+            tree.insert("", "end", iid=str(i), values=(finding.severity, len(finding.rows), finding.message))
 
     # ---------- Экспорт изображений ----------
 
@@ -1542,7 +8473,10 @@ class CoreMapGUI:
             )
             if not filename:
                 return
-            self._export_raster_via_eps(filename, fmt, font_scale)
+            if self._raster_mode:
+                self._export_view_image(filename, fmt, font_scale)
+            else:
+                self._export_raster_via_eps(filename, fmt, font_scale)
 
         elif fmt == "SVG":
             filename = filedialog.asksaveasfilename(
@@ -1557,12 +8491,15 @@ class CoreMapGUI:
             messagebox.showerror("Экспорт", f"Формат {fmt} не поддерживается.")
 
     def _export_raster_via_eps(self, filename, fmt, font_scale):
-        scale_for_eps = 4
-        eps_file = os.path.splitext(filename)[0] + ".eps"
-
+        """
+        Снимок холста в EPS (в потоке Tk, с увеличенным шрифтом); растеризация
+        Pillow/Ghostscript и кодирование — фоновой задачей.
+        """
         old_pos_size = self.font_pos.cget("size") if self.font_pos else None
         old_factory_size = self.font_factory.cget("size") if self.font_factory else None
 
+        fd, eps_file = tempfile.mkstemp(suffix=".eps", prefix="cartogram_")
+        os.close(fd)
         try:
             if self.font_pos and old_pos_size is not None:
                 self.font_pos.configure(size=int(old_pos_size * font_scale))
@@ -1577,27 +8514,10 @@ class CoreMapGUI:
                 pagewidth=self.canvas_width,
                 pageheight=self.canvas_height
             )
-
-            img = Image.open(eps_file)
-            img.load(scale=scale_for_eps)
-
-            if fmt == "JPEG":
-                img = img.convert("RGB")
-                img.save(filename, "JPEG", quality=95)
-            elif fmt == "TIFF":
-                img.save(filename, "TIFF")
-            else:
-                img.save(filename, "PNG")
-
-            # os.remove(eps_file)
-
-            messagebox.showinfo(
-                "Экспорт",
-                f"{fmt} успешно сохранён (повышенное разрешение, увеличенный шрифт)."
-            )
-
         except Exception as e:
+            os.remove(eps_file)
             messagebox.showerror("Ошибка", f"Не удалось экспортировать {fmt}:\n{e}")
+            return
         finally:
             if self.font_pos and old_pos_size is not None:
                 self.font_pos.configure(size=old_pos_size)
@@ -1605,88 +8525,417 @@ class CoreMapGUI:
                 self.font_factory.configure(size=old_factory_size)
             self.canvas.update_idletasks()
 
-    def _export_svg(self, filename, font_scale):
-        width = self.canvas_width
-        height = self.canvas_height
+        job = BackgroundJob(f"{fmt}: {os.path.basename(filename)}")
+        future = self._export_executor().submit(rasterize_eps, eps_file, filename, fmt, job)
 
-        pos_size = int(self.font_pos.cget("size") * font_scale) if self.font_pos else 10
-        factory_size = int(self.font_factory.cget("size") * font_scale) if self.font_factory else 8
+        def done():
+            try:
+                future.result()
+            except JobCancelled:
+                return
+            except Exception as e:
+                messagebox.showerror("Ошибка", f"Не удалось экспортировать {fmt}:\n{e}")
+                return
+            messagebox.showinfo(
+                "Экспорт",
+                f"{fmt} успешно сохранён (повышенное разрешение, увеличенный шрифт)."
+            )
 
-        def esc(text):
-            return saxutils.escape(str(text))
+        self._run_job(job, future, done)
+
+    def export_poster(self):
+        """
+        Плакат в несколько десятков тысяч пикселей: отрисовка без Tk по
+        областям (полосами в один PNG или набором тайлов с индексом) в
+        фоновой задаче; текущая окраска, поворот и коэффициент шрифта.
+        """
+        if not self.cells:
+            messagebox.showwarning("Экспорт", "Нет данных для экспорта.")
+            return
+        side = simpledialog.askinteger(
+            "Плакат",
+            "Размер по большей стороне, пикс.:",
+            initialvalue=POSTER_DEFAULT_SIDE,
+            minvalue=1000,
+            maxvalue=POSTER_MAX_SIDE,
+            parent=self.master,
+        )
+        if not side:
+            return
+        filename = filedialog.asksaveasfilename(
+            title="Экспорт плаката",
+            defaultextension=".png",
+            filetypes=[
+                ("PNG одним файлом", "*.png"),
+                ("Тайлы PNG с индексом", "*.json"),
+            ]
+        )
+        if not filename:
+            return
 
+        scale = side / max(self.canvas_width, self.canvas_height)
+        width = max(1, round(self.canvas_width * scale))
+        height = max(1, round(self.canvas_height * scale))
         try:
-            with open(filename, "w", encoding="utf-8") as f:
-                f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-                f.write(
-                    f'<svg xmlns="http://www.w3.org/2000/svg" '
-                    f'width="{width}" height="{height}" '
-                    f'viewBox="0 0 {width} {height}">\n'
+            result = self._get_coloring(self.coloring_mode_var.get())
+            if result is None:
+                styles = type_cell_styles(self.get_columns(), [ft["color"] for ft in self.fuel_types])
+            else:
+                styles = result[0]
+            model = CartogramModel(
+                self._current_cells_data(), self.fuel_types,
+                os.path.splitext(os.path.basename(filename))[0], self.get_columns(),
+            )
+            renderer = PosterRenderer(
+                model, list(styles), width, height, self.rotation_angle_deg,
+                float(self.export_font_scale.get()),
+            )
+        except Exception as e:
+            messagebox.showerror("Ошибка", f"Не удалось подготовить плакат:\n{e}")
+            return
+
+        tiles = filename.lower().endswith(".json")
+        job = BackgroundJob(f"Плакат {width}×{height}: {os.path.basename(filename)}")
+        writer = write_poster_tiles if tiles else write_poster_png
+        future = self._export_executor().submit(writer, filename, renderer, job)
+
+        def done():
+            try:
+                future.result()
+            except JobCancelled:
+                return
+            except Exception as e:
+                messagebox.showerror("Ошибка", f"Не удалось экспортировать плакат:\n{e}")
+                return
+            where = poster_tiles_dir(filename) if tiles else filename
+            messagebox.showinfo("Экспорт", f"Плакат {width}×{height} сохранён:\n{where}")
+
+        self._run_job(job, future, done)
+
+    def export_report(self):
+        """Отчёт PDF по показанной картограмме (карты, статистика по типам, кольца)."""
+        if not self.cells:
+            messagebox.showwarning("Отчёт", "Нет данных для отчёта.")
+            return
+        filename = filedialog.asksaveasfilename(
+            title="Отчёт PDF",
+            defaultextension=".pdf",
+            filetypes=[("PDF", "*.pdf"), ("Все файлы", "*.*")]
+        )
+        if not filename:
+            return
+        name = os.path.splitext(os.path.basename(self.document_path or filename))[0]
+        model = CartogramModel(self._current_cells_data(), self.fuel_types, name, self.get_columns())
+
+        job = BackgroundJob(f"Отчёт: {os.path.basename(filename)}")
+        future = self._export_executor().submit(write_model_report, filename, model, job)
+
+        def done():
+            try:
+                future.result()
+            except JobCancelled:
+                return
+            except Exception as e:
+                messagebox.showerror("Ошибка", f"Не удалось сформировать отчёт:\n{e}")
+                return
+            messagebox.showinfo("Отчёт", f"Отчёт сохранён:\n{filename}")
+
+        self._run_job(job, future, done)
+
+    def export_report_batch(self):
+        """Отчёты PDF по всем CSV каталога — в процессах, с общим кэшем отрисовки."""
+        source = filedialog.askdirectory(title="Каталог с картограммами CSV")
+        if not source:
+            return
+        if not report_sources([source]):
+            messagebox.showwarning("Отчёты", "В каталоге нет файлов CSV.")
+            return
+        out_dir = filedialog.askdirectory(title="Каталог для отчётов PDF")
+        if not out_dir:
+            return
+
+        job = BackgroundJob(f"Отчёты: {os.path.basename(source)}")
+        future = self._export_executor().submit(
+            report_batch, [source], out_dir, self.fuel_types, default_render_cache_dir(), None, job
+        )
+
+        def done():
+            try:
+                done_files, failed = future.result()
+            except JobCancelled:
+                return
+            except Exception as e:
+                messagebox.showerror("Ошибка", f"Не удалось сформировать отчёты:\n{e}")
+                return
+            text = f"Отчётов: {len(done_files)} в {out_dir}"
+            if failed:
+                text += "\n\nОшибки:\n" + "\n".join(
+                    f"{os.path.basename(path)}: {error}" for path, error in failed[:10]
                 )
+                messagebox.showwarning("Отчёты", text)
+            else:
+                messagebox.showinfo("Отчёты", text)
 
-                # Фигуры: берем текущий цвет fill у Canvas (учитывает градиент)
-                for cell_id, cell in self.cells.items():
-                    item_type = self.canvas.type(cell_id)
-                    coords = self.canvas.coords(cell_id)
-                    fill_color = self.canvas.itemcget(cell_id, "fill") or "#FFFFFF"
-                    stroke_color = "#000000"
-
-                    if item_type == "oval" and len(coords) == 4:
-                        x1, y1, x2, y2 = coords
-                        cx = (x1 + x2) / 2.0
-                        cy = (y1 + y2) / 2.0
-                        r = (min(x2 - x1, y2 - y1)) / 2.0
-                        f.write(
-                            f'  <circle cx="{cx:.2f}" cy="{cy:.2f}" r="{r:.2f}" '
-                            f'stroke="{stroke_color}" fill="{fill_color}"/>\n'
-                        )
-                    elif item_type == "polygon" and len(coords) >= 6:
-                        points = " ".join(
-                            f"{coords[i]:.2f},{coords[i+1]:.2f}"
-                            for i in range(0, len(coords), 2)
-                        )
-                        f.write(
-                            f'  <polygon points="{points}" '
-                            f'stroke="{stroke_color}" fill="{fill_color}"/>\n'
-                        )
-
-                # Тексты
-                for cell_id, cell in self.cells.items():
-                    pos_text_id = cell.get("text_pos_id")
-                    if pos_text_id:
-                        x, y = self.canvas.coords(pos_text_id)
-                        text = self.canvas.itemcget(pos_text_id, "text")
-                        if text:
-                            f.write(
-                                f'  <text x="{x:.2f}" y="{y:.2f}" '
-                                f'font-family="Arial" font-size="{pos_size}" '
-                                f'text-anchor="middle" dominant-baseline="middle">'
-                                f'{esc(text)}</text>\n'
-                            )
-
-                    fact_text_id = cell.get("text_factory_id")
-                    if fact_text_id:
-                        x, y = self.canvas.coords(fact_text_id)
-                        text = self.canvas.itemcget(fact_text_id, "text")
-                        if text:
-                            f.write(
-                                f'  <text x="{x:.2f}" y="{y:.2f}" '
-                                f'font-family="Arial" font-size="{factory_size}" '
-                                f'text-anchor="middle" dominant-baseline="middle">'
-                                f'{esc(text)}</text>\n'
-                            )
-
-                f.write('</svg>\n')
+        self._run_job(job, future, done)
 
-            messagebox.showinfo("Экспорт", "SVG успешно сохранён.")
+    def show_export_matrix(self):
+        """Окно матрицы вариантов: выбор поворотов, режимов окраски и размера."""
+        if self.matrix_window is not None and self.matrix_window.winfo_exists():
+            self.matrix_window.lift()
+            return
+
+        win = tk.Toplevel(self.master)
+        win.title("Матрица вариантов")
+        win.transient(self.master)
+
+        ttk.Label(win, text="Повороты:").grid(row=0, column=0, sticky="w", padx=5, pady=(5, 0))
+        rotations = ttk.Frame(win)
+        rotations.grid(row=1, column=0, sticky="w", padx=5)
+        for i, rotation in enumerate(MATRIX_ROTATIONS):
+            ttk.Checkbutton(
+                rotations, text=f"{rotation}°", variable=self.matrix_rotation_vars[rotation]
+            ).grid(row=i // 6, column=i % 6, sticky="w", padx=(0, 6))
+
+        ttk.Label(win, text="Режимы окраски:").grid(row=2, column=0, sticky="w", padx=5, pady=(5, 0))
+        modes = tk.Listbox(win, selectmode=tk.MULTIPLE, height=12, width=44, exportselection=False)
+        for mode in HEADLESS_MODES:
+            modes.insert(tk.END, mode)
+        for i in range(1 + len(GRADIENT_MODES)):
+            modes.selection_set(i)
+        modes.grid(row=3, column=0, sticky="nsew", padx=5)
+
+        bottom = ttk.Frame(win)
+        bottom.grid(row=4, column=0, sticky="ew", padx=5, pady=5)
+        ttk.Label(bottom, text="Размер, пикс.:").pack(side="left")
+        ttk.Spinbox(
+            bottom, from_=200, to=RENDER_MAX_SIDE, increment=100,
+            textvariable=self.matrix_size_var, width=6
+        ).pack(side="left", padx=(2, 8))
+        ttk.Button(bottom, text="Экспортировать…", command=self.export_matrix).pack(side="left")
+        win.rowconfigure(3, weight=1)
+        win.columnconfigure(0, weight=1)
+
+        def on_close():
+            self.matrix_window = None
+            self._matrix_modes_list = None
+            win.destroy()
+
+        win.protocol("WM_DELETE_WINDOW", on_close)
+        self.matrix_window = win
+        self._matrix_modes_list = modes
+
+    def export_matrix(self):
+        """
+        Экспорт выбранных сочетаний в каталог и контактный лист. Раскраски
+        берутся из кэша раскрасок окна (текущие масштабирование и тип ТВС),
+        отрисовка — в процессах, фоновой задачей.
+        """
+        if not self.cells:
+            messagebox.showwarning("Экспорт", "Нет данных для экспорта.")
+            return
+        rotations = [r for r in MATRIX_ROTATIONS if self.matrix_rotation_vars[r].get()]
+        modes = [HEADLESS_MODES[i] for i in self._matrix_modes_list.curselection()]
+        if not rotations or not modes:
+            messagebox.showwarning("Экспорт", "Выберите хотя бы один поворот и один режим.")
+            return
+        try:
+            size = int(self.matrix_size_var.get())
+        except (tk.TclError, ValueError):
+            messagebox.showerror("Экспорт", "Некорректный размер изображения.")
+            return
+        out_dir = filedialog.askdirectory(title="Каталог для матрицы вариантов")
+        if not out_dir:
+            return
+
+        styles_by_mode = {}
+        skipped = []
+        for mode in modes:
+            result = self._get_coloring(mode)
+            if result is None:
+                skipped.append(mode)
+            else:
+                styles_by_mode[mode] = list(result[0])
+        if not styles_by_mode:
+            messagebox.showwarning("Экспорт", "Нет значений ни для одного из выбранных режимов.")
+            return
+        name = os.path.splitext(os.path.basename(self.document_path or ""))[0]
+        model = CartogramModel(self._current_cells_data(), self.fuel_types, name, self.get_columns())
+        fmt = self.export_format_var.get().upper()
+        font_scale = float(self.export_font_scale.get())
+
+        job = BackgroundJob(f"Матрица {len(rotations)}×{len(styles_by_mode)}")
+        future = self._export_executor().submit(
+            export_matrix, model, styles_by_mode, rotations, out_dir, size, fmt, font_scale, None, job
+        )
+
+        def done():
+            try:
+                files, sheet_file = future.result()
+            except JobCancelled:
+                return
+            except Exception as e:
+                messagebox.showerror("Ошибка", f"Не удалось экспортировать матрицу:\n{e}")
+                return
+            text = f"Вариантов: {len(files)}\nКонтактный лист: {sheet_file}"
+            if skipped:
+                text += "\n\nНет значений, пропущены:\n" + "\n".join(skipped)
+            messagebox.showinfo("Экспорт", text)
+
+        self._run_job(job, future, done)
+
+    def _export_view_image(self, filename, fmt, font_scale):
+        """Растровый режим: видимая область рисуется Pillow по модели, без снимка EPS."""
+        try:
+            scene = self._view_scene(font_scale, EXPORT_EPS_SCALE)
+        except Exception as e:
+            messagebox.showerror("Ошибка", f"Не удалось экспортировать {fmt}:\n{e}")
+            return
+
+        job = BackgroundJob(f"{fmt}: {os.path.basename(filename)}")
+        future = self._export_executor().submit(write_scene_image, filename, scene, fmt, job)
+
+        def done():
+            try:
+                future.result()
+            except JobCancelled:
+                return
+            except Exception as e:
+                messagebox.showerror("Ошибка", f"Не удалось экспортировать {fmt}:\n{e}")
+                return
+            messagebox.showinfo("Экспорт", f"{fmt} успешно сохранён (повышенное разрешение).")
+
+        self._run_job(job, future, done)
+
+    def _view_scene(self, font_scale, scale=1.0):
+        """
+        Видимая область в растровом режиме (на Canvas нет фигур ячеек) —
+        сцена из модели с текущими центрами, сдвигом и окраской.
+        """
+        import numpy as np
+
+        pan_x, pan_y = self.pan_offset
+        reach = self.hex_size * POSTER_REACH
+        rows = self.get_spatial_index().in_rect(
+            -pan_x - reach, -pan_y - reach,
+            -pan_x + self.canvas_width + reach, -pan_y + self.canvas_height + reach,
+        )
+        rows.sort()
+        centres = np.asarray(self._row_centres, dtype=np.float64).reshape(-1, 2)
+        xs = (centres[rows, 0] + pan_x) * scale
+        ys = (centres[rows, 1] + pan_y) * scale
+        styles = [style or BLANK_STYLE for style in self._applied_styles or [None] * len(self.cells)]
+        return self._raster_view_model().scene_rows(
+            styles, rows, xs, ys, self.hex_size * scale,
+            int(self.canvas_width * scale), int(self.canvas_height * scale), font_scale,
+        )
+
+    def _snapshot_svg_scene(self, font_scale):
+        """Снять с холста фигуры, цвета и подписи ячеек в неизменяемый CartogramScene."""
+        if self._raster_mode:
+            return self._view_scene(font_scale)
+        pos_size = int(self.font_pos.cget("size") * font_scale) if self.font_pos else 10
+        factory_size = int(self.font_factory.cget("size") * font_scale) if self.font_factory else 8
+
+        canvas = self.canvas
+        shapes = []
+        texts = []
+        for cell_id in self.cells:
+            shapes.append((
+                canvas.type(cell_id),
+                tuple(canvas.coords(cell_id)),
+                canvas.itemcget(cell_id, "fill") or "#FFFFFF",
+                canvas.itemcget(cell_id, "outline") or "#000000",
+            ))
+        for cell in self.cells.values():
+            for key, size, bold in (
+                ("text_pos_id", pos_size, True),
+                ("text_factory_id", factory_size, False),
+            ):
+                text_id = cell.get(key)
+                if not text_id:
+                    continue
+                text = canvas.itemcget(text_id, "text")
+                if text:
+                    x, y = canvas.coords(text_id)
+                    color = canvas.itemcget(text_id, "fill") or "black"
+                    texts.append((x, y, size, text, color, bold))
+        return CartogramScene(self.canvas_width, self.canvas_height, shapes, texts)
 
+    def _export_svg(self, filename, font_scale):
+        try:
+            scene = self._snapshot_svg_scene(font_scale)
         except Exception as e:
             messagebox.showerror("Ошибка", f"Не удалось экспортировать SVG:\n{e}")
+            return
+
+        job = BackgroundJob(f"SVG: {os.path.basename(filename)}")
+        future = self._export_executor().submit(write_svg, filename, scene, job)
+
+        def done():
+            try:
+                future.result()
+            except JobCancelled:
+                return
+            except Exception as e:
+                messagebox.showerror("Ошибка", f"Не удалось экспортировать SVG:\n{e}")
+                return
+            messagebox.showinfo("Экспорт", "SVG успешно сохранён.")
 
+        self._run_job(job, future, done)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Картограмма активной зоны",
+        epilog="Требуются Pillow и NumPy: pip install pillow numpy",
+    )
+    parser.add_argument(
+        "csv", nargs="*",
+        help="картограмма CSV, открываемая при запуске вместо решётки по умолчанию; "
+             "несколько файлов открываются как набор (циклы)"
+    )
+    parser.add_argument(
+        "--startup-timing", action="store_true",
+        help="вывести время до первого кадра и до готовности, затем закрыть окно"
+    )
+    serve = parser.add_argument_group("рендер-сервис (без окна)")
+    serve.add_argument(
+        "--serve", action="store_true",
+        help="запустить HTTP-сервис отрисовки картограмм вместо окна"
+    )
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8765)
+    serve.add_argument(
+        "--root", default=".",
+        help="каталог, из которого сервис читает CSV по path (по умолчанию текущий)"
+    )
+    serve.add_argument("--workers", type=int, default=None, help="процессов отрисовки (по умолчанию — по числу ядер)")
+    serve.add_argument("--threads", type=int, default=16, help="потоков обслуживания соединений")
+    serve.add_argument("--cache-dir", default=None, help="каталог дискового кэша изображений")
+    serve.add_argument("--cache-memory-mb", type=int, default=RENDER_CACHE_MEMORY // (1024 * 1024))
+    serve.add_argument("--cache-disk-mb", type=int, default=RENDER_CACHE_DISK // (1024 * 1024))
+    serve.add_argument("--verbose", action="store_true", help="журнал запросов в stderr")
+    report = parser.add_argument_group("отчёты PDF (без окна)")
+    report.add_argument(
+        "--report", metavar="КАТАЛОГ",
+        help="записать в КАТАЛОГ отчёты PDF по картограммам из позиционных аргументов "
+             "(файлы CSV или каталоги); --workers и --cache-dir — как у сервиса"
+    )
+    args = parser.parse_args(argv)
+
+    if args.serve:
+        serve_render(args)
+        return
+    if args.report:
+        sys.exit(report_main(args))
 
-def main():
     root = tk.Tk()
-    app = CoreMapGUI(root)
+    app = CoreMapGUI(
+        root,
+        initial_csv=args.csv[0] if len(args.csv) == 1 else None,
+        workspace=args.csv if len(args.csv) > 1 else None,
+        startup_timing=args.startup_timing,
+    )
     root.mainloop()
 
 
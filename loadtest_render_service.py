@@ -0,0 +1,143 @@
+"""
+Нагрузочная проверка рендер-сервиса картограмм (core_fas_8.py --serve).
+
+Отправляет запросы /render параллельно из нескольких потоков и печатает
+пропускную способность, перцентили задержки и распределение ответов по
+источнику (X-Cache: memory / disk / render / shared).
+
+Примеры:
+    python core_fas_8.py --serve --root .
+    python loadtest_render_service.py --path 241_UM_2025.csv -n 500 -c 16
+    python loadtest_render_service.py --csv 241_UM_2025.csv --rotations 0,60,120 --modes 0,1,7
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+
+def percentile(sorted_values, p):
+    """Перцентиль p (0..100) по отсортированному списку (ближайший ранг)."""
+    if not sorted_values:
+        return float("nan")
+    rank = max(1, int(round(p / 100.0 * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def build_requests(args, upload):
+    """Список (url, тело) — параметры перебираются по кругу (режимы × повороты)."""
+    combos = [
+        (mode, rotation)
+        for mode in args.modes.split(",")
+        for rotation in args.rotations.split(",")
+    ]
+    requests = []
+    for i in range(args.requests):
+        mode, rotation = combos[i % len(combos)]
+        query = {
+            "mode": mode.strip(),
+            "rotation": rotation.strip(),
+            "width": str(args.size),
+            "format": args.format,
+        }
+        if upload is None:
+            query["path"] = args.path
+        if args.no_cache:
+            # уникальный размер шрифта — каждый запрос мимо кэша
+            query["font_scale"] = f"{1.0 + i * 1e-6:.6f}"
+        url = args.url.rstrip("/") + "/render?" + urllib.parse.urlencode(query)
+        requests.append((url, upload))
+    return requests
+
+
+def run(args):
+    upload = None
+    if args.csv:
+        with open(args.csv, "rb") as f:
+            upload = f.read()
+    elif not args.path:
+        sys.exit("Укажите --path (CSV в каталоге сервиса) или --csv (загрузка файла).")
+
+    requests = build_requests(args, upload)
+    latencies = []
+    sources = Counter()
+    errors = Counter()
+    received = [0]
+    lock = threading.Lock()
+
+    def one(item):
+        url, body = item
+        req = urllib.request.Request(url, data=body, method="POST" if body is not None else "GET")
+        if body is not None:
+            req.add_header("Content-Type", "text/csv")
+        t0 = time.perf_counter()
+        try:
+            with urllib.request.urlopen(req, timeout=args.timeout) as resp:
+                data = resp.read()
+                source = resp.headers.get("X-Cache", "?")
+            elapsed = time.perf_counter() - t0
+            with lock:
+                latencies.append(elapsed)
+                sources[source] += 1
+                received[0] += len(data)
+        except urllib.error.HTTPError as e:
+            with lock:
+                errors[f"HTTP {e.code}"] += 1
+        except Exception as e:
+            with lock:
+                errors[type(e).__name__] += 1
+
+    t_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(one, requests))
+    wall = time.perf_counter() - t_start
+
+    latencies.sort()
+    ok = len(latencies)
+    print(f"Запросов: {len(requests)}, успешно: {ok}, ошибок: {sum(errors.values())}")
+    print(f"Параллельно: {args.concurrency}, время: {wall:.2f} с")
+    print(f"Пропускная способность: {ok / wall:.1f} запр/с, {received[0] / wall / 1e6:.1f} МБ/с")
+    if ok:
+        print(
+            "Задержка, мс: "
+            + ", ".join(
+                f"p{p}={percentile(latencies, p) * 1000:.1f}" for p in (50, 90, 95, 99)
+            )
+            + f", max={latencies[-1] * 1000:.1f}, среднее={sum(latencies) / ok * 1000:.1f}"
+        )
+    if sources:
+        print("Источник ответа: " + ", ".join(f"{k}={v}" for k, v in sources.most_common()))
+    if errors:
+        print("Ошибки: " + ", ".join(f"{k}={v}" for k, v in errors.most_common()))
+    return 0 if not errors else 1
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочная проверка рендер-сервиса картограмм")
+    parser.add_argument("--url", default="http://127.0.0.1:8765", help="адрес сервиса")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--path", help="CSV внутри каталога сервиса (GET)")
+    source.add_argument("--csv", help="локальный CSV, отправляемый в теле запроса (POST)")
+    parser.add_argument("-n", "--requests", type=int, default=200, help="всего запросов")
+    parser.add_argument("-c", "--concurrency", type=int, default=8, help="одновременных запросов")
+    parser.add_argument("--modes", default="0", help="номера режимов окраски через запятую")
+    parser.add_argument("--rotations", default="0", help="повороты (градусы) через запятую")
+    parser.add_argument("--size", type=int, default=1000, help="ширина и высота изображения")
+    parser.add_argument("--format", default="png", choices=["png", "jpeg", "tiff", "svg"])
+    parser.add_argument("--no-cache", action="store_true", help="каждый запрос с уникальными параметрами")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    args = parser.parse_args(argv)
+    if args.csv and not os.path.isfile(args.csv):
+        parser.error(f"нет файла {args.csv}")
+    return run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,383 @@
+"""Тесты чистых функций core_fas_8 (без окна Tk): запросы, соединения, журнал, выражения."""
+
+import numpy as np
+import pytest
+
+import core_fas_8 as m
+
+
+def make_cells(n=6):
+    """Строка решётки из n ячеек с массами и заводскими номерами."""
+    cells = []
+    for i in range(n):
+        cells.append({
+            "index": i + 1,
+            "q": i,
+            "r": 0,
+            "shape": "hex",
+            "fuel_type": i % 3,
+            "pos_label": f"1-{i + 1}",
+            "factory_id": f"F{i + 1}",
+            "mass_fuel": f"{3000 + 10 * i}",
+            "mass_boron": "" if i % 2 else "0.5",
+            "mass_gd": "",
+        })
+    return cells
+
+
+def query_rows(text, cells=None):
+    columns = m.CellColumns(cells or make_cells())
+    return np.flatnonzero(m.CellQuery(text).evaluate(columns)).tolist()
+
+
+# ---------- Запросы ----------
+
+def test_query_comparison_and_aliases():
+    assert query_rows("mass_fuel < 3020") == [0, 1]
+    assert query_rows("m_топл >= 3040") == [4, 5]
+    assert query_rows("тип = 1") == [1, 4]
+
+
+def test_query_and_binds_tighter_than_or():
+    # type = 0 OR (type = 1 AND mass_fuel > 3020)
+    assert query_rows("type = 0 OR type = 1 AND mass_fuel > 3020") == [0, 3, 4]
+    assert query_rows("(type = 0 OR type = 1) AND mass_fuel > 3020") == [3, 4]
+
+
+def test_query_not_missing_and_text():
+    assert query_rows("mass_boron IS MISSING") == [1, 3, 5]
+    assert query_rows("mass_boron IS NOT MISSING AND NOT type = 0") == [2, 4]
+    assert query_rows("factory_id = F3 OR pos = '1-6'") == [2, 5]
+    assert query_rows("factory_id != F1") == [1, 2, 3, 4, 5]
+
+
+@pytest.mark.parametrize("text", [
+    "",
+    "nosuch = 1",
+    "mass_fuel",
+    "mass_fuel < abc",
+    "factory_id < 5",
+    "(type = 1",
+    "type = 1 type = 2",
+    "mass_fuel < 1 @",
+])
+def test_query_errors(text):
+    with pytest.raises(ValueError):
+        m.CellQuery(text)
+
+
+# ---------- Импорт паспортов ----------
+
+def passport_join(cells, header, records):
+    return m.PassportJoin(m.CellColumns(cells), header, iter(records))
+
+
+def test_join_updates_masses_and_extra_without_blanking():
+    cells = make_cells(3)
+    join = passport_join(cells, ["factory_id", "mass_fuel", "mass_gd", "vendor"], [
+        ["F1", "3100.5", "", "ТВЭЛ"],
+        ["F2", "", "", ""],
+    ])
+    changes = join.changes(lambda row: cells[row])
+    assert (0, "mass_fuel", "3100.5") in changes
+    assert (0, "extra", {"vendor": "ТВЭЛ"}) in changes
+    assert not [c for c in changes if c[0] == 1]     # пустые значения не затирают данные
+    assert join.missing_on_map == ["F3"]
+
+
+def test_join_conflicts_first_record_wins():
+    cells = make_cells(3)
+    cells[2]["factory_id"] = "F1"                   # один номер на двух позициях
+    join = passport_join(cells, ["factory_id", "mass_fuel"], [
+        ["F1", "3100"],
+        ["F1", "3200"],
+        ["F9", "3300"],
+        ["", "3400"],
+    ])
+    changes = join.changes(lambda row: cells[row])
+    assert sorted(changes) == [(0, "mass_fuel", "3100"), (2, "mass_fuel", "3100")]
+    assert join.duplicates == {"F1": 2}
+    assert join.map_duplicates == ["F1"]
+    assert join.unmatched_count == 1 and join.blank_rows == 1
+
+
+def test_join_never_takes_cartogram_columns_as_extra(tmp_path):
+    cells = make_cells(2)
+    header = ["factory_id", "fuel_type", "pos_label", "index", "q", "r", "shape", "vendor"]
+    join = passport_join(cells, header, [["F1", "ПЗ", "9-9", "77", "5", "5", "circle", "X"]])
+    assert [name for name, _ in join.extra_columns] == ["vendor"]
+    assert join.ignored_columns == ["fuel_type", "pos_label", "index", "q", "r", "shape"]
+    assert join.changes(lambda row: cells[row]) == [(0, "extra", {"vendor": "X"})]
+
+    # стандартный столбец в extra не дублирует заголовок CSV
+    cells[0]["extra"] = {"pos_label": "9-9", "vendor": "X"}
+    path = tmp_path / "map.csv"
+    m.write_cells_csv(str(path), cells, ["Пусто", "ОМ-1", "ОМ-2"])
+    rows = m.read_cartogram_csv(str(path))
+    assert path.read_text(encoding="utf-8").splitlines()[0].split(";") == m.CSV_COLUMNS + ["vendor"]
+    assert rows[0]["pos_label"] == "1-1" and rows[0]["vendor"] == "X"
+
+
+# ---------- Журнал правок ----------
+
+TYPE_NAMES = ["Пусто", "ОМ-1", "ОМ-2"]
+
+
+def write_map(tmp_path, cells):
+    path = str(tmp_path / "map.csv")
+    m.write_cells_csv(path, cells, TYPE_NAMES)
+    return path
+
+
+def test_journal_replay_round_trip_with_extra(tmp_path):
+    cells = make_cells(3)
+    cells[1]["extra"] = {"vendor": "A", "batch": "7"}
+    path = write_map(tmp_path, cells)
+
+    journal = m.EditJournal(path)
+    journal.start(len(cells))
+    journal.append([(1, "mass_fuel", "3111.5"), (2, "factory_id", "F22")])
+    journal.append([(2, "extra", {"vendor": "B"}), (3, "fuel_type", "ОМ-2")])
+    journal.append([(1, "mass_fuel", "3112")])      # последняя правка поля побеждает
+    journal.close()
+    m.EditJournal.wait_closed(path)
+    assert journal.error is None
+
+    header, edits = m.read_journal(path)
+    assert header == {"base": "source", "rows": 3}
+    rows = {int(r["index"]): r for r in m.replay_journal(path, header, edits)}
+    assert rows[1]["mass_fuel"] == "3112"
+    assert rows[2]["factory_id"] == "F22"
+    assert rows[2]["vendor"] == "B" and rows[2]["batch"] == ""
+    assert rows[3]["fuel_type"] == "ОМ-2"
+
+    fuel_types = [{"name": name, "color": "#FFFFFF"} for name in TYPE_NAMES]
+    cells_data = m.cells_data_from_rows(list(rows.values()), fuel_types)
+    assert cells_data[1]["extra"] == {"vendor": "B"}
+    assert cells_data[2]["fuel_type"] == 2
+
+
+def test_journal_replay_extra_cannot_overwrite_core_fields(tmp_path):
+    path = write_map(tmp_path, make_cells(2))
+    edits = [(1, "extra", {"pos_label": "9-9", "fuel_type": "ОМ-2", "vendor": "X"})]
+    rows = m.replay_journal(path, {"base": "source", "rows": 2}, edits)
+    assert rows[0]["pos_label"] == "1-1"
+    assert rows[0]["fuel_type"] == "Пусто"
+    assert rows[0]["vendor"] == "X"
+
+
+def test_journal_snapshot_then_reset(tmp_path):
+    cells = make_cells(2)
+    path = write_map(tmp_path, cells)
+
+    journal = m.EditJournal(path)
+    journal.start(len(cells))
+    journal.append([(1, "mass_fuel", "1")])
+    edited = [dict(c) for c in cells]
+    edited[0]["mass_fuel"] = "1"
+    journal.snapshot(edited, TYPE_NAMES)
+    journal.append([(2, "mass_fuel", "2")])
+    journal.close()
+    m.EditJournal.wait_closed(path)
+
+    header, edits = m.read_journal(path)
+    assert header["base"] == "snapshot" and edits == [(2, "mass_fuel", "2")]
+    rows = m.replay_journal(path, header, edits)
+    assert [r["mass_fuel"] for r in rows] == ["1", "2"]
+
+    # новый журнал от исходного файла: снимок больше не нужен
+    journal = m.EditJournal(path)
+    journal.start(len(cells))
+    journal.close()
+    m.EditJournal.wait_closed(path)
+    assert m.read_journal(path) == ({"base": "source", "rows": 2}, [])
+    assert not (tmp_path / ("map.csv" + m.SNAPSHOT_SUFFIX)).exists()
+
+
+def test_concurrent_writers_of_one_file_do_not_share_temp_file(tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+
+    path = str(tmp_path / "map.csv")
+    variants = [make_cells(200 + 50 * i) for i in range(4)]
+    with ThreadPoolExecutor(4) as pool:
+        list(pool.map(lambda cells: m.write_cells_csv(path, cells, TYPE_NAMES), variants * 3))
+    assert len(m.read_cartogram_csv(path)) in {len(cells) for cells in variants}
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["map.csv"]
+
+
+def test_atomic_output_keeps_target_on_error(tmp_path):
+    path = tmp_path / "out.txt"
+    path.write_text("old", encoding="utf-8")
+    with pytest.raises(RuntimeError):
+        with m.atomic_output(str(path)) as tmp:
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write("new")
+            raise RuntimeError
+    assert path.read_text(encoding="utf-8") == "old"
+    assert [p.name for p in tmp_path.iterdir()] == ["out.txt"]
+
+
+def test_journal_close_does_not_wait_and_next_journal_waits_for_it(tmp_path):
+    path = write_map(tmp_path, make_cells(2))
+    old = m.EditJournal(path)
+    old.start(2)
+    old.append([(1, "mass_gd", "0.1")])
+    old.close(discard=True)              # возвращается сразу, журнал удаляется в фоне
+    new = m.EditJournal(path)            # тот же файл снова открыт
+    new.start(2)
+    new.append([(2, "mass_gd", "0.2")])
+    new.close()
+    m.EditJournal.wait_closed()
+    assert not old._thread.is_alive() and not new._thread.is_alive()
+    assert m.read_journal(path) == ({"base": "source", "rows": 2}, [(2, "mass_gd", "0.2")])
+
+
+def test_journal_torn_last_line_and_mismatch(tmp_path):
+    path = write_map(tmp_path, make_cells(2))
+    with open(path + m.JOURNAL_SUFFIX, "w", encoding="utf-8") as f:
+        f.write('{"base": "source", "rows": 2}\n[[1, "mass_gd", "0.1"]]\n[[2, "mass_')
+    header, edits = m.read_journal(path)
+    assert edits == [(1, "mass_gd", "0.1")]
+    with pytest.raises(ValueError):
+        m.replay_journal(path, {"base": "source", "rows": 3}, edits)
+    with pytest.raises(ValueError):
+        m.replay_journal(path, header, [(99, "mass_gd", "1")])
+
+
+# ---------- Вычисляемые столбцы ----------
+
+def test_computed_matches_builtin_metric_and_is_cached():
+    columns = m.CellColumns(make_cells())
+    column = m.ComputedColumn("погл", "nz(m_b) + nz(m_gd)")
+    values = columns.computed(column)
+    np.testing.assert_array_equal(values, columns.metric("m_погл"))
+    assert columns.computed(m.ComputedColumn("погл", column.text)) is values
+    assert column.fields == {"mass_boron", "mass_gd"}
+
+
+def test_computed_undefined_values_are_nan():
+    columns = m.CellColumns(make_cells(4))
+    values = m.ComputedColumn("x", "mass_fuel / (mass_fuel - 3010)").evaluate(columns)
+    assert np.isnan(values[1]) and np.isfinite(values[0])
+    assert np.isnan(m.ComputedColumn("x", "10 ** 400 * mass_fuel").evaluate(columns)).all()
+    assert np.isnan(m.ComputedColumn("x", "mass_boron").evaluate(columns)[[1, 3]]).all()
+    np.testing.assert_allclose(
+        m.ComputedColumn("x", "mass_fuel - mean(mass_fuel)").evaluate(columns), [-15, -5, 5, 15]
+    )
+
+
+def test_computed_long_but_shallow_expression_evaluates():
+    columns = m.CellColumns(make_cells(2))
+    text = "+".join(["mass_fuel"] * m.COMPUTED_MAX_DEPTH)
+    np.testing.assert_allclose(
+        m.ComputedColumn("x", text).evaluate(columns), [3000 * m.COMPUTED_MAX_DEPTH, 3010 * m.COMPUTED_MAX_DEPTH]
+    )
+
+
+@pytest.mark.parametrize("text", [
+    "__import__('os')",
+    "mass_fuel.real",
+    "(lambda: 1)()",
+    "mass_fuel if 1 else 0",
+    "[mass_fuel][0]",
+    "'abc'",
+    "factory_id + 1",
+    "nosuch * 2",
+    "sqrt(mass_fuel, 2)",
+    "open('x')",
+    "mass_fuel +",
+    "1" + "+1" * 3000,
+    "(" * 500 + "1" + ")" * 500,
+    "-" * 5000 + "1",
+])
+def test_computed_rejects_anything_but_arithmetic(text):
+    with pytest.raises(ValueError):
+        m.ComputedColumn("x", text)
+
+
+# ---------- Столбцы ячеек ----------
+
+def test_with_rows_updated_refreshes_text_and_masses():
+    cells = make_cells(3)
+    columns = m.CellColumns(cells)
+    assert columns.text_index("pos_label")["1-2"] == [1]
+
+    edited = dict(cells[1], pos_label="7-7", factory_id="F77", mass_fuel="", fuel_type=2)
+    new = columns.with_rows_updated([1], [edited])
+    assert new.text_index("pos_label")["7-7"] == [1] and "1-2" not in new.text_index("pos_label")
+    assert new.text_index("factory_id")["F77"] == [1]
+    assert np.isnan(new.numeric_column("mass_fuel")[1]) and new.fuel_type[1] == 2
+    # исходные столбцы не меняются
+    assert columns.pos_label[1] == "1-2" and columns.text_index("pos_label")["1-2"] == [1]
+    assert m.CellQuery("pos = '7-7'").evaluate(new).tolist() == [False, True, False]
+
+
+# ---------- Архив циклов ----------
+
+def test_fleet_store_keeps_type_names_of_legacy_csv(tmp_path):
+    path = tmp_path / "legacy.csv"
+    path.write_text(
+        "index;q;r;shape;fuel_type;pos_label;factory_id;mass_fuel;mass_boron;mass_gd\n"
+        "1;0;0;hex;9;1-1;A1;3050;;\n"
+        "2;1;0;hex;ОМ-1;1-2;A2;3060;;\n"
+        "3;2;0;hex;;1-3;;;;\n",
+        encoding="utf-8",
+    )
+    store = m.FleetStore(str(tmp_path / "fleet.sqlite"))
+    try:
+        assert store.ingest([str(path)]) == 3
+        # имена — как в списке типов окна (Combobox архива)
+        assert store.position_counts(fuel_type="Тип 9")["count"].tolist() == [1]
+        assert store.position_counts(fuel_type="9")["count"].size == 0
+        assert store.position_history("1-1", "Тип 9")["factory_id"].tolist() == ["A1"]
+        assert store.position_history("1-2", "ОМ-1")["factory_id"].tolist() == ["A2"]
+        assert store.position_history("1-3")["fuel_type"].tolist() == ["Пусто"]
+
+        renamed = [dict(ft) for ft in m.DEFAULT_FUEL_TYPES]
+        renamed[9]["name"] = "ТВС-9"
+        store.ingest([str(path)], fuel_types=renamed)    # повторная загрузка заменяет цикл
+        assert store.position_history("1-1", "ТВС-9")["seq"].tolist() == [0]
+        assert renamed[9]["name"] == "ТВС-9" and len(renamed) == len(m.DEFAULT_FUEL_TYPES)
+    finally:
+        store.close()
+
+
+# ---------- Рендер-сервис ----------
+
+@pytest.mark.parametrize("query", [
+    {"width": ["8000"]},
+    {"width": ["8000"], "height": ["2001"]},
+    {"font_scale": ["inf"]},
+    {"font_scale": ["300"]},
+    {"mode": ["99"]},
+])
+def test_render_options_limits(query):
+    with pytest.raises(ValueError):
+        m.render_options(query)
+
+
+def test_render_options_accepts_wide_image_within_area():
+    options = m.render_options({"width": ["8000"], "height": ["2000"], "format": ["svg"]})
+    assert (options["width"], options["height"], options["format"]) == (8000, 2000, "SVG")
+
+
+# ---------- Проверка данных ----------
+
+def test_unknown_shape_is_reported_without_raw_rows():
+    rows = m.parse_cartogram_csv([
+        "index;q;r;shape;fuel_type",
+        "1;0;0;hex;1",
+        "2;1;0;Hexagon;1",
+        "3;2;0; CIRCLE ;1",
+    ])
+    cells_data = m.cells_data_from_rows(rows, [dict(ft) for ft in m.DEFAULT_FUEL_TYPES])
+    assert [c["shape"] for c in cells_data] == ["hex", "hex", "circle"]
+    assert cells_data[1]["shape_source"] == "Hexagon" and "shape_source" not in cells_data[2]
+
+    findings = m.validate_cartogram(m.CellColumns(cells_data), cells_data)
+    assert [(f.rule, f.rows) for f in findings] == [("shape", [1])]
+
+    # исправленная в файле форма — не правка на месте, а перестроение
+    fixed = [dict(c) for c in cells_data]
+    del fixed[1]["shape_source"]
+    assert m.cell_changes_by_index(cells_data, fixed) is None